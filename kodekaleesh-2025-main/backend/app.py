@@ -1,15 +1,22 @@
 from flask import Flask, request, jsonify, g
+import click
 from flask_cors import CORS
 import os
 import json
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from document_processor import DocumentProcessor
-from summarizer import DocumentSummarizer
+from document_processor import DocumentProcessor, METADATA_VERSION
+from summarizer import SUMMARY_MODES, SummaryModeUnavailable
 from search_engine import SearchEngine
+from query_parser import QuerySyntaxError
+from document_extractors import ExtractionError
 from ocr_processor import OCRProcessor
 from auth import register_user, authenticate_user, create_token, auth_required
 from blockchain import SimpleChain
+from jobs import JobQueue, QueueFullError
 
 # Load environment variables from .env file
 load_dotenv()
@@ -76,6 +83,9 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf', 'txt', 'docx', 'jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff'}
 OCR_EXTENSIONS = {'jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff'}
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+MAX_BATCH_FILES = int(os.environ.get('MAX_BATCH_FILES', 500))
+MAX_BATCH_EXTRACTED_SIZE = 500 * 1024 * 1024  # zip contents, 500MB
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 2))
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -84,10 +94,10 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
 # Initialize services
-processor = DocumentProcessor()
-summarizer = DocumentSummarizer()
-search_engine = SearchEngine()
 ocr = OCRProcessor()
+processor = DocumentProcessor(ocr=ocr)
+search_engine = SearchEngine(processor.index, processor.store)
+jobs = JobQueue()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -133,6 +143,213 @@ def auth_login():
 def auth_me():
     return success_response({'user': g.user})
 
+class IngestionError(Exception):
+    """Upload could not be turned into a document"""
+    
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details
+
+
+def _wants_async():
+    """True when the client asked for background processing (?async=1)"""
+    flag = request.args.get('async', request.form.get('async', ''))
+    return flag.lower() in ('1', 'true', 'yes')
+
+
+def extract_document(filepath, filename, report=None):
+    """
+    OCR or read a saved upload into a document record, without storing it
+    
+    Args:
+        filepath: Path of the saved upload
+        filename: Sanitised original filename
+        report: Optional progress callback ``report(percent, message)``
+    
+    Returns:
+        (document_data, upload response payload)
+    """
+    report = report or (lambda progress, message=None: None)
+    
+    # Check if file is an image (needs OCR)
+    file_ext = filename.rsplit('.', 1)[1].lower()
+    ocr_result = None
+    
+    if file_ext in OCR_EXTENSIONS:
+        # Process with OCR
+        report(10, 'Running OCR')
+        errors = []
+        
+        def ocr_pages():
+            # Stream pages so a long TIFF never holds more than one frame
+            for page in ocr.iter_pages(filepath):
+                if not page['success']:
+                    errors.append(page.get('error'))
+                if page.get('page_count'):
+                    report(10 + 60 * page['page'] // page['page_count'],
+                           f"OCR page {page['page']} of {page['page_count']}")
+                yield page
+        
+        document_data = processor.build_paged_document(filepath, filename, ocr_pages())
+        if len(errors) == document_data['pages']:
+            raise IngestionError(
+                'OCR processing failed',
+                {
+                    'error': errors[0] if errors else None,
+                    'hint': 'Install Tesseract OCR: pip install pytesseract pillow'
+                }
+            )
+        ocr_result = {'confidence': document_data.get('ocr_confidence', 0)}
+    else:
+        report(30, 'Extracting text')
+        try:
+            document_data = processor.build_document(filepath, filename)
+        except ExtractionError as e:
+            raise IngestionError('Document extraction failed', {'error': str(e), 'hint': e.hint})
+    
+    response_data = {
+        'document_id': document_data['id'],
+        'filename': filename,
+        'pages': document_data['pages'],
+        'text_length': document_data['text_length'],
+        'file_type': 'image_ocr' if file_ext in OCR_EXTENSIONS else 'document'
+    }
+    
+    if ocr_result:
+        response_data['ocr_confidence'] = ocr_result.get('confidence', 0)
+    
+    return document_data, response_data
+
+
+def ingest_file(report, filepath, filename):
+    """OCR/process a saved upload and store it; returns the upload response payload"""
+    document_data, response_data = extract_document(filepath, filename, report)
+    if report:
+        report(80, 'Storing document')
+    processor.store_documents([document_data])
+    return response_data
+
+
+def ingest_batch(report, saved_files):
+    """
+    Extract many saved uploads in parallel, then store and index them together
+    
+    Args:
+        report: Optional progress callback ``report(percent, message)``
+        saved_files: List of (filepath, filename)
+    
+    Returns:
+        Dict with per-file results and failures
+    """
+    report = report or (lambda progress, message=None: None)
+    documents, results, failed = [], [], []
+    
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        futures = {
+            pool.submit(extract_document, filepath, filename): filename
+            for filepath, filename in saved_files
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            filename = futures[future]
+            try:
+                document_data, response_data = future.result()
+                documents.append(document_data)
+                results.append(response_data)
+            except IngestionError as e:
+                failed.append({'filename': filename, 'error': str(e), 'details': e.details})
+            except Exception as e:
+                failed.append({'filename': filename, 'error': str(e)})
+            report(90 * done // len(futures), f'Extracted {done}/{len(futures)} files')
+    
+    # One storage commit and one indexing pass for the whole batch
+    processor.store_documents(documents)
+    
+    return {
+        'documents': results,
+        'failed': failed,
+        'total': len(saved_files),
+        'successful': len(results)
+    }
+
+
+def _save_batch_files(files):
+    """
+    Save uploaded files, expanding .zip archives
+    
+    Raises:
+        IngestionError: batch has too many entries or is too large once
+            extracted; files saved so far are removed first
+    
+    Returns:
+        (list of (filepath, filename), list of rejected entries)
+    """
+    saved, rejected = [], []
+    used_names = set()
+    extracted_bytes = 0
+    
+    def unique_path(name):
+        base, ext = os.path.splitext(name)
+        candidate, counter = name, 1
+        while (candidate in used_names
+               or os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], candidate))):
+            candidate = f'{base}_{counter}{ext}'
+            counter += 1
+        used_names.add(candidate)
+        return candidate, os.path.join(app.config['UPLOAD_FOLDER'], candidate)
+    
+    def check_count(extra=1):
+        # Rejected entries count too, so a zip of junk cannot grow the response unbounded
+        if len(saved) + len(rejected) + extra > MAX_BATCH_FILES:
+            raise IngestionError('Too many files in batch', {'max_files': MAX_BATCH_FILES})
+    
+    try:
+        for file in files:
+            name = secure_filename(file.filename or '')
+            if name.lower().endswith('.zip'):
+                try:
+                    archive = zipfile.ZipFile(file.stream)
+                except zipfile.BadZipFile:
+                    check_count()
+                    rejected.append({'filename': name, 'error': 'Invalid zip archive'})
+                    continue
+                with archive:
+                    members = [m for m in archive.infolist() if not m.is_dir()]
+                    # Refuse oversized archives before writing any member
+                    check_count(len(members))
+                    for member in members:
+                        check_count()
+                        member_name = secure_filename(os.path.basename(member.filename))
+                        if not allowed_file(member_name):
+                            rejected.append({'filename': member.filename, 'error': 'File type not allowed'})
+                            continue
+                        extracted_bytes += member.file_size
+                        if extracted_bytes > MAX_BATCH_EXTRACTED_SIZE:
+                            raise IngestionError('Batch too large once extracted',
+                                                 {'max_extracted_mb': MAX_BATCH_EXTRACTED_SIZE / (1024*1024)})
+                        member_name, filepath = unique_path(member_name)
+                        saved.append((filepath, member_name))
+                        with archive.open(member) as src, open(filepath, 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+            else:
+                check_count()
+                if allowed_file(name):
+                    name, filepath = unique_path(name)
+                    saved.append((filepath, name))
+                    file.save(filepath)
+                else:
+                    rejected.append({'filename': file.filename, 'error': 'File type not allowed'})
+    except Exception:
+        # Never leave part of an aborted batch behind in uploads/
+        for filepath, _ in saved:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+        raise
+    
+    return saved, rejected
+
+
 @app.route('/api/upload', methods=['POST'])
 @auth_required
 def upload_document():
@@ -172,44 +389,101 @@ def upload_document():
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
-        # Check if file is an image (needs OCR)
-        file_ext = filename.rsplit('.', 1)[1].lower()
-        document_data = None
-        ocr_result = None
+        if _wants_async():
+            try:
+                job = jobs.submit('upload', ingest_file, filepath, filename, owner=g.user.get('id'))
+            except QueueFullError as e:
+                response, status = error_response('Upload queue is full, retry later', 503, str(e))
+                response.headers['Retry-After'] = '5'
+                return response, status
+            return success_response({
+                'job_id': job['id'],
+                'status': job['status'],
+                'status_url': f"/api/jobs/{job['id']}"
+            }, 'Upload accepted for processing', 202)
         
-        if file_ext in OCR_EXTENSIONS:
-            # Process with OCR
-            ocr_result = ocr.extract_text_with_preprocessing(filepath)
-            if ocr_result['success']:
-                document_data = processor.process_ocr_result(filepath, filename, ocr_result)
-            else:
-                return error_response(
-                    'OCR processing failed',
-                    400,
-                    {
-                        'error': ocr_result.get('error'),
-                        'hint': 'Install Tesseract OCR: pip install pytesseract pillow'
-                    }
-                )
-        else:
-            document_data = processor.process(filepath, filename)
+        try:
+            response_data = ingest_file(None, filepath, filename)
+        except IngestionError as e:
+            return error_response(str(e), 400, e.details)
+        
+        message = 'Image processed with OCR' if response_data['file_type'] == 'image_ocr' else 'Document uploaded successfully'
+        return success_response(response_data, message, 201)
+    
+    except Exception as e:
+        return error_response('Upload failed', 500, str(e))
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@auth_required
+def job_status(job_id):
+    """Report progress and result of a background upload"""
+    try:
+        job = jobs.get(job_id)
+        if not job or job.get('owner') not in (None, g.user.get('id')):
+            return error_response('Job not found', 404)
         
         response_data = {
-            'document_id': document_data['id'],
-            'filename': filename,
-            'pages': document_data['pages'],
-            'text_length': document_data['text_length'],
-            'file_type': 'image_ocr' if file_ext in OCR_EXTENSIONS else 'document'
+            'job_id': job['id'],
+            'status': job['status'],
+            'progress': job['progress'],
+            'message': job['message'],
+            'created_at': job['created_at'],
+            'updated_at': job['updated_at']
         }
+        if job['status'] == 'succeeded':
+            response_data['result'] = job['result']
+            response_data['document_id'] = job['result'].get('document_id')
+        elif job['status'] == 'failed':
+            response_data['error'] = job['error']
+            if job['result']:
+                response_data['details'] = job['result'].get('details')
+        return success_response(response_data)
+    except Exception as e:
+        return error_response('Failed to read job status', 500, str(e))
+
+
+@app.route('/api/upload/batch', methods=['POST'])
+@auth_required
+def upload_batch():
+    """Upload many documents/images (or .zip archives of them) in one request"""
+    try:
+        files = request.files.getlist('files') + request.files.getlist('file')
+        if not files:
+            return error_response('No files provided in request', 400)
         
-        if ocr_result:
-            response_data['ocr_confidence'] = ocr_result.get('confidence', 0)
+        try:
+            saved, rejected = _save_batch_files(files)
+        except IngestionError as e:
+            return error_response(str(e), 413, e.details)
         
-        message = 'Image processed with OCR' if file_ext in OCR_EXTENSIONS else 'Document uploaded successfully'
-        return success_response(response_data, message, 201)
+        if not saved:
+            return error_response('No supported files in batch', 400, {
+                'allowed_types': list(ALLOWED_EXTENSIONS),
+                'rejected': rejected
+            })
+        
+        if _wants_async():
+            try:
+                job = jobs.submit('upload_batch', ingest_batch, saved, owner=g.user.get('id'))
+            except QueueFullError as e:
+                response, status = error_response('Upload queue is full, retry later', 503, str(e))
+                response.headers['Retry-After'] = '5'
+                return response, status
+            return success_response({
+                'job_id': job['id'],
+                'status': job['status'],
+                'status_url': f"/api/jobs/{job['id']}",
+                'files_accepted': len(saved),
+                'rejected': rejected
+            }, 'Batch accepted for processing', 202)
+        
+        result = ingest_batch(None, saved)
+        result['failed'].extend(rejected)
+        return success_response(result, f"Processed {result['successful']} of {len(saved)} files", 201)
     
     except Exception as e:
-        return error_response('Upload failed', 500, str(e))
+        return error_response('Batch upload failed', 500, str(e))
 
 
 # ============ Proof of Integrity (Simple Chain) ============
@@ -265,9 +539,7 @@ def proof_chain():
     try:
         valid = ledger.verify()
         # return limited info for brevity
-        import json as _json
-        with open(CHAIN_FILE, 'r', encoding='utf-8') as f:
-            chain = _json.load(f)
+        chain = ledger.get_chain()
         return success_response({'valid': valid, 'length': len(chain), 'tip': chain[-1] if chain else None})
     except Exception as e:
         return error_response('Chain retrieval failed', 500, str(e))
@@ -294,16 +566,60 @@ def proof_hash(doc_id):
     except Exception as e:
         return error_response('Failed to compute hash', 500, str(e))
 
-@app.route('/api/documents', methods=['GET'])
+@app.route('/api/stats', methods=['GET'])
 @auth_required
-def list_documents():
-    """List all uploaded documents"""
+def service_stats():
+    """Cache and storage statistics for capacity planning"""
     try:
-        documents = processor.list_documents()
         return success_response({
-            'documents': documents,
-            'total': len(documents)
+            'document_cache': processor.cache_stats(),
+            'documents': len(processor.metadata),
+            'document_storage': processor.storage_stats(),
+            'upload_queue': jobs.stats(),
+            'ocr_cache': ocr.cache.stats() if ocr.cache else None
         })
+    except Exception as e:
+        return error_response('Failed to collect stats', 500, str(e))
+
+@app.route('/api/documents', methods=['GET'])
+@auth_required
+def list_documents():
+    """
+    List uploaded documents, one page at a time
+    
+    Query parameters: limit (1-500, default 50), cursor (next_cursor of the
+    previous page), sort (created_at, filename, text_length), order (asc,
+    desc), filename / min_length / max_length filters and fields
+    (comma-separated projection).
+    """
+    try:
+        try:
+            limit = int(request.args.get('limit', 50))
+            filters = {'filename': request.args.get('filename', '').strip()}
+            for name in ('min_length', 'max_length'):
+                if request.args.get(name):
+                    filters[name] = int(request.args[name])
+        except ValueError:
+            return error_response('limit, min_length and max_length must be integers', 400)
+        if limit < 1 or limit > 500:
+            return error_response('limit must be between 1 and 500', 400)
+        order = request.args.get('order', 'asc').lower()
+        if order not in ('asc', 'desc'):
+            return error_response('order must be asc or desc', 400)
+        fields = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+        
+        try:
+            page = processor.page_documents(
+                limit=limit,
+                cursor=request.args.get('cursor'),
+                sort=request.args.get('sort', 'created_at'),
+                descending=order == 'desc',
+                filters=filters,
+                fields=fields or None
+            )
+        except ValueError as e:
+            return error_response(str(e), 400)
+        return success_response(page)
     except Exception as e:
         return error_response('Failed to list documents', 500, str(e))
 
@@ -315,10 +631,6 @@ def summarize_document(doc_id):
         if not doc_id or len(doc_id.strip()) == 0:
             return error_response('Invalid document ID', 400)
         
-        doc = processor.get_document(doc_id)
-        if not doc:
-            return error_response('Document not found', 404)
-        
         try:
             max_length = int(request.args.get('max_length', 500))
             if max_length < 50 or max_length > 2000:
@@ -326,13 +638,24 @@ def summarize_document(doc_id):
         except ValueError:
             return error_response('max_length must be an integer', 400)
         
-        summary = summarizer.summarize(doc['content'], max_length=max_length)
+        mode = request.args.get('mode', 'frequency').lower()
+        if mode not in SUMMARY_MODES:
+            return error_response(f'mode must be one of {", ".join(SUMMARY_MODES)}', 400)
+        
+        try:
+            result = processor.summarize_document(doc_id, max_length=max_length, mode=mode)
+        except SummaryModeUnavailable as e:
+            return error_response('Summary mode unavailable', 400, str(e))
+        if result is None:
+            return error_response('Document not found', 404)
         
         return success_response({
             'document_id': doc_id,
-            'summary': summary,
-            'original_length': len(doc['content']),
-            'summary_length': len(summary)
+            'summary': result['summary'],
+            'mode': mode,
+            'key_points': result['key_points'],
+            'original_length': result['original_length'],
+            'summary_length': len(result['summary'])
         })
     except Exception as e:
         return error_response('Summarization failed', 500, str(e))
@@ -345,11 +668,10 @@ def document_metadata(doc_id):
         if not doc_id or len(doc_id.strip()) == 0:
             return error_response('Invalid document ID', 400)
         
-        doc = processor.get_document(doc_id)
-        if not doc:
-            return error_response('Document not found', 404)
-        
         metadata = processor.extract_metadata(doc_id)
+        doc = processor.metadata.get(doc_id)
+        if not metadata or not doc:
+            return error_response('Document not found', 404)
         
         return success_response({
             'document_id': doc_id,
@@ -396,14 +718,18 @@ def search_documents():
             return error_response('Search query too long (max 500 chars)', 400)
         
         limit = min(int(data.get('limit', 10)), 100)  # Max 100 results
+        ranking = data.get('ranking', 'bm25f')
         
-        results = search_engine.search(query, limit=limit)
+        results = search_engine.search(query, limit=limit, ranking=ranking)
         
         return success_response({
             'query': query,
+            'ranking': ranking,
             'results': results,
             'count': len(results)
         })
+    except QuerySyntaxError as e:
+        return error_response('Invalid search query', 400, str(e))
     except ValueError as e:
         return error_response('Invalid request parameters', 400, str(e))
     except Exception as e:
@@ -445,6 +771,7 @@ def ocr_status():
     return success_response({
         'ocr_available': ocr.is_available(),
         'supported_formats': list(ocr.SUPPORTED_FORMATS),
+        'engine': ocr.engine,
         'status': 'available' if ocr.is_available() else 'not_installed'
     })
 
@@ -684,6 +1011,30 @@ def method_not_allowed(error):
     """Handle 405 Method Not Allowed"""
     return error_response('Method not allowed', 405)
 
+# ============ Maintenance Commands ============
+
+@app.cli.command('compress-documents')
+def compress_documents():
+    """Rewrite stored document bodies with the configured codec (DOCUMENT_BLOB_CODEC)"""
+    blobs = getattr(processor.store, 'blobs', None)
+    if not blobs:
+        click.echo('Document bodies are stored inline; nothing to compress')
+        return
+    result = blobs.migrate()
+    # Full walk here rather than in /api/stats, which reads the running counters
+    blobs.recount()
+    stats = blobs.stats()
+    click.echo(f"Rewrote {result['rewritten']} blobs with {stats['codec']} (level {stats['level']}): "
+               f"{result['bytes_before']} -> {result['bytes_after']} bytes, "
+               f"compression ratio {stats['compression_ratio']}")
+
+@app.cli.command('recompute-metadata')
+@click.option('--all', 'recompute_all', is_flag=True, help='Recompute every document, not only outdated ones')
+def recompute_metadata(recompute_all):
+    """Re-extract keywords, entities and word counts stored with documents"""
+    count = processor.recompute_metadata(recompute_all)
+    click.echo(f'Recomputed metadata for {count} documents (metadata version {METADATA_VERSION})')
+
 if __name__ == '__main__':
     debug_flag = os.environ.get('FLASK_DEBUG', '1')
     debug = True if debug_flag == '1' else False
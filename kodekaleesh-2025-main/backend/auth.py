@@ -5,24 +5,33 @@ from functools import wraps
 from flask import request, jsonify, g
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from locking import file_lock, atomic_write_json, file_signature
 
 USERS_FILE = os.path.join(os.path.dirname(__file__), 'users.json')
 
+# Parsed users.json, reused until the file changes on disk
+_users_cache = {'signature': None, 'users': []}
+
 
 def _read_users():
-    if not os.path.exists(USERS_FILE):
-        return []
-    try:
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data.get('users', []) if isinstance(data, dict) else []
-    except Exception:
-        return []
+    with file_lock(USERS_FILE, shared=True):
+        signature = file_signature(USERS_FILE)
+        if signature is None:
+            return []
+        if signature != _users_cache['signature']:
+            try:
+                with open(USERS_FILE, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                users = data.get('users', []) if isinstance(data, dict) else []
+            except Exception:
+                return []
+            _users_cache.update(signature=signature, users=users)
+        return list(_users_cache['users'])
 
 
 def _write_users(users):
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump({'users': users}, f, indent=2)
+    # Callers hold the exclusive file lock
+    atomic_write_json(USERS_FILE, {'users': users}, indent=2)
 
 
 def _get_serializer(secret_key: str):
@@ -59,17 +68,20 @@ def register_user(email: str, password: str):
         return False, 'Invalid email'
     if not password or len(password) < 6:
         return False, 'Password must be at least 6 characters'
-    users = _read_users()
-    if any(u.get('email') == email for u in users):
-        return False, 'Email already registered'
-    user = {
-        'id': f'u{len(users)+1:05d}',
-        'email': email,
-        'password_hash': generate_password_hash(password),
-        'created_at': datetime.utcnow().isoformat()
-    }
-    users.append(user)
-    _write_users(users)
+    password_hash = generate_password_hash(password)
+    # Lock across read-check-write so two workers cannot register the same email or id
+    with file_lock(USERS_FILE):
+        users = _read_users()
+        if any(u.get('email') == email for u in users):
+            return False, 'Email already registered'
+        user = {
+            'id': f'u{len(users)+1:05d}',
+            'email': email,
+            'password_hash': password_hash,
+            'created_at': datetime.utcnow().isoformat()
+        }
+        users.append(user)
+        _write_users(users)
     return True, {'id': user['id'], 'email': user['email']}
 
 
@@ -0,0 +1,311 @@
+"""Content-addressed, compressed files holding document bodies"""
+
+import gzip
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from typing import Dict, Any, Optional, Tuple
+
+from cache import LRUCache
+from locking import file_lock, atomic_write_json
+
+# Try to import zstd support - gzip (stdlib) is used without it
+ZSTD_AVAILABLE = False
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    pass
+
+CODECS = ('none', 'gzip', 'zstd')
+DEFAULT_LEVELS = {'none': 0, 'gzip': 6, 'zstd': 3}
+# Neither magic number can start valid UTF-8 text, so uncompressed blobs
+# written by earlier versions are recognised as such
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Running blob/byte counters, kept next to the blobs and shared by every process
+STATS_FILE = '.stats.json'
+
+
+class BlobStore:
+    """
+    Store each distinct document body once, in a file named by its SHA-256
+
+    Bodies are immutable, so readers need no locks and identical uploads
+    share one file. Callers are responsible for deleting a blob only when
+    no document references it any more.
+
+    Each file is self-describing (gzip/zstd magic or plain UTF-8), so
+    changing the codec never breaks reading existing blobs; ``migrate``
+    rewrites them in the configured codec.
+
+    Blob count and byte totals are maintained in ``.stats.json`` by every
+    put/delete/migrate, so ``stats`` never walks the directory; ``recount``
+    rebuilds them from the files.
+
+    A body can have companions (``<digest>.<name>``): binary values derived
+    from the body alone, compressed with the same codec and deleted with it.
+    They count towards the byte totals but not the blob count.
+
+    Args:
+        directory: Blob directory (DOCUMENT_BLOB_DIR, default ``document_blobs``)
+        codec: 'zstd', 'gzip' or 'none' (DOCUMENT_BLOB_CODEC, default zstd
+            when zstandard is installed, else gzip)
+        level: Compression level (DOCUMENT_BLOB_LEVEL, codec default)
+    """
+
+    def __init__(self, directory: Optional[str] = None, codec: Optional[str] = None,
+                 level: Optional[int] = None):
+        self.directory = directory or os.getenv('DOCUMENT_BLOB_DIR', 'document_blobs')
+        self.codec = (codec or os.getenv('DOCUMENT_BLOB_CODEC', 'zstd' if ZSTD_AVAILABLE else 'gzip')).lower()
+        if self.codec not in CODECS:
+            raise ValueError(f'Unknown document blob codec: {self.codec}')
+        if self.codec == 'zstd' and not ZSTD_AVAILABLE:
+            raise ValueError('The zstd codec needs the zstandard package: pip install zstandard')
+        if level is None:
+            level = int(os.getenv('DOCUMENT_BLOB_LEVEL', DEFAULT_LEVELS[self.codec]))
+        self.level = level
+        # Blobs are immutable, so recently decoded bodies never go stale; this
+        # lets several snippet reads of one search hit decompress it once
+        self._decoded = LRUCache(int(os.getenv('DOCUMENT_BLOB_CACHE_BYTES', 64 * 1024 * 1024)))
+        self._stats_path = os.path.join(self.directory, STATS_FILE)
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def digest(content: str) -> str:
+        """Address of a body (hash of the text, independent of the codec)"""
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _encode(self, raw: bytes) -> bytes:
+        if self.codec == 'gzip':
+            return gzip.compress(raw, compresslevel=self.level, mtime=0)
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level).compress(raw)
+        return raw
+
+    @staticmethod
+    def _decode(data: bytes) -> bytes:
+        if data[:2] == GZIP_MAGIC:
+            return gzip.decompress(data)
+        if data[:4] == ZSTD_MAGIC:
+            if not ZSTD_AVAILABLE:
+                raise RuntimeError('Blob is zstd-compressed but zstandard is not installed')
+            return zstandard.ZstdDecompressor().decompress(data)
+        return data
+
+    @staticmethod
+    def _codec_of(data: bytes) -> str:
+        if data[:2] == GZIP_MAGIC:
+            return 'gzip'
+        if data[:4] == ZSTD_MAGIC:
+            return 'zstd'
+        return 'none'
+
+    def _write(self, path: str, data: bytes):
+        """Atomically write ``data`` to ``path``"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _read_counters(self) -> Optional[Dict[str, int]]:
+        try:
+            with open(self._stats_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _adjust(self, blobs: int = 0, stored: int = 0, raw: int = 0):
+        """Add to the persisted counters; the caller holds the stats lock"""
+        counters = self._read_counters()
+        if counters is None:
+            return  # Not counted yet; the first stats() call walks the blobs
+        counters['blobs'] += blobs
+        counters['stored_bytes'] += stored
+        counters['raw_bytes'] += raw
+        atomic_write_json(self._stats_path, counters)
+
+    def put(self, content: str) -> str:
+        """Write a body if it is not stored yet; returns its digest"""
+        digest = self.digest(content)
+        path = self._path(digest)
+        if os.path.exists(path):
+            return digest
+        raw = content.encode('utf-8')
+        data = self._encode(raw)
+        with file_lock(self._stats_path):
+            # Re-check so a body written concurrently is counted once
+            if not os.path.exists(path):
+                self._write(path, data)
+                self._adjust(1, len(data), len(raw))
+        return digest
+
+    def get(self, digest: str) -> Optional[str]:
+        """Body for a digest, or None if it is not stored"""
+        content = self._decoded.get(digest)
+        if content is not None:
+            return content
+        try:
+            with open(self._path(digest), 'rb') as f:
+                content = self._decode(f.read()).decode('utf-8')
+        except FileNotFoundError:
+            return None
+        self._decoded.put(digest, content)
+        return content
+
+    def _sizes(self, path: str) -> Tuple[int, int]:
+        """(stored, raw) size of a file; raises FileNotFoundError"""
+        stored = os.path.getsize(path)
+        return stored, self._raw_size(path, stored)
+
+    def _remove(self, path: str) -> Tuple[int, int]:
+        """Delete a file, returning its (stored, raw) sizes; caller holds the stats lock"""
+        sizes = self._sizes(path)
+        os.remove(path)
+        return sizes
+
+    def delete(self, digest: str):
+        """Remove a body and its companions (no-op if already gone)"""
+        self._decoded.invalidate(digest)
+        path = self._path(digest)
+        with file_lock(self._stats_path):
+            try:
+                names = os.listdir(os.path.dirname(path))
+            except FileNotFoundError:
+                return
+            for name in names:
+                if name.startswith(digest + '.'):
+                    try:
+                        stored, raw = self._remove(os.path.join(os.path.dirname(path), name))
+                    except FileNotFoundError:
+                        continue
+                    self._adjust(0, -stored, -raw)
+            try:
+                stored, raw = self._remove(path)
+            except FileNotFoundError:
+                return
+            self._adjust(-1, -stored, -raw)
+
+    def put_companion(self, digest: str, name: str, data: bytes) -> bool:
+        """
+        Store (or replace) a value derived from the body ``digest``
+
+        Returns:
+            False, storing nothing, if the body is not stored (any more)
+        """
+        path = f'{self._path(digest)}.{name}'
+        encoded = self._encode(data)
+        with file_lock(self._stats_path):
+            # Checked under the lock delete() holds, so no companion outlives its body
+            if not os.path.exists(self._path(digest)):
+                return False
+            try:
+                stored, raw = self._sizes(path)
+            except FileNotFoundError:
+                stored = raw = 0
+            self._write(path, encoded)
+            self._adjust(0, len(encoded) - stored, len(data) - raw)
+        return True
+
+    def get_companion(self, digest: str, name: str) -> Optional[bytes]:
+        """Companion value of a body, or None if it is not stored"""
+        try:
+            with open(f'{self._path(digest)}.{name}', 'rb') as f:
+                return self._decode(f.read())
+        except FileNotFoundError:
+            return None
+
+    def _blob_paths(self):
+        """Paths of every body and companion"""
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                # Skips temp files and the counters file and its lock
+                if not name.startswith('.'):
+                    yield os.path.join(root, name)
+
+    def migrate(self) -> Dict[str, Any]:
+        """
+        Rewrite every blob not stored with the configured codec
+
+        Safe to run while the service is up: each rewrite is an atomic
+        replace of a file with the same content.
+
+        Returns:
+            Number of blobs rewritten and total stored bytes before/after
+        """
+        rewritten = before = after = 0
+        for path in self._blob_paths():
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue  # Deleted meanwhile
+            before += len(data)
+            if self._codec_of(data) != self.codec:
+                encoded = self._encode(self._decode(data))
+                with file_lock(self._stats_path):
+                    if not os.path.exists(path):
+                        continue  # Deleted meanwhile
+                    self._write(path, encoded)
+                    self._adjust(stored=len(encoded) - len(data))
+                data = encoded
+                rewritten += 1
+            after += len(data)
+        return {'rewritten': rewritten, 'bytes_before': before, 'bytes_after': after}
+
+    @staticmethod
+    def _raw_size(path: str, stored: int) -> int:
+        """Uncompressed size from the gzip trailer / zstd frame header"""
+        with open(path, 'rb') as f:
+            header = f.read(18)
+            if header[:2] == GZIP_MAGIC:
+                f.seek(-4, os.SEEK_END)
+                return struct.unpack('<I', f.read(4))[0]
+            if header[:4] == ZSTD_MAGIC and ZSTD_AVAILABLE:
+                size = zstandard.frame_content_size(header)
+                if size >= 0:
+                    return size
+        return stored
+
+    def recount(self) -> Dict[str, int]:
+        """Rebuild the persisted counters by reading every blob (O(corpus) I/O)"""
+        with file_lock(self._stats_path):
+            blobs = stored = raw = 0
+            for path in self._blob_paths():
+                try:
+                    size = os.path.getsize(path)
+                    raw += self._raw_size(path, size)
+                except FileNotFoundError:
+                    continue
+                if '.' not in os.path.basename(path):
+                    blobs += 1  # A body, not a companion
+                stored += size
+            counters = {'blobs': blobs, 'stored_bytes': stored, 'raw_bytes': raw}
+            atomic_write_json(self._stats_path, counters)
+            return counters
+
+    def stats(self) -> Dict[str, Any]:
+        """Codec settings, blob count, stored and uncompressed bytes, compression ratio"""
+        counters = self._read_counters() or self.recount()
+        stored, raw = counters['stored_bytes'], counters['raw_bytes']
+        return {
+            'codec': self.codec,
+            'level': self.level,
+            'blobs': counters['blobs'],
+            'stored_bytes': stored,
+            'raw_bytes': raw,
+            'compression_ratio': round(raw / stored, 2) if stored else 1.0
+        }
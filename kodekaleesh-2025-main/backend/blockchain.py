@@ -2,21 +2,34 @@ import hashlib
 import json
 import os
 from datetime import datetime
+from locking import file_lock, atomic_write_json, file_signature
 
 
 class SimpleChain:
     def __init__(self, chain_file: str):
         self.chain_file = chain_file
-        if not os.path.exists(self.chain_file):
-            self._write_chain([self._create_genesis_block()])
+        self._cache = None
+        self._cache_signature = None
+        with file_lock(self.chain_file):
+            if not os.path.exists(self.chain_file):
+                self._write_chain([self._create_genesis_block()])
 
     def _read_chain(self):
-        with open(self.chain_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        # Re-parse only when another process (or this one) rewrote the file
+        with file_lock(self.chain_file, shared=True):
+            signature = file_signature(self.chain_file)
+            if signature != self._cache_signature:
+                with open(self.chain_file, 'r', encoding='utf-8') as f:
+                    self._cache = json.load(f)
+                self._cache_signature = signature
+            return list(self._cache)
 
     def _write_chain(self, chain):
-        with open(self.chain_file, 'w', encoding='utf-8') as f:
-            json.dump(chain, f, indent=2)
+        # Callers hold the exclusive file lock
+        atomic_write_json(self.chain_file, chain, indent=2)
+
+    def get_chain(self):
+        return self._read_chain()
 
     def _create_genesis_block(self):
         data = {
@@ -33,17 +46,19 @@ class SimpleChain:
         return hashlib.sha256(payload).hexdigest()
 
     def add_block(self, data: dict):
-        chain = self._read_chain()
-        prev = chain[-1]
-        block = {
-            'index': prev['index'] + 1,
-            'timestamp': datetime.utcnow().isoformat(),
-            'data': data,
-            'previous_hash': prev['hash']
-        }
-        block['hash'] = self._hash_block(block)
-        chain.append(block)
-        self._write_chain(chain)
+        # Hold the lock across read-modify-write so concurrent workers never fork the chain
+        with file_lock(self.chain_file):
+            chain = self._read_chain()
+            prev = chain[-1]
+            block = {
+                'index': prev['index'] + 1,
+                'timestamp': datetime.utcnow().isoformat(),
+                'data': data,
+                'previous_hash': prev['hash']
+            }
+            block['hash'] = self._hash_block(block)
+            chain.append(block)
+            self._write_chain(chain)
         return block
 
     def verify(self):
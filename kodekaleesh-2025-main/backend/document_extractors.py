@@ -0,0 +1,154 @@
+"""Page-by-page text extraction for PDF and DOCX uploads"""
+
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import Dict, Any, Iterator
+
+# Try to import PDF support - graceful fallback if not available
+PYPDF_AVAILABLE = False
+try:
+    from pypdf import PdfReader
+    PYPDF_AVAILABLE = True
+except ImportError:
+    pass
+
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+
+class ExtractionError(ValueError):
+    """Raised when a document cannot be read"""
+
+    def __init__(self, message: str, hint: str = None):
+        super().__init__(message)
+        self.hint = hint
+
+
+def iter_pdf_pages(path: str, ocr=None) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the text of a PDF one page at a time
+
+    pypdf parses page objects on access, so only the current page's
+    content stream (and images, when OCR is needed) is held in memory.
+    Pages without a text layer are sent to ``ocr`` if one is given.
+
+    Args:
+        path: Path to the PDF
+        ocr: Optional OCRProcessor for image-only pages
+
+    Yields:
+        Dicts with page, page_count, text, success and source ('text',
+        'ocr' or 'empty'); OCR pages also carry confidence and word_count
+
+    Raises:
+        ExtractionError: if the PDF cannot be opened, or after the last
+            page when no page could be extracted
+    """
+    if not PYPDF_AVAILABLE:
+        raise ExtractionError('PDF support not installed', 'Install pypdf: pip install pypdf')
+
+    with open(path, 'rb') as f:
+        try:
+            reader = PdfReader(f)
+            page_count = len(reader.pages)
+        except Exception as e:
+            raise ExtractionError(f'Could not read PDF: {e}')
+
+        failed = 0
+        error = None
+        for number in range(page_count):
+            page = reader.pages[number]
+            try:
+                text = (page.extract_text() or '').strip()
+            except Exception as e:
+                result = {'page': number + 1, 'page_count': page_count, 'success': False,
+                          'text': '', 'error': str(e)}
+            else:
+                result = {'page': number + 1, 'page_count': page_count, 'success': True,
+                          'text': text, 'source': 'text'}
+                if not text:
+                    result['source'] = 'empty'
+                    if ocr is not None and ocr.is_available():
+                        result.update(_ocr_page_images(page, ocr))
+            if not result['success']:
+                failed += 1
+                error = result.get('error')
+            yield result
+
+        if page_count and failed == page_count:
+            raise ExtractionError(f'Could not extract any of the {page_count} PDF pages: {error}')
+
+
+def _ocr_page_images(page, ocr) -> Dict[str, Any]:
+    """OCR the embedded images of a page that has no text layer"""
+    try:
+        images = [ocr.extract_image(image_file.image) for image_file in page.images]
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+    if not images:
+        return {}
+    combined = ocr.combine_pages(images)
+    if not combined['success']:
+        return {'success': False, 'error': combined.get('error')}
+    return {
+        'text': combined['text'],
+        'source': 'ocr',
+        'confidence': combined['confidence'],
+        'word_count': combined.get('word_count', 0)
+    }
+
+
+def iter_docx_pages(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the text of a DOCX one page at a time
+
+    ``word/document.xml`` is streamed with iterparse and each paragraph is
+    cleared once read. DOCX has no fixed layout, so pages are split at
+    explicit page breaks and at the page breaks Word recorded when the
+    file was last saved (``lastRenderedPageBreak``).
+
+    Yields:
+        Dicts with page, text and success
+    """
+    try:
+        archive = zipfile.ZipFile(path)
+    except (zipfile.BadZipFile, OSError) as e:
+        raise ExtractionError(f'Could not read DOCX: {e}')
+
+    with archive:
+        try:
+            stream = archive.open('word/document.xml')
+        except KeyError:
+            raise ExtractionError('Could not read DOCX: word/document.xml is missing')
+
+        with stream:
+            number = 1
+            lines = []
+            runs = []
+            try:
+                for _, elem in ET.iterparse(stream, events=('end',)):
+                    tag = elem.tag
+                    if tag == WORD_NS + 't':
+                        runs.append(elem.text or '')
+                    elif tag == WORD_NS + 'tab':
+                        runs.append('\t')
+                    elif tag == WORD_NS + 'br' and elem.get(WORD_NS + 'type') != 'page':
+                        runs.append('\n')
+                    elif tag == WORD_NS + 'p':
+                        lines.append(''.join(runs))
+                        runs = []
+                        elem.clear()
+                    elif tag in (WORD_NS + 'br', WORD_NS + 'lastRenderedPageBreak'):
+                        # Explicit and rendered breaks often coincide; skip empty pages
+                        if any(line.strip() for line in lines) or ''.join(runs).strip():
+                            lines.append(''.join(runs))
+                            runs = []
+                            yield {'page': number, 'success': True, 'text': '\n'.join(lines).strip()}
+                            number += 1
+                            lines = []
+            except ET.ParseError as e:
+                raise ExtractionError(f'Could not read DOCX: {e}')
+
+            lines.append(''.join(runs))
+            text = '\n'.join(lines).strip()
+            if text or number == 1:
+                yield {'page': number, 'success': True, 'text': text}
@@ -1,30 +1,204 @@
+import base64
 import json
 import os
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 import uuid
-from typing import Dict, List, Any
+from typing import Dict, Iterable, List, Any, Optional
+from storage import DocumentStore, create_document_store, SORT_FIELDS
+from search_index import SearchIndex
+from cache import LRUCache
+from locking import file_lock
+from document_extractors import iter_pdf_pages, iter_docx_pages
+from summarizer import DocumentSummarizer, SUMMARY_MODES, CORPUS_MODES
+from text_analysis import AnalyzedText, ANALYSIS_VERSION
+
+# Fields returned by the document listing when no projection is requested
+LIST_FIELDS = ('id', 'filename', 'created_at', 'text_length', 'pages')
+# Internal fields never exposed through the listing
+HIDDEN_FIELDS = ('file_path', 'content', 'content_hash')
+# Summaries are cached per bucket (smallest bucket >= max_length) and trimmed
+# to the requested length; DEFAULT_SUMMARY_LENGTH's bucket is filled at ingest
+SUMMARY_BUCKETS = (250, 500, 1000, 2000)
+DEFAULT_SUMMARY_LENGTH = 500
+KEY_POINTS = 5
+# Bump when keyword/entity extraction changes; stored metadata with another
+# version (or computed from another ANALYSIS_VERSION) is recomputed on read
+# or by `flask --app app recompute-metadata`
+METADATA_VERSION = 1
+KEYWORD_COUNT = 10
+# Derived keys nothing reads any more, dropped on startup: summaries stored
+# before modes existed ('summary:500', 'key_points') and uncompressed
+# analyses, now kept as an attachment
+LEGACY_DERIVED_KEYS = ('summary:[0-9]*', 'key_points', 'analysis')
+
+
+def summary_key(mode: str, bucket: int) -> str:
+    """Derived-value key of a document's summary for one mode and length bucket"""
+    return f'summary:{mode}:{bucket}'
+
+
+def key_points_key(mode: str) -> str:
+    """Derived-value key of a document's key points for one mode"""
+    return f'key_points:{mode}'
+
+
+def encode_cursor(sort: str, descending: bool, doc: Dict[str, Any]) -> str:
+    """Opaque cursor pointing after ``doc`` in a listing"""
+    payload = json.dumps([sort, descending, doc.get(sort), doc['id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: str, descending: bool):
+    """``(sort value, id)`` from a cursor; raises ValueError if invalid or from another ordering"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, cursor_desc, value, doc_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if cursor_sort != sort or cursor_desc != descending:
+        raise ValueError('Cursor belongs to a different sort order')
+    return value, doc_id
+
+
+def summary_bucket(max_length: int) -> int:
+    """Smallest summary bucket holding ``max_length`` characters"""
+    for bucket in SUMMARY_BUCKETS:
+        if max_length <= bucket:
+            return bucket
+    return max_length
+
 
 class DocumentProcessor:
     """Handle document processing and storage"""
     
-    def __init__(self):
+    def __init__(self, store: Optional[DocumentStore] = None, index: Optional[SearchIndex] = None,
+                 ocr=None, summarizer: Optional[DocumentSummarizer] = None):
         self.storage_file = 'documents.json'
-        self.documents = self._load_documents()
+        # Optional OCRProcessor for image-only PDF pages
+        self.ocr = ocr
+        self.precompute_summaries = os.getenv('PRECOMPUTE_SUMMARIES', 'true').lower() == 'true'
+        self.store = store or create_document_store(legacy_json=self.storage_file)
+        self.index = index or SearchIndex()
+        self.summarizer = summarizer or DocumentSummarizer(self.index)
+        # Build the index for stores that predate it, or repair it after a
+        # write that reached the store but not the index; the exclusive lock
+        # waits for writes in flight in other processes
+        with file_lock(self.index.path):
+            if self.index.needs_rebuild():
+                self.index.rebuild(self.store.iter_documents())
+        self.store.delete_derived(list(LEGACY_DERIVED_KEYS))
+        # Metadata stays resident; bodies are loaded on demand through the cache
+        self._lock = threading.RLock()
+        self._change_seq = self.store.change_seq()
+        self.metadata = {doc['id']: doc for doc in self.store.list_metadata()}
+        self.content_cache = LRUCache(int(os.getenv('DOCUMENT_CACHE_BYTES', 64 * 1024 * 1024)))
+    
+    def sync(self):
+        """Apply writes made by other worker processes since the last call"""
+        with self._lock:
+            changes = self.store.changes_since(self._change_seq)
+            if changes is None:
+                self._change_seq = self.store.change_seq()
+                self.metadata = {doc['id']: doc for doc in self.store.list_metadata()}
+                self.content_cache.clear()
+                return
+            self._change_seq, events = changes
+            for doc_id, op in events:
+                self.content_cache.invalidate(doc_id)
+                meta = self.store.get_metadata(doc_id) if op == 'put' else None
+                if meta:
+                    self.metadata[doc_id] = meta
+                else:
+                    self.metadata.pop(doc_id, None)
+    
+    @contextmanager
+    def _indexed_write(self):
+        """
+        Bracket a store write and its index update with the index's pending marker
+        
+        If the block raises (or the process dies) the marker stays set and
+        the next startup rebuilds the index from the store.
+        """
+        with file_lock(self.index.path, shared=True):
+            self.index.begin_write()
+            yield
+            self.index.end_write()
     
-    def _load_documents(self) -> Dict:
-        """Load documents from JSON storage"""
-        if os.path.exists(self.storage_file):
-            with open(self.storage_file, 'r') as f:
-                return json.load(f)
-        return {}
+    def store_documents(self, docs: List[Dict[str, Any]]):
+        """Persist docs in one storage commit and index them in one pass"""
+        if not docs:
+            return
+        # Tokenize each body once; the index, summaries and keywords share it
+        analyses = {doc_data['id']: AnalyzedText.analyze(doc_data['content']) for doc_data in docs}
+        with self._indexed_write():
+            self.store.put_many(docs)
+            self.index.add_documents(docs, analyses)
+        with self._lock:
+            for doc_data in docs:
+                self.metadata[doc_data['id']] = {k: v for k, v in doc_data.items() if k != 'content'}
+        for doc_data in docs:
+            self.content_cache.put(doc_data['id'], doc_data['content'])
+        self.store.put_attachments([
+            (doc_id, 'analysis', analysis.to_bytes()) for doc_id, analysis in analyses.items()
+        ])
+        derived = [
+            (doc_data['id'], 'metadata', self._compute_metadata(doc_data['content'], analyses[doc_data['id']]))
+            for doc_data in docs
+        ]
+        if self.precompute_summaries:
+            bucket = summary_bucket(DEFAULT_SUMMARY_LENGTH)
+            for doc_data in docs:
+                derived.extend(self._summary_entries(doc_data['id'], doc_data['content'], bucket,
+                                                     analysis=analyses[doc_data['id']]))
+        self.store.put_derived(derived)
     
-    def _save_documents(self):
-        """Save documents to JSON storage"""
-        with open(self.storage_file, 'w') as f:
-            json.dump(self.documents, f, indent=2)
+    def get_analysis(self, doc_id: str, content: Optional[str] = None) -> Optional[AnalyzedText]:
+        """
+        Stored tokenization of a document
+        
+        Kept compressed as the document's 'analysis' attachment. Documents
+        stored before analyses existed (or with an older ANALYSIS_VERSION)
+        are analysed now and the result is stored.
+        """
+        analysis = AnalyzedText.from_bytes(self.store.get_attachment(doc_id, 'analysis'))
+        if analysis is not None:
+            return analysis
+        if content is None:
+            doc = self.get_document(doc_id)
+            if not doc:
+                return None
+            content = doc['content']
+        analysis = AnalyzedText.analyze(content)
+        self.store.put_attachments([(doc_id, 'analysis', analysis.to_bytes())])
+        return analysis
     
     def process(self, filepath: str, filename: str) -> Dict[str, Any]:
         """Process and store a document"""
+        doc_data = self.build_document(filepath, filename)
+        self.store_documents([doc_data])
+        return doc_data
+    
+    def process_ocr_result(self, filepath: str, filename: str, ocr_result: Dict[str, Any]) -> Dict[str, Any]:
+        """Process and store OCR extraction result"""
+        doc_data = self.build_ocr_document(filepath, filename, ocr_result)
+        self.store_documents([doc_data])
+        return doc_data
+    
+    def build_document(self, filepath: str, filename: str) -> Dict[str, Any]:
+        """
+        Extract a document record from a file without storing it
+        
+        PDF and DOCX files are read page by page (raises ExtractionError if
+        they cannot be parsed); anything else is read as text.
+        """
+        file_ext = filename.rsplit('.', 1)[-1].lower()
+        if file_ext == 'pdf':
+            return self.build_paged_document(filepath, filename, iter_pdf_pages(filepath, self.ocr), 'pdf')
+        if file_ext == 'docx':
+            return self.build_paged_document(filepath, filename, iter_docx_pages(filepath), 'docx')
+        
         doc_id = str(uuid.uuid4())[:8]
         
         # Read document content
@@ -47,13 +221,10 @@ class DocumentProcessor:
             'file_path': filepath
         }
         
-        self.documents[doc_id] = doc_data
-        self._save_documents()
-        
         return doc_data
     
-    def process_ocr_result(self, filepath: str, filename: str, ocr_result: Dict[str, Any]) -> Dict[str, Any]:
-        """Process and store OCR extraction result"""
+    def build_ocr_document(self, filepath: str, filename: str, ocr_result: Dict[str, Any]) -> Dict[str, Any]:
+        """Build a document record from an OCR result without storing it"""
         doc_id = str(uuid.uuid4())[:8]
         
         # Use OCR extracted text
@@ -66,24 +237,90 @@ class DocumentProcessor:
             'filename': filename,
             'content': content,
             'created_at': datetime.now().isoformat(),
-            'pages': max(1, len(content) // 3000),  # Rough estimate
+            'pages': ocr_result.get('page_count', 1),
             'text_length': len(content),
             'file_path': filepath,
             'source_type': 'ocr_image',
             'ocr_confidence': confidence
         }
         
-        self.documents[doc_id] = doc_data
-        self._save_documents()
+        return doc_data
+    
+    def build_paged_document(self, filepath: str, filename: str, pages: Iterable[Dict[str, Any]],
+                             source_type: str = 'ocr_image') -> Dict[str, Any]:
+        """
+        Build a document record from page results as they are produced
+        
+        Pages are consumed one at a time (e.g. from OCRProcessor.iter_pages),
+        so only page text is held, never page images. Pages are separated by
+        a blank line and ``page_offsets`` records where each one starts.
+        
+        Args:
+            filepath: Path of the source file
+            filename: Original filename
+            pages: Iterable of dicts with 'text' and optionally 'success',
+                'confidence' and 'word_count'
+            source_type: Stored as the document's source_type
+        """
+        texts = []
+        offsets = []
+        failed = []
+        position = 0
+        weighted_confidence = 0.0
+        confident_words = 0
+        
+        for number, page in enumerate(pages, 1):
+            text = page.get('text', '') if page.get('success', True) else ''
+            if not page.get('success', True):
+                failed.append(page.get('page', number))
+            if texts:
+                position += 2  # Blank line between pages
+            offsets.append(position)
+            texts.append(text)
+            position += len(text)
+            if 'confidence' in page and page.get('success', True):
+                words = page.get('word_count', len(text.split()))
+                weighted_confidence += page['confidence'] * words
+                confident_words += words
+        
+        content = '\n\n'.join(texts)
+        doc_data = {
+            'id': str(uuid.uuid4())[:8],
+            'filename': filename,
+            'content': content,
+            'created_at': datetime.now().isoformat(),
+            'pages': len(texts),
+            'text_length': len(content),
+            'file_path': filepath,
+            'source_type': source_type,
+            'page_offsets': offsets
+        }
+        if confident_words:
+            doc_data['ocr_confidence'] = round(weighted_confidence / confident_words, 2)
+        if failed:
+            doc_data['failed_pages'] = failed
         
         return doc_data
     
     def get_document(self, doc_id: str) -> Dict[str, Any]:
         """Retrieve a document"""
-        return self.documents.get(doc_id)
+        self.sync()
+        meta = self.metadata.get(doc_id)
+        if not meta:
+            return None
+        content = self.content_cache.get(doc_id)
+        if content is None:
+            content = self.store.get_content(doc_id)
+            if content is None:
+                return None
+            self.content_cache.put(doc_id, content)
+        return {**meta, 'content': content}
     
     def list_documents(self) -> List[Dict[str, Any]]:
         """List all documents"""
+        self.sync()
+        with self._lock:
+            documents = list(self.metadata.values())
         return [
             {
                 'id': doc['id'],
@@ -92,51 +329,219 @@ class DocumentProcessor:
                 'text_length': doc['text_length'],
                 'pages': doc['pages']
             }
-            for doc in self.documents.values()
+            for doc in documents
         ]
     
+    def page_documents(self, limit: int = 50, cursor: Optional[str] = None, sort: str = 'created_at',
+                       descending: bool = False, filters: Optional[Dict[str, Any]] = None,
+                       fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """
+        One page of the document listing, read from the store's sorted index
+        
+        Args:
+            limit: Page size
+            cursor: ``next_cursor`` of the previous page
+            sort: One of SORT_FIELDS
+            descending: Newest/largest/last first
+            filters: filename / min_length / max_length, as in advanced_search
+            fields: Metadata fields to return (``id`` is always included)
+        
+        Returns:
+            documents, next_cursor (None on the last page) and total matching
+        
+        Raises:
+            ValueError: for an unknown sort key or an invalid cursor
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f'sort must be one of {", ".join(SORT_FIELDS)}')
+        after = decode_cursor(cursor, sort, descending) if cursor else None
+        # One extra row tells whether another page follows
+        docs = self.store.page_metadata(sort, descending, after, limit + 1, filters)
+        next_cursor = encode_cursor(sort, descending, docs[limit - 1]) if len(docs) > limit else None
+        fields = [name for name in (fields or LIST_FIELDS) if name not in HIDDEN_FIELDS]
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+        return {
+            'documents': [{name: doc[name] for name in fields if name in doc} for doc in docs[:limit]],
+            'next_cursor': next_cursor,
+            'total': self.store.count_matching(filters)
+        }
+    
+    def _summary_stamp(self, mode: str) -> Dict[str, Any]:
+        """What a stored summary/key points record depends on besides the body"""
+        # Every mode reads the stored tokenization; corpus-weighted modes are
+        # also only valid for the index generation they saw
+        return {'analysis': ANALYSIS_VERSION,
+                'corpus': self.index.generation() if mode in CORPUS_MODES else None}
+    
+    @staticmethod
+    def _fresh(record: Any, stamp: Dict[str, Any], field: str) -> Optional[Any]:
+        """``record[field]`` if the stored record matches ``stamp``, else None"""
+        if not isinstance(record, dict) or any(record.get(k) != v for k, v in stamp.items()):
+            return None
+        return record.get(field)
+    
+    def _summary_entries(self, doc_id: str, content: str, bucket: int, mode: str = 'frequency',
+                         analysis: Optional[AnalyzedText] = None,
+                         stamp: Optional[Dict[str, Any]] = None) -> List[tuple]:
+        """Derived-value entries for a document's bucket summary and key points"""
+        analysis = analysis or self.get_analysis(doc_id, content)
+        stamp = stamp if stamp is not None else self._summary_stamp(mode)
+        entries = [(doc_id, key_points_key(mode),
+                    {**stamp, 'key_points': self.summarizer.extract_key_points(content, KEY_POINTS, mode, analysis)})]
+        if len(content) > bucket:
+            entries.append((doc_id, summary_key(mode, bucket),
+                            {**stamp, 'summary': self.summarizer.summarize(content, bucket, mode, analysis)}))
+        return entries
+    
+    def summarize_document(self, doc_id: str, max_length: int = DEFAULT_SUMMARY_LENGTH,
+                           mode: str = 'frequency') -> Optional[Dict[str, Any]]:
+        """
+        Summary and key points of a document, computed once and stored with it
+        
+        Documents never change after upload, so the summary for each mode
+        and length bucket is kept in the store (dropped on delete) and
+        trimmed to ``max_length`` on the way out. Documents no longer than
+        the bucket are summarized directly. TF-IDF and TextRank results
+        record the index generation they were computed at and are
+        recomputed once the corpus has changed.
+        
+        Returns:
+            summary, key_points and original_length, or None if the document is missing
+        
+        Raises:
+            ValueError: for a mode not in SUMMARY_MODES
+            SummaryModeUnavailable: if the mode cannot handle this document here
+        """
+        if mode not in SUMMARY_MODES:
+            raise ValueError(f'mode must be one of {", ".join(SUMMARY_MODES)}')
+        self.sync()
+        meta = self.metadata.get(doc_id)
+        if not meta:
+            return None
+        bucket = summary_bucket(max_length)
+        stamp = self._summary_stamp(mode)
+        summary = None
+        if meta['text_length'] > bucket:
+            summary = self._fresh(self.store.get_derived(doc_id, summary_key(mode, bucket)), stamp, 'summary')
+        key_points = self._fresh(self.store.get_derived(doc_id, key_points_key(mode)), stamp, 'key_points')
+        
+        if summary is None or key_points is None:
+            doc = self.get_document(doc_id)
+            if not doc:
+                return None
+            content = doc['content']
+            if len(content) <= bucket:
+                # Short documents are cheap to summarize and are not cached
+                summary = self.summarizer.summarize(content, max_length, mode)
+            if summary is None or key_points is None:
+                entries = self._summary_entries(doc_id, content, bucket, mode, stamp=stamp)
+                self.store.put_derived(entries)
+                derived = {key: value for _, key, value in entries}
+                key_points = derived[key_points_key(mode)]['key_points']
+                if summary_key(mode, bucket) in derived:
+                    summary = derived[summary_key(mode, bucket)]['summary']
+        
+        if len(summary) > max_length:
+            summary = summary[:max_length] + '...'
+        return {'summary': summary, 'key_points': key_points, 'original_length': meta['text_length']}
+    
+    def storage_stats(self) -> Optional[Dict[str, Any]]:
+        """Body blob codec, sizes and compression ratio (None if bodies are stored inline)"""
+        blobs = getattr(self.store, 'blobs', None)
+        return blobs.stats() if blobs else None
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """Content cache counters, for sizing DOCUMENT_CACHE_BYTES"""
+        return self.content_cache.stats()
+    
     def delete_document(self, doc_id: str) -> bool:
         """Delete a document"""
-        if doc_id in self.documents:
-            file_path = self.documents[doc_id].get('file_path')
+        self.sync()
+        doc = self.metadata.get(doc_id)
+        if doc:
+            file_path = doc.get('file_path')
             if file_path and os.path.exists(file_path):
                 os.remove(file_path)
-            del self.documents[doc_id]
-            self._save_documents()
+            with self._indexed_write():
+                self.store.delete(doc_id)
+                self.index.remove_document(doc_id)
+            with self._lock:
+                self.metadata.pop(doc_id, None)
+            self.content_cache.invalidate(doc_id)
             return True
         return False
     
-    def extract_metadata(self, doc_id: str) -> Dict[str, Any]:
-        """Extract metadata from document"""
-        doc = self.get_document(doc_id)
-        if not doc:
-            return {}
-        
-        content = doc['content']
-        
-        # Simple keyword extraction
-        keywords = self._extract_keywords(content)
-        
+    def _compute_metadata(self, content: str, analysis: AnalyzedText) -> Dict[str, Any]:
+        """Word counts, keywords and entities of a body, tagged with the versions they come from"""
         return {
+            'version': METADATA_VERSION,
+            'analysis': ANALYSIS_VERSION,
             'word_count': len(content.split()),
             'character_count': len(content),
-            'keywords': keywords,
+            'keywords': self._extract_keywords(content, KEYWORD_COUNT, analysis),
             'entities': self._extract_entities(content)
         }
     
-    def _extract_keywords(self, text: str, top_n: int = 10) -> List[str]:
-        """Extract top keywords from text"""
-        words = text.lower().split()
-        # Filter common words
-        stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'is', 'are', 'was', 'were', 'be', 'been', 'being'}
+    @staticmethod
+    def _metadata_current(stored: Any) -> bool:
+        """Whether stored metadata matches METADATA_VERSION and ANALYSIS_VERSION"""
+        return (isinstance(stored, dict) and stored.get('version') == METADATA_VERSION
+                and stored.get('analysis') == ANALYSIS_VERSION)
+    
+    def _stored_metadata(self, doc_id: str, recompute: bool = False) -> Optional[Dict[str, Any]]:
+        """Extracted metadata kept with the document, recomputed when missing or outdated"""
+        stored = None if recompute else self.store.get_derived(doc_id, 'metadata')
+        if self._metadata_current(stored):
+            return stored
+        doc = self.get_document(doc_id)
+        if not doc:
+            return None
+        stored = self._compute_metadata(doc['content'], self.get_analysis(doc_id, doc['content']))
+        self.store.put_derived([(doc_id, 'metadata', stored)])
+        return stored
+    
+    def extract_metadata(self, doc_id: str) -> Dict[str, Any]:
+        """
+        Extract metadata from document
         
-        filtered = [w.strip('.,;:!?"\'') for w in words if w.lower() not in stop_words and len(w) > 3]
+        Extraction runs once at ingest; this returns the stored result.
+        """
+        self.sync()
+        if doc_id not in self.metadata:
+            return {}
+        stored = self._stored_metadata(doc_id)
+        if not stored:
+            return {}
+        return {k: v for k, v in stored.items() if k not in ('version', 'analysis')}
+    
+    def recompute_metadata(self, recompute_all: bool = False) -> int:
+        """
+        Re-run metadata extraction for documents stored with an older
+        METADATA_VERSION or ANALYSIS_VERSION
         
-        # Count frequency
-        from collections import Counter
-        freq = Counter(filtered)
+        Args:
+            recompute_all: Recompute every document, whatever its version
         
-        return [word for word, _ in freq.most_common(top_n)]
+        Returns:
+            Number of documents recomputed
+        """
+        self.sync()
+        with self._lock:
+            doc_ids = list(self.metadata)
+        recomputed = 0
+        for doc_id in doc_ids:
+            stored = self.store.get_derived(doc_id, 'metadata')
+            if recompute_all or not self._metadata_current(stored):
+                if self._stored_metadata(doc_id, recompute=True):
+                    recomputed += 1
+        return recomputed
+    
+    def _extract_keywords(self, text: str, top_n: int = 10,
+                          analysis: Optional[AnalyzedText] = None) -> List[str]:
+        """Extract top keywords (most frequent content words) from text"""
+        analysis = analysis or AnalyzedText.analyze(text)
+        return [word for word, _ in analysis.term_counts().most_common(top_n)]
     
     def _extract_entities(self, text: str) -> Dict[str, List[str]]:
         """Extract named entities from text"""
@@ -174,15 +579,16 @@ class DocumentProcessor:
         
         all_keywords = []
         
+        self.sync()
         for doc_id in doc_ids:
-            doc = self.get_document(doc_id)
-            if doc:
-                insights['combined_word_count'] += len(doc['content'].split())
-                metadata = self.extract_metadata(doc_id)
+            meta = self.metadata.get(doc_id)
+            metadata = self._stored_metadata(doc_id) if meta else None
+            if metadata:
+                insights['combined_word_count'] += metadata['word_count']
                 all_keywords.extend(metadata.get('keywords', []))
                 insights['document_summary'].append({
                     'id': doc_id,
-                    'filename': doc['filename'],
+                    'filename': meta['filename'],
                     'word_count': metadata['word_count']
                 })
         
@@ -0,0 +1,199 @@
+"""Bounded background job queue with persisted job status"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, Any, Callable, Optional
+
+from storage import open_sqlite
+
+logger = logging.getLogger(__name__)
+# Distinguishes this process from an earlier one that had the same pid
+PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+
+def _pid_alive(pid: int) -> bool:
+    """True if a process with ``pid`` exists on this host"""
+    if os.name == 'nt':
+        return True  # os.kill would terminate it; only same-pid restarts are detected
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue cannot accept more work"""
+
+
+class JobQueue:
+    """
+    Run callables on a fixed pool of worker threads
+
+    At most ``max_pending`` jobs wait in the queue; beyond that ``submit``
+    raises QueueFullError so callers can apply back-pressure. Job status is
+    stored in SQLite so any worker process can report on any job.
+
+    The queue itself lives in memory, so each job records the process that
+    accepted it; on startup, queued or running jobs whose process is gone
+    are marked failed instead of being polled forever.
+
+    Job functions receive a ``report(progress, message)`` callback as their
+    first argument and return a JSON-serialisable result.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            owner TEXT,
+            status TEXT NOT NULL,
+            progress INTEGER NOT NULL DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            worker TEXT
+        )
+    """
+
+    def __init__(self, path: Optional[str] = None, max_workers: Optional[int] = None,
+                 max_pending: Optional[int] = None):
+        self.path = path or os.getenv('JOBS_DB_PATH', 'jobs.db')
+        self.max_workers = max_workers or int(os.getenv('UPLOAD_WORKERS', 2))
+        self.max_pending = max_pending or int(os.getenv('UPLOAD_QUEUE_SIZE', 32))
+        self._queue: 'queue.Queue' = queue.Queue(maxsize=self.max_pending)
+        self._local = threading.local()
+        self._workers = []
+        self._start_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(self.SCHEMA)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'worker' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN worker TEXT')
+        self._fail_orphans()
+
+    @staticmethod
+    def _worker_id() -> str:
+        return f'{os.getpid()}:{PROCESS_TOKEN}'
+
+    def _fail_orphans(self):
+        """Mark unfinished jobs of processes that no longer exist as failed"""
+        pid, token = os.getpid(), PROCESS_TOKEN
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, worker FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchall()
+            orphans = []
+            for row in rows:
+                owner_pid, _, owner_token = (row['worker'] or '').partition(':')
+                if not owner_pid.isdigit():
+                    orphans.append(row['id'])  # Written before workers were recorded
+                elif int(owner_pid) == pid:
+                    if owner_token != token:
+                        orphans.append(row['id'])  # An earlier process with our pid
+                elif not _pid_alive(int(owner_pid)):
+                    orphans.append(row['id'])
+            conn.executemany(
+                "UPDATE jobs SET status = 'failed', message = 'Failed', updated_at = ?, "
+                "error = 'Worker restarted before the job finished; upload again' WHERE id = ?",
+                [(datetime.now().isoformat(), job_id) for job_id in orphans]
+            )
+        if orphans:
+            logger.warning('Marked %d interrupted jobs as failed', len(orphans))
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = open_sqlite(self.path)
+        return conn
+
+    def _ensure_workers(self):
+        """Start worker threads on first use (after any fork by the server)"""
+        with self._start_lock:
+            if self._workers:
+                return
+            for i in range(self.max_workers):
+                worker = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _update(self, job_id: str, **fields):
+        fields['updated_at'] = datetime.now().isoformat()
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as conn:
+            conn.execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+    def submit(self, kind: str, fn: Callable, *args, owner: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        """
+        Queue a job
+
+        Returns:
+            The new job record
+
+        Raises:
+            QueueFullError: if ``max_pending`` jobs are already waiting
+        """
+        self._ensure_workers()
+        job_id = uuid.uuid4().hex[:12]
+        now = datetime.now().isoformat()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, kind, owner, status, progress, message, created_at, updated_at, worker) '
+                'VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?)',
+                (job_id, kind, owner, 'queued', 'Waiting for a worker', now, now, self._worker_id())
+            )
+        # Read back before queueing so the caller always sees the queued record
+        job = self.get(job_id)
+        try:
+            self._queue.put_nowait((job_id, fn, args, kwargs))
+        except queue.Full:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            raise QueueFullError(f'{self.max_pending} jobs already queued')
+        return job
+
+    def _run(self):
+        while True:
+            job_id, fn, args, kwargs = self._queue.get()
+            try:
+                self._update(job_id, status='running', message='Processing')
+
+                def report(progress: int, message: str = None):
+                    self._update(job_id, progress=int(progress), message=message)
+
+                result = fn(report, *args, **kwargs)
+                self._update(job_id, status='succeeded', progress=100, message='Done',
+                             result=json.dumps(result))
+            except Exception as e:
+                logger.exception('Job %s failed', job_id)
+                details = getattr(e, 'details', None)
+                self._update(job_id, status='failed', message='Failed', error=str(e),
+                             result=json.dumps({'details': details}) if details else None)
+            finally:
+                self._queue.task_done()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Job record with decoded result, or None"""
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and limits for this process"""
+        return {
+            'workers': self.max_workers,
+            'queued': self._queue.qsize(),
+            'max_pending': self.max_pending
+        }
@@ -0,0 +1,95 @@
+"""Cross-process file locking and atomic JSON writes"""
+
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# flock() is per open file description, so threads of one process also
+# need an in-process lock per path
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+# Paths whose file lock the current thread already holds (re-entrancy)
+_held = threading.local()
+
+
+def _thread_lock(path: str) -> threading.RLock:
+    with _thread_locks_guard:
+        return _thread_locks.setdefault(os.path.abspath(path), threading.RLock())
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False):
+    """
+    Hold an advisory lock on ``<path>.lock`` for the duration of the block
+
+    Re-entrant within a thread: a nested call while the lock is held
+    (in either mode) is a no-op.
+
+    Args:
+        path: File being protected
+        shared: Take a shared (reader) lock instead of an exclusive one;
+            Windows only supports exclusive locks
+    """
+    key = os.path.abspath(path)
+    held = _held.__dict__.setdefault('paths', set())
+    if key in held:
+        yield
+        return
+    with _thread_lock(path):
+        held.add(key)
+        try:
+            with open(path + '.lock', 'a+') as handle:
+                if fcntl:
+                    fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                else:
+                    handle.seek(0)
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(handle, fcntl.LOCK_UN)
+                    else:
+                        handle.seek(0)
+                        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            held.discard(key)
+
+
+def atomic_write_json(path: str, data: Any, **dump_kwargs):
+    """Write JSON to a temp file and rename it over ``path`` so readers never see a partial file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_signature(path: str):
+    """
+    (inode, mtime_ns, size) used to detect changes made by other processes
+
+    atomic_write_json replaces the file, so the inode changes on every
+    write even when mtime (coarse on some filesystems) and size do not.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,132 @@
+"""On-disk cache of OCR results keyed by image content and OCR settings"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Any, Optional
+
+from locking import atomic_write_json
+
+
+class OCRResultCache:
+    """
+    Store OCR results as JSON files named by a content hash
+
+    The key combines the SHA-256 of the image bytes with the preprocessing
+    settings, so the same scan uploaded again (by anyone, under any name)
+    skips OCR, while a change of settings misses. Reads refresh a file's
+    mtime; when the directory grows past ``max_bytes`` the least recently
+    used files are removed until it is back under 90% of the budget.
+    Size and entry count are scanned once per process and then kept up to
+    date by ``put`` and eviction, so ``stats`` does not walk the directory.
+
+    Args:
+        directory: Cache directory (OCR_CACHE_DIR, default ``ocr_cache``)
+        max_bytes: Size budget (OCR_CACHE_BYTES, default 256MB)
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.directory = directory or os.getenv('OCR_CACHE_DIR', 'ocr_cache')
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('OCR_CACHE_BYTES', 256 * 1024 * 1024))
+        self._lock = threading.Lock()
+        # Estimated directory size and file count, scanned on first use
+        self._bytes = None
+        self._entries = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(image_hash: str, settings: Dict[str, Any]) -> str:
+        """Cache key for an image hash and the OCR settings applied to it"""
+        encoded = json.dumps(settings, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(f'{image_hash}:{encoded}'.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Cached result, or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]):
+        """Store a result and evict old entries if over budget"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            self._ensure_counted()
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = None
+            atomic_write_json(path, result)
+            self._bytes += os.path.getsize(path) - (replaced or 0)
+            if replaced is None:
+                self._entries += 1
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _ensure_counted(self):
+        """Scan the directory once; the caller holds the lock"""
+        if self._bytes is None:
+            entries, self._bytes = self._scan()
+            self._entries = len(entries)
+
+    def _scan(self):
+        """(files as (mtime, size, path), total bytes) for the cache directory"""
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # Evicted by another process
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries, sum(entry[1] for entry in entries)
+
+    def _evict(self):
+        entries, total = self._scan()
+        remaining = len(entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            remaining -= 1
+            self.evictions += 1
+        self._bytes = total
+        self._entries = remaining
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters and current disk usage"""
+        with self._lock:
+            self._ensure_counted()
+            lookups = self.hits + self.misses
+            return {
+                'entries': self._entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
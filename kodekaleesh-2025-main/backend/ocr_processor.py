@@ -1,7 +1,15 @@
 """OCR module for extracting text from images"""
 
+import logging
 import os
-from typing import Dict, Any
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+from blockchain import SimpleChain
+from ocr_cache import OCRResultCache
 
 # Try to import OCR dependencies - graceful fallback if not available
 TESSERACT_AVAILABLE = False
@@ -13,14 +21,130 @@ except (ImportError, ValueError):
     # ValueError catches numpy compatibility issues
     pass
 
+# Optional in-process engine (tesserocr C-API binding): keeps language data
+# loaded and takes images in memory instead of forking tesseract per call
+TESSEROCR_AVAILABLE = False
+try:
+    import tesserocr
+    from PIL import Image
+    TESSEROCR_AVAILABLE = True
+except (ImportError, ValueError):
+    pass
+
+logger = logging.getLogger(__name__)
+
+TSV_COLUMNS = ('level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num',
+               'left', 'top', 'width', 'height', 'conf', 'text')
+
+
+def tsv_to_dict(tsv: str) -> Dict[str, list]:
+    """Convert tesseract TSV output into the column dict returned by image_to_data"""
+    data = {column: [] for column in TSV_COLUMNS}
+    for row in tsv.splitlines():
+        values = row.split('\t')
+        if len(values) < len(TSV_COLUMNS) - 1 or values[0] == 'level':
+            continue
+        values += [''] * (len(TSV_COLUMNS) - len(values))
+        for column, value in zip(TSV_COLUMNS, values):
+            data[column].append(value)
+    return data
+
+
+class TesseractEnginePool:
+    """
+    Warm tesserocr engines shared by the threads of one process
+    
+    Engines are created on demand up to ``size`` and reused; each is used
+    by one thread at a time. A forked child starts with a fresh pool.
+    """
+    
+    def __init__(self, size: Optional[int] = None, lang: str = 'eng'):
+        self.size = size or int(os.getenv('OCR_ENGINE_POOL_SIZE', os.cpu_count() or 1))
+        self.lang = lang
+        self._lock = threading.Lock()
+        self._reset()
+    
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle: 'queue.LifoQueue' = queue.LifoQueue()
+        self._created = 0
+    
+    @contextmanager
+    def engine(self):
+        """Borrow an idle engine, creating one if the pool is not full"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            idle = self._idle
+            create = idle.empty() and self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                api = tesserocr.PyTessBaseAPI(lang=self.lang)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        else:
+            api = idle.get()
+        try:
+            yield api
+        finally:
+            api.Clear()
+            idle.put(api)
+    
+    def recognize(self, image, timeout: Optional[float] = None) -> Dict[str, list]:
+        """OCR a PIL image in memory; returns image_to_data style columns"""
+        with self.engine() as api:
+            api.SetImage(image)
+            if not api.Recognize(int((timeout or 0) * 1000)):
+                raise TimeoutError('Tesseract process timeout')
+            return tsv_to_dict(api.GetTSVText(0))
+
+
+_engine_pool: Optional[TesseractEnginePool] = None
+_engine_pool_lock = threading.Lock()
+
+
+def get_engine_pool() -> Optional[TesseractEnginePool]:
+    """Process-wide engine pool, or None when tesserocr is unavailable or disabled"""
+    global _engine_pool
+    if not TESSEROCR_AVAILABLE or os.getenv('OCR_ENGINE', 'auto') == 'pytesseract':
+        return None
+    with _engine_pool_lock:
+        if _engine_pool is None:
+            _engine_pool = TesseractEnginePool()
+        return _engine_pool
+
 
 class OCRProcessor:
     """Process images and extract text using OCR"""
     
     SUPPORTED_FORMATS = {'jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff'}
+    LANGUAGE = 'eng'
+    # Settings for extract_text_with_preprocessing (part of the cache key)
+    PREPROCESSING = {
+        'contrast': 1.5,
+        'brightness': 1.1,
+        'sharpness': 2.0,
+        'median_filter': 3,
+        'binarize': os.getenv('OCR_BINARIZE', 'false').lower() == 'true',
+        'target_dpi': int(os.getenv('OCR_TARGET_DPI', 300))
+    }
+    # Retry settings for pages whose first pass is below HEAVY_BELOW_CONFIDENCE
+    HEAVY_PREPROCESSING = dict(PREPROCESSING, contrast=2.0, brightness=1.0, sharpness=2.5,
+                               median_filter=5, binarize=True)
+    ADAPTIVE = os.getenv('OCR_ADAPTIVE', 'true').lower() == 'true'
+    HEAVY_BELOW_CONFIDENCE = float(os.getenv('OCR_HEAVY_BELOW_CONFIDENCE', 60))
     
-    def __init__(self):
-        self.available = TESSERACT_AVAILABLE
+    def __init__(self, cache: Optional[OCRResultCache] = None):
+        self.cache = cache if cache is not None else OCRResultCache()
+        if self.cache.max_bytes <= 0:
+            self.cache = None
+        self.engine_pool = get_engine_pool()
+        self.available = TESSERACT_AVAILABLE or self.engine_pool is not None
+        self._engine_version = None
         if TESSERACT_AVAILABLE:
             # Try to configure Tesseract path for Windows
             try:
@@ -32,12 +156,124 @@ class OCRProcessor:
         """Check if OCR is available"""
         return self.available
     
-    def extract_text(self, image_path: str) -> Dict[str, Any]:
+    def _recognize(self, image, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Run tesseract once and rebuild text, lines and word boxes from its TSV output"""
+        data = None
+        if self.engine_pool is not None:
+            try:
+                data = self.engine_pool.recognize(image, timeout)
+            except RuntimeError:
+                if not TESSERACT_AVAILABLE:
+                    raise
+                # Engine failed to initialise (e.g. missing tessdata): switch this
+                # processor to the CLI path so engine and cache keys say so
+                logger.warning('tesserocr engine failed; falling back to pytesseract', exc_info=True)
+                self.engine_pool = None
+                self._engine_version = None
+        if data is None:
+            data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT, timeout=timeout or 0)
+        return self.parse_tesseract_data(data)
+    
+    @property
+    def engine(self) -> str:
+        """OCR backend in use: 'tesserocr', 'pytesseract' or 'none'"""
+        if self.engine_pool is not None:
+            return 'tesserocr'
+        return 'pytesseract' if TESSERACT_AVAILABLE else 'none'
+    
+    @property
+    def engine_version(self) -> str:
+        """Tesseract version behind ``engine`` (part of the cache key), read once"""
+        if self._engine_version is None:
+            try:
+                if self.engine == 'tesserocr':
+                    version = tesserocr.tesseract_version().splitlines()[0]
+                elif self.engine == 'pytesseract':
+                    version = str(pytesseract.get_tesseract_version())
+                else:
+                    version = 'none'
+            except Exception:
+                version = 'unknown'
+            self._engine_version = version
+        return self._engine_version
+    
+    @staticmethod
+    def parse_tesseract_data(data: Dict[str, list]) -> Dict[str, Any]:
+        """
+        Rebuild OCR output from ``image_to_data`` columns
+        
+        Words are joined with spaces into lines, lines with newlines, and
+        paragraphs/blocks are separated by a blank line, matching the layout
+        of ``image_to_string``.
+        
+        Args:
+            data: pytesseract.Output.DICT result of image_to_data
+            
+        Returns:
+            Dictionary with text, lines, words (with boxes) and mean word confidence
+        """
+        lines = []
+        words = []
+        current_key = None
+        for i, word in enumerate(data.get('text', [])):
+            word = (word or '').strip()
+            # Level 5 rows are words; empty rows are layout containers
+            if int(data['level'][i]) != 5 or not word:
+                continue
+            conf = float(data['conf'][i])
+            box = {
+                'text': word,
+                'confidence': round(conf, 2),
+                'left': int(data['left'][i]),
+                'top': int(data['top'][i]),
+                'width': int(data['width'][i]),
+                'height': int(data['height'][i])
+            }
+            words.append(box)
+            
+            paragraph = (data['page_num'][i], data['block_num'][i], data['par_num'][i])
+            key = paragraph + (data['line_num'][i],)
+            if key != current_key:
+                lines.append({'paragraph': paragraph, 'text': word, 'words': 1,
+                              'left': box['left'], 'top': box['top'],
+                              'right': box['left'] + box['width'], 'bottom': box['top'] + box['height']})
+                current_key = key
+            else:
+                line = lines[-1]
+                line['text'] += ' ' + word
+                line['words'] += 1
+                line['left'] = min(line['left'], box['left'])
+                line['top'] = min(line['top'], box['top'])
+                line['right'] = max(line['right'], box['left'] + box['width'])
+                line['bottom'] = max(line['bottom'], box['top'] + box['height'])
+        
+        parts = []
+        for n, line in enumerate(lines):
+            if n and line['paragraph'] != lines[n - 1]['paragraph']:
+                parts.append('')
+            parts.append(line['text'])
+        
+        confidences = [word['confidence'] for word in words if word['confidence'] > 0]
+        average_confidence = sum(confidences) / len(confidences) if confidences else 0
+        
+        return {
+            'text': '\n'.join(parts),
+            'lines': [
+                {'text': line['text'], 'words': line['words'],
+                 'box': [line['left'], line['top'], line['right'], line['bottom']]}
+                for line in lines
+            ],
+            'words': words,
+            'confidence': round(average_confidence, 2)
+        }
+    
+    def extract_text(self, image_path: str, timeout: Optional[float] = None) -> Dict[str, Any]:
         """
         Extract text from image using Tesseract OCR
         
         Args:
-            image_path: Path to image file
+            image_path: Path to image file (every frame of a multi-page TIFF is read)
+            timeout: Seconds before the tesseract process is killed (None = no limit)
             
         Returns:
             Dictionary with extracted text, confidence, and metadata
@@ -49,43 +285,43 @@ class OCRProcessor:
                 'text': '',
                 'confidence': 0
             }
+        return self.combine_pages(self.iter_pages(image_path, preprocess=False, timeout=timeout))
+    
+    def extract_text_with_preprocessing(self, image_path: str) -> Dict[str, Any]:
+        """
+        Extract text with image preprocessing for better accuracy
         
-        try:
-            # Open and process image
-            image = Image.open(image_path)
-            
-            # Get image metadata
-            image_info = {
-                'width': image.width,
-                'height': image.height,
-                'format': image.format,
-                'mode': image.mode
-            }
-            
-            # Extract text using Tesseract
-            text = pytesseract.image_to_string(image)
-            
-            # Get detailed data (includes confidence scores)
-            data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
-            
-            # Calculate average confidence
-            confidences = [int(conf) for conf in data['conf'] if int(conf) > 0]
-            average_confidence = sum(confidences) / len(confidences) if confidences else 0
+        Args:
+            image_path: Path to image file
             
-            # Get OCR statistics
-            text_length = len(text)
-            word_count = len(text.split())
+        Returns:
+            Dictionary with extracted text and metadata
+        """
+        if not self.available:
+            return self.extract_text(image_path)
+        return self.combine_pages(self.iter_pages(image_path, preprocess=True))
+    
+    def extract_image(self, image, preprocess: bool = True, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        OCR an in-memory PIL image (e.g. a scan embedded in a PDF page)
+        
+        Args:
+            image: PIL image
+            preprocess: Apply (adaptive) preprocessing before OCR
+            timeout: Seconds before the tesseract process is killed
             
+        Returns:
+            Dictionary with extracted text and metadata
+        """
+        if not self.available:
             return {
-                'success': True,
-                'text': text.strip(),
-                'confidence': round(average_confidence, 2),
-                'word_count': word_count,
-                'character_count': text_length,
-                'image_info': image_info,
-                'language': 'eng'
+                'success': False,
+                'error': 'Tesseract OCR not installed. Install with: pip install pytesseract pillow',
+                'text': '',
+                'confidence': 0
             }
-        
+        try:
+            return self._ocr_frame(image, preprocess, timeout)
         except Exception as e:
             return {
                 'success': False,
@@ -94,79 +330,216 @@ class OCRProcessor:
                 'confidence': 0
             }
     
-    def extract_text_with_preprocessing(self, image_path: str) -> Dict[str, Any]:
+    def _settings(self, preprocess: bool) -> Dict[str, Any]:
+        """OCR settings that affect the result (part of the cache key)"""
+        # Engines and tesseract releases segment differently, so their results never mix
+        settings = {'preprocessing': self.PREPROCESSING if preprocess else None, 'language': self.LANGUAGE,
+                    'engine': self.engine, 'engine_version': self.engine_version}
+        if preprocess and self.ADAPTIVE:
+            settings.update(heavy=self.HEAVY_PREPROCESSING, heavy_below=self.HEAVY_BELOW_CONFIDENCE)
+        return settings
+    
+    def _cache_key(self, image_hash: Optional[str], preprocess: bool, page: int) -> Optional[str]:
+        """Cache key of one page with the current settings, or None without a cache"""
+        if self.cache is None or not image_hash:
+            return None
+        return self.cache.key(image_hash, dict(self._settings(preprocess), page=page))
+    
+    def iter_pages(self, image_path: str, preprocess: bool = True,
+                   timeout: Optional[float] = None) -> Iterator[Dict[str, Any]]:
         """
-        Extract text with image preprocessing for better accuracy
+        OCR an image one frame at a time
+        
+        Multi-page TIFFs are read lazily: only the current frame is decoded,
+        so memory stays bounded by one page however long the file is. Each
+        page is cached separately by image hash, settings and page number.
         
         Args:
             image_path: Path to image file
+            preprocess: Apply (adaptive) preprocessing before OCR
+            timeout: Seconds allowed per page
             
-        Returns:
-            Dictionary with extracted text and metadata
+        Yields:
+            Per-page results with 'page' and 'page_count'; a single result
+            without 'page' if the file cannot be opened
         """
         if not self.available:
-            return self.extract_text(image_path)
+            yield self.extract_text(image_path)
+            return
+        
+        image_hash = None
+        if self.cache is not None:
+            try:
+                image_hash = SimpleChain.sha256_file(image_path)
+            except OSError:
+                pass  # Image.open below reports the unreadable file
         
         try:
-            from PIL import ImageEnhance, ImageFilter
-            
-            # Open image
-            image = Image.open(image_path)
-            
-            # Convert to RGB if needed
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Preprocessing steps
-            # 1. Enhance contrast
-            enhancer = ImageEnhance.Contrast(image)
-            image = enhancer.enhance(1.5)
-            
-            # 2. Enhance brightness
-            enhancer = ImageEnhance.Brightness(image)
-            image = enhancer.enhance(1.1)
-            
-            # 3. Apply sharpness
-            enhancer = ImageEnhance.Sharpness(image)
-            image = enhancer.enhance(2.0)
-            
-            # 4. Apply slight blur to reduce noise
-            image = image.filter(ImageFilter.MedianFilter(size=3))
-            
-            # Extract text
-            text = pytesseract.image_to_string(image)
+            with Image.open(image_path) as image:
+                page_count = getattr(image, 'n_frames', 1)
+                for number in range(page_count):
+                    key = self._cache_key(image_hash, preprocess, number)
+                    result = self.cache.get(key) if key else None
+                    if result is not None:
+                        result['cached'] = True
+                    else:
+                        try:
+                            image.seek(number)
+                            result = self._ocr_frame(image, preprocess, timeout)
+                        except Exception as e:
+                            result = {'success': False, 'error': str(e), 'text': '', 'confidence': 0}
+                        result.update(page=number + 1, page_count=page_count)
+                        if key and result['success']:
+                            # Re-keyed: the engine may have fallen back during this page
+                            self.cache.put(self._cache_key(image_hash, preprocess, number), result)
+                    yield result
+        except Exception as e:
+            yield {'success': False, 'error': str(e), 'text': '', 'confidence': 0}
+    
+    def _ocr_frame(self, frame, preprocess: bool, timeout: Optional[float]) -> Dict[str, Any]:
+        """OCR the current frame of an open image"""
+        if not preprocess:
+            image_info = {
+                'width': frame.width,
+                'height': frame.height,
+                'format': frame.format,
+                'mode': frame.mode
+            }
             
-            # Get confidence
-            data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
-            confidences = [int(conf) for conf in data['conf'] if int(conf) > 0]
-            average_confidence = sum(confidences) / len(confidences) if confidences else 0
+            # Single tesseract run: text and confidence both come from image_to_data
+            ocr = self._recognize(frame, timeout)
             
             return {
                 'success': True,
-                'text': text.strip(),
-                'confidence': round(average_confidence, 2),
-                'word_count': len(text.split()),
-                'character_count': len(text),
-                'preprocessed': True
+                'text': ocr['text'],
+                'confidence': ocr['confidence'],
+                'word_count': len(ocr['words']),
+                'character_count': len(ocr['text']),
+                'lines': ocr['lines'],
+                'words': ocr['words'],
+                'image_info': image_info,
+                'language': self.LANGUAGE
             }
         
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e),
-                'text': '',
-                'confidence': 0
+        from image_preprocessing import grayscale_at_dpi, image_stats, choose_preprocessing, preprocess_image
+        
+        # Grayscale and downsample once; every path starts from this image
+        gray = grayscale_at_dpi(frame, self.PREPROCESSING['target_dpi'])
+        stats = image_stats(gray)
+        
+        # Clean inputs go straight to OCR, everything else gets the standard pass
+        path = choose_preprocessing(stats) if self.ADAPTIVE else 'standard'
+        image = gray if path == 'fast' else preprocess_image(gray, **self.PREPROCESSING)
+        ocr = self._recognize(image, timeout)
+        
+        # Heavy enhancement only for pages the first pass read poorly
+        if self.ADAPTIVE and ocr['confidence'] < self.HEAVY_BELOW_CONFIDENCE:
+            heavy = self._recognize(preprocess_image(gray, **self.HEAVY_PREPROCESSING), timeout)
+            if heavy['confidence'] > ocr['confidence']:
+                ocr, path = heavy, 'heavy'
+        
+        return {
+            'success': True,
+            'text': ocr['text'],
+            'confidence': ocr['confidence'],
+            'word_count': len(ocr['words']),
+            'character_count': len(ocr['text']),
+            'lines': ocr['lines'],
+            'words': ocr['words'],
+            'preprocessed': path != 'fast',
+            'preprocessing': path,
+            'image_stats': stats
+        }
+    
+    @staticmethod
+    def combine_pages(pages) -> Dict[str, Any]:
+        """
+        Merge per-page results into one
+        
+        A single page is returned as is. For several pages the text is
+        joined with blank lines, confidence is weighted by word count, and
+        per-page line/word boxes are dropped in favour of a page summary.
+        """
+        results = list(pages)
+        if not results:
+            return {'success': False, 'error': 'Image has no pages', 'text': '', 'confidence': 0}
+        if len(results) == 1 or not any(result['success'] for result in results):
+            return results[0]
+        
+        text = '\n\n'.join(result['text'] for result in results)
+        word_count = sum(result.get('word_count', 0) for result in results)
+        weighted = sum(result['confidence'] * result.get('word_count', 0) for result in results)
+        return {
+            'success': True,
+            'text': text,
+            'confidence': round(weighted / word_count, 2) if word_count else 0,
+            'word_count': word_count,
+            'character_count': len(text),
+            'page_count': len(results),
+            'pages': [
+                {key: result.get(key) for key in ('page', 'success', 'confidence', 'word_count', 'preprocessing', 'error')
+                 if key in result}
+                for result in results
+            ],
+            'failed_pages': [result['page'] for result in results if not result['success']],
+            'preprocessed': any(result.get('preprocessed') for result in results)
+        }
+    
+    def iter_batch_extract(self, image_paths: list, workers: Optional[int] = None,
+                           page_timeout: Optional[float] = None) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        OCR pages on a process pool, yielding results as each page finishes
+        
+        Each worker process builds one OCRProcessor (sharing this one's
+        cache directory) and reuses it, with its warm engines, for every page
+        it is given.
+        
+        Uploads do not go through here: ingest_batch runs in JobQueue worker
+        threads, where forking a pool from the multi-threaded server is
+        unsafe, and those threads already overlap OCR (tesserocr releases the
+        GIL; pytesseract runs tesseract as a subprocess). This is for
+        scripts and maintenance tasks OCRing many files at once.
+        
+        Args:
+            image_paths: List of paths to image files
+            workers: Pool size (defaults to OCR_WORKERS or the CPU count)
+            page_timeout: Seconds allowed per page before tesseract is killed
+            
+        Yields:
+            (input index, extract_text result) in completion order
+        """
+        workers = workers or int(os.getenv('OCR_WORKERS', os.cpu_count() or 1))
+        if not self.available or workers <= 1 or len(image_paths) <= 1:
+            for i, image_path in enumerate(image_paths):
+                yield i, self.extract_text(image_path, timeout=page_timeout)
+            return
+        
+        cache = (self.cache.directory, self.cache.max_bytes) if self.cache is not None else (None, 0)
+        with ProcessPoolExecutor(max_workers=min(workers, len(image_paths)),
+                                 initializer=_init_worker, initargs=cache) as pool:
+            futures = {
+                pool.submit(_extract_page, image_path, page_timeout): i
+                for i, image_path in enumerate(image_paths)
             }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'success': False, 'error': str(e), 'text': '', 'confidence': 0}
+                yield futures[future], result
     
-    def batch_extract(self, image_paths: list) -> Dict[str, Any]:
+    def batch_extract(self, image_paths: list, workers: int = 1,
+                      page_timeout: Optional[float] = None) -> Dict[str, Any]:
         """
         Extract text from multiple images
         
         Args:
             image_paths: List of paths to image files
+            workers: Number of OCR processes; 1 runs pages sequentially
+            page_timeout: Seconds allowed per page before tesseract is killed
             
         Returns:
-            Dictionary with results for each image
+            Dictionary with results for each image, in input order
         """
         results = {
             'total_images': len(image_paths),
@@ -176,11 +549,13 @@ class OCRProcessor:
             'combined_text': ''
         }
         
+        ordered = [None] * len(image_paths)
+        for i, result in self.iter_batch_extract(image_paths, workers, page_timeout):
+            ordered[i] = result
+        
         all_text = []
         
-        for image_path in image_paths:
-            result = self.extract_text(image_path)
-            
+        for image_path, result in zip(image_paths, ordered):
             if result['success']:
                 results['successful'] += 1
                 all_text.append(result['text'])
@@ -198,3 +573,18 @@ class OCRProcessor:
         results['total_words'] = len(results['combined_text'].split())
         
         return results
+
+
+# The OCRProcessor of a batch worker process, built once by _init_worker
+_worker_processor: Optional[OCRProcessor] = None
+
+
+def _init_worker(cache_directory: Optional[str], cache_bytes: int):
+    """Process-pool initializer: one processor, cache handle and engine pool per worker"""
+    global _worker_processor
+    _worker_processor = OCRProcessor(cache=OCRResultCache(cache_directory, cache_bytes))
+
+
+def _extract_page(image_path: str, timeout: Optional[float]) -> Dict[str, Any]:
+    """Process-pool entry point: OCR one page with the worker's processor"""
+    return _worker_processor.extract_text(image_path, timeout=timeout)
@@ -0,0 +1,153 @@
+"""Parser for search queries with phrases, NEAR/n and boolean operators
+
+Grammar (operators are upper case; juxtaposition means OR)::
+
+    query    := and_expr ([OR] and_expr)*
+    and_expr := near (AND near | NOT near)*
+    near     := unary (NEAR/n unary)*
+    unary    := NOT unary | '(' query ')' | "phrase" | term
+"""
+
+import re
+from collections import namedtuple
+from typing import List, Tuple
+
+from text_analysis import query_terms
+
+Term = namedtuple('Term', ['term'])
+Phrase = namedtuple('Phrase', ['terms'])
+Near = namedtuple('Near', ['left', 'right', 'distance'])
+And = namedtuple('And', ['children'])
+Or = namedtuple('Or', ['children'])
+Not = namedtuple('Not', ['child'])
+
+TOKEN_PATTERN = re.compile(r'"([^"]*)"|(\()|(\))|NEAR/(\d+)|(\S+?)(?=[()"]|\s|$)')
+OPERATORS = {'AND', 'OR', 'NOT'}
+DEFAULT_NEAR_DISTANCE = 5
+
+
+class QuerySyntaxError(ValueError):
+    """Raised for malformed search queries"""
+
+
+def _lex(query: str) -> List[Tuple[str, object]]:
+    tokens = []
+    for phrase, lparen, rparen, near, word in TOKEN_PATTERN.findall(query):
+        if lparen:
+            tokens.append(('(', None))
+        elif rparen:
+            tokens.append((')', None))
+        elif near:
+            tokens.append(('NEAR', int(near)))
+        elif word == 'NEAR':
+            tokens.append(('NEAR', DEFAULT_NEAR_DISTANCE))
+        elif word in OPERATORS:
+            tokens.append((word, None))
+        elif word:
+            # A word may split into several terms ("co-owner" -> co, owner)
+            terms = query_terms(word)
+            if len(terms) == 1:
+                tokens.append(('TERM', Term(terms[0])))
+            elif terms:
+                tokens.append(('TERM', Phrase(tuple(terms))))
+        else:
+            terms = query_terms(phrase)
+            if len(terms) == 1:
+                tokens.append(('TERM', Term(terms[0])))
+            elif terms:
+                tokens.append(('TERM', Phrase(tuple(terms))))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def query(self):
+        children = [self.and_expr()]
+        while self.peek() not in (None, ')'):
+            if self.peek() == 'OR':
+                self.take()
+            children.append(self.and_expr())
+        return children[0] if len(children) == 1 else Or(tuple(children))
+
+    def and_expr(self):
+        children = [self.near()]
+        while self.peek() in ('AND', 'NOT'):
+            kind, _ = self.take()
+            node = self.near()
+            children.append(Not(node) if kind == 'NOT' else node)
+        return children[0] if len(children) == 1 else And(tuple(children))
+
+    def near(self):
+        node = self.unary()
+        while self.peek() == 'NEAR':
+            _, distance = self.take()
+            node = Near(node, self.unary(), distance)
+        return node
+
+    def unary(self):
+        kind = self.peek()
+        if kind is None:
+            raise QuerySyntaxError('Unexpected end of query')
+        if kind == 'NOT':
+            self.take()
+            return Not(self.unary())
+        if kind == '(':
+            self.take()
+            node = self.query()
+            if self.peek() != ')':
+                raise QuerySyntaxError('Unbalanced parentheses')
+            self.take()
+            return node
+        if kind == 'TERM':
+            return self.take()[1]
+        raise QuerySyntaxError(f'Unexpected {kind}')
+
+
+def parse_query(query: str):
+    """
+    Parse a query string into an expression tree
+
+    Returns:
+        Tree of Term/Phrase/Near/And/Or/Not nodes, or None for an empty query
+    """
+    tokens = _lex(query)
+    if not tokens:
+        return None
+    parser = _Parser(tokens)
+    node = parser.query()
+    if parser.pos != len(tokens):
+        raise QuerySyntaxError('Unbalanced parentheses')
+    return node
+
+
+def positive_terms(node) -> List[str]:
+    """Terms that contribute to ranking (everything not under NOT)"""
+    if isinstance(node, Term):
+        return [node.term]
+    if isinstance(node, Phrase):
+        return list(node.terms)
+    if isinstance(node, Near):
+        return positive_terms(node.left) + positive_terms(node.right)
+    if isinstance(node, (And, Or)):
+        return [term for child in node.children for term in positive_terms(child)]
+    return []
+
+
+def is_plain(node) -> bool:
+    """True for a bag of words (terms joined by OR) with no positional constraints"""
+    if isinstance(node, Term):
+        return True
+    if isinstance(node, Or):
+        return all(isinstance(child, Term) for child in node.children)
+    return False
@@ -0,0 +1,177 @@
+"""BM25 / BM25F relevance scoring over the inverted index"""
+
+import heapq
+import math
+from itertools import accumulate
+from typing import Container, Dict, List, Optional, Tuple
+
+from search_index import SearchIndex, Posting, FIELDS
+
+RANKING_MODES = ('bm25f', 'bm25')
+
+
+class BM25Scorer:
+    """
+    Score documents with BM25 (content only) or BM25F (content + filename)
+
+    Collection statistics, per-document length norms and IDF values are
+    cached and only recomputed when the index generation changes.
+    """
+
+    def __init__(self, index: SearchIndex, k1: float = 1.2,
+                 field_weights: Optional[Dict[str, float]] = None,
+                 field_b: Optional[Dict[str, float]] = None):
+        self.index = index
+        self.k1 = k1
+        self.field_weights = field_weights or {'content': 1.0, 'filename': 3.0}
+        self.field_b = field_b or {'content': 0.75, 'filename': 0.3}
+        self._generation = None
+        self._doc_count = 0
+        self._norms: Dict[str, tuple] = {}
+        self._idf: Dict[str, float] = {}
+
+    def refresh(self):
+        """Reload cached statistics if the index changed since last use"""
+        generation = self.index.generation()
+        if generation == self._generation:
+            return
+        stats = self.index.stats()
+        doc_count = max(stats['doc_count'], 1)
+        averages = {
+            'content': stats['content_length'] / doc_count or 1.0,
+            'filename': stats['filename_length'] / doc_count or 1.0,
+        }
+        self._norms = {
+            doc_id: tuple(
+                1 - self.field_b[field] + self.field_b[field] * length / averages[field]
+                for field, length in zip(FIELDS, lengths)
+            )
+            for doc_id, lengths in self.index.doc_lengths().items()
+        }
+        self._doc_count = stats['doc_count']
+        self._idf = {}
+        self._generation = generation
+
+    def idf(self, term: str, df: int) -> float:
+        """Robertson-Sparck Jones IDF, cached per term"""
+        if term not in self._idf:
+            self._idf[term] = math.log(1 + (self._doc_count - df + 0.5) / (df + 0.5))
+        return self._idf[term]
+
+    def fields(self, mode: str) -> tuple:
+        """Index fields taking part in a ranking mode"""
+        return FIELDS if mode == 'bm25f' else ('content',)
+
+    def _contribution(self, field_postings: Dict[str, Dict[str, Posting]], doc_id: str,
+                      idf: float, fields: tuple) -> float:
+        """Score contribution of one term to one document"""
+        norms = self._norms.get(doc_id)
+        if norms is None:
+            return 0.0
+        # BM25F: combine length-normalised field frequencies before saturation
+        weighted_tf = 0.0
+        for field in fields:
+            posting = field_postings.get(field, {}).get(doc_id)
+            if posting:
+                weighted_tf += self.field_weights[field] * posting.tf / norms[FIELDS.index(field)]
+        return idf * weighted_tf * (self.k1 + 1) / (self.k1 + weighted_tf)
+
+    def score_term(self, term: str, field_postings: Dict[str, Dict[str, Posting]],
+                   mode: str = 'bm25f') -> Dict[str, float]:
+        """
+        Score every document containing a term
+
+        Args:
+            term: Query term
+            field_postings: field -> {doc_id: Posting} for this term
+            mode: 'bm25f' or 'bm25'
+
+        Returns:
+            doc_id -> score contribution of the term
+        """
+        fields = self.fields(mode)
+        doc_ids = set()
+        for field in fields:
+            doc_ids.update(field_postings.get(field, {}))
+        if not doc_ids:
+            return {}
+
+        idf = self.idf(f'{mode}:{term}', len(doc_ids))
+        return {doc_id: self._contribution(field_postings, doc_id, idf, fields) for doc_id in doc_ids}
+
+    def top_k(self, term_postings: Dict[str, Dict[str, Dict[str, Posting]]], k: int,
+              mode: str = 'bm25f', allowed: Optional[Container[str]] = None) -> List[Tuple[str, float]]:
+        """
+        Best k documents using MaxScore dynamic pruning
+
+        Terms are ordered by their score upper bound (idf * (k1 + 1)). Once
+        the k-th best score exceeds the combined bound of the weakest terms,
+        those terms become non-essential: documents that only contain them
+        are never visited, and their contributions are added to a candidate
+        only while it can still enter the heap.
+
+        Args:
+            term_postings: term -> field -> {doc_id: Posting}
+            k: Number of hits to return
+            mode: 'bm25f' or 'bm25'
+            allowed: Optional filter (e.g. boolean/phrase matches) a hit must be in
+
+        Returns:
+            (doc_id, score) pairs, best first
+        """
+        if k <= 0:
+            return []
+        fields = self.fields(mode)
+
+        cursors = []
+        for term, field_postings in term_postings.items():
+            doc_ids = sorted(set().union(*(field_postings.get(field, {}) for field in fields)))
+            if doc_ids:
+                idf = self.idf(f'{mode}:{term}', len(doc_ids))
+                cursors.append((idf * (self.k1 + 1), idf, field_postings, doc_ids))
+        cursors.sort(key=lambda cursor: cursor[0])
+        bounds = list(accumulate(cursor[0] for cursor in cursors))
+        pointers = [0] * len(cursors)
+
+        heap: List[Tuple[float, str]] = []
+        threshold = 0.0
+        essential = 0
+
+        while essential < len(cursors):
+            # Next candidate comes from essential lists only
+            doc_id = min(
+                (cursors[i][3][pointers[i]] for i in range(essential, len(cursors))
+                 if pointers[i] < len(cursors[i][3])),
+                default=None
+            )
+            if doc_id is None:
+                break
+
+            matched = allowed is None or doc_id in allowed
+            score = 0.0
+            for i in range(essential, len(cursors)):
+                if pointers[i] < len(cursors[i][3]) and cursors[i][3][pointers[i]] == doc_id:
+                    if matched:
+                        score += self._contribution(cursors[i][2], doc_id, cursors[i][1], fields)
+                    pointers[i] += 1
+            if not matched:
+                continue
+
+            for i in range(essential - 1, -1, -1):
+                if score + bounds[i] <= threshold:
+                    break
+                score += self._contribution(cursors[i][2], doc_id, cursors[i][1], fields)
+
+            if len(heap) < k:
+                heapq.heappush(heap, (score, doc_id))
+            elif score > heap[0][0]:
+                heapq.heapreplace(heap, (score, doc_id))
+            else:
+                continue
+
+            if len(heap) == k:
+                threshold = heap[0][0]
+                while essential < len(cursors) and bounds[essential] <= threshold:
+                    essential += 1
+
+        return [(doc_id, score) for score, doc_id in sorted(heap, reverse=True)]
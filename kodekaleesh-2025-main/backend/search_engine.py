@@ -1,113 +1,229 @@
-import json
-import os
-from typing import List, Dict, Any
+from bisect import bisect_left
+from typing import List, Dict, Any, Optional, Tuple
+from storage import DocumentStore, create_document_store, metadata_matches
+from search_index import SearchIndex, FIELDS
+from ranking import BM25Scorer, RANKING_MODES
+from query_parser import Term, Phrase, Near, And, Or, Not, parse_query, positive_terms, is_plain
+
+# (first token position, last token position, start char, end char)
+Span = Tuple[int, int, int, int]
 
 class SearchEngine:
     """Search across documents"""
     
-    def __init__(self):
-        self.storage_file = 'documents.json'
+    def __init__(self, index: Optional[SearchIndex] = None, store: Optional[DocumentStore] = None):
+        self.index = index or SearchIndex()
+        self.store = store or create_document_store()
+        self.scorer = BM25Scorer(self.index)
     
-    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
-        """Search documents for a query"""
-        if not os.path.exists(self.storage_file):
+    def search(self, query: str, limit: int = 10, ranking: str = 'bm25f') -> List[Dict[str, Any]]:
+        """
+        Search documents for a query
+        
+        Supports "exact phrases", a NEAR/n b proximity and AND / OR / NOT
+        (upper case) with parentheses. Plain words are OR-ed and ranked.
+        """
+        if ranking not in RANKING_MODES:
+            raise ValueError(f'ranking must be one of {", ".join(RANKING_MODES)}')
+        
+        node = parse_query(query)
+        terms = positive_terms(node) if node else []
+        if not terms:
             return []
         
-        with open(self.storage_file, 'r') as f:
-            documents = json.load(f)
+        self.scorer.refresh()
+        term_postings: Dict[str, Dict[str, Dict]] = {}
+        for term in terms:
+            self._load(term, term_postings)
+        
+        matches = None
+        if not is_plain(node):
+            matches = self._evaluate(node, term_postings)
+        
+        # Bounded heap; snippets are built for the final hits only
+        ranked = self.scorer.top_k(
+            {term: term_postings[term] for term in set(terms)}, limit, ranking, allowed=matches
+        )
+        info = self.index.doc_info(doc_id for doc_id, _ in ranked)
         
-        query_lower = query.lower()
         results = []
+        for doc_id, score in ranked:
+            if matches is None:
+                spans = self._phrase_spans(terms, term_postings, doc_id)
+            else:
+                spans = matches[doc_id]
+            snippets = self._extract_snippets(doc_id, spans or self._term_spans(terms, term_postings, doc_id))
+            if snippets is None:
+                continue
+            results.append({
+                'document_id': doc_id,
+                'filename': info[doc_id]['filename'],
+                'relevance_score': round(score, 4),
+                'match_count': len(spans),
+                'snippets': snippets,
+                'created_at': info[doc_id]['created_at']
+            })
         
-        for doc_id, doc_data in documents.items():
-            content = doc_data.get('content', '').lower()
-            filename = doc_data.get('filename', '').lower()
-            
-            # Calculate relevance score
-            score = 0
-            
-            # Exact phrase match gets highest score
-            if query_lower in content:
-                score += 100
-            
-            # Word matches
-            query_words = query_lower.split()
-            for word in query_words:
-                score += content.count(word) * 5
-                if word in filename:
-                    score += 20
-            
-            if score > 0:
-                # Extract context snippets
-                snippets = self._extract_snippets(doc_data['content'], query, max_snippets=2)
-                
-                results.append({
-                    'document_id': doc_id,
-                    'filename': doc_data['filename'],
-                    'relevance_score': score,
-                    'match_count': content.count(query_lower),
-                    'snippets': snippets,
-                    'created_at': doc_data['created_at']
-                })
-        
-        # Sort by relevance score
-        results = sorted(results, key=lambda x: x['relevance_score'], reverse=True)
-        
-        return results[:limit]
+        return results
     
-    def _extract_snippets(self, text: str, query: str, max_snippets: int = 2) -> List[str]:
-        """Extract text snippets containing the query"""
-        snippets = []
-        query_lower = query.lower()
-        text_lower = text.lower()
+    def _load(self, term: str, term_postings: Dict[str, Dict[str, Dict]]) -> Dict[str, Dict]:
+        """Fetch a term's postings once per query"""
+        if term not in term_postings:
+            term_postings[term] = {
+                field: {p.doc_id: p for p in self.index.postings(term, field)}
+                for field in FIELDS
+            }
+        return term_postings[term]
+    
+    def _evaluate(self, node, term_postings) -> Dict[str, List[Span]]:
+        """Matching documents of a query node with their positional match spans"""
+        if isinstance(node, Term):
+            fields = self._load(node.term, term_postings)
+            return {doc_id: [] for field in FIELDS for doc_id in fields[field]}
         
-        start = 0
-        snippet_count = 0
+        if isinstance(node, Phrase):
+            content = [self._load(term, term_postings)['content'] for term in node.terms]
+            candidates = set.intersection(*(set(postings) for postings in content))
+            result = {}
+            for doc_id in candidates:
+                spans = self._phrase_spans(node.terms, term_postings, doc_id)
+                if spans:
+                    result[doc_id] = spans
+            return result
         
-        while snippet_count < max_snippets:
-            pos = text_lower.find(query_lower, start)
-            if pos == -1:
+        if isinstance(node, Near):
+            left = self._positional(node.left, term_postings)
+            right = self._positional(node.right, term_postings)
+            result = {}
+            for doc_id in left.keys() & right.keys():
+                spans = self._near_spans(left[doc_id], right[doc_id], node.distance)
+                if spans:
+                    result[doc_id] = spans
+            return result
+        
+        if isinstance(node, Or):
+            result = {}
+            for child in node.children:
+                for doc_id, spans in self._evaluate(child, term_postings).items():
+                    result.setdefault(doc_id, []).extend(spans)
+            return result
+        
+        if isinstance(node, And):
+            positive = [c for c in node.children if not isinstance(c, Not)]
+            negative = [c.child for c in node.children if isinstance(c, Not)]
+            if positive:
+                result = self._evaluate(positive[0], term_postings)
+                for child in positive[1:]:
+                    other = self._evaluate(child, term_postings)
+                    result = {doc_id: spans + other[doc_id] for doc_id, spans in result.items() if doc_id in other}
+            else:
+                result = {doc_id: [] for doc_id in self.index.doc_ids()}
+            for child in negative:
+                excluded = self._evaluate(child, term_postings)
+                result = {doc_id: spans for doc_id, spans in result.items() if doc_id not in excluded}
+            return result
+        
+        if isinstance(node, Not):
+            excluded = self._evaluate(node.child, term_postings)
+            return {doc_id: [] for doc_id in self.index.doc_ids() if doc_id not in excluded}
+        
+        raise TypeError(f'Unknown query node {node!r}')
+    
+    def _positional(self, node, term_postings) -> Dict[str, List[Span]]:
+        """Content-field match spans for a NEAR operand"""
+        if isinstance(node, Term):
+            return {
+                doc_id: self._term_spans([node.term], term_postings, doc_id, limit=None)
+                for doc_id in self._load(node.term, term_postings)['content']
+            }
+        if isinstance(node, Or):
+            result = {}
+            for child in node.children:
+                for doc_id, spans in self._positional(child, term_postings).items():
+                    result.setdefault(doc_id, []).extend(spans)
+            return result
+        return self._evaluate(node, term_postings)
+    
+    @staticmethod
+    def _near_spans(left: List[Span], right: List[Span], distance: int) -> List[Span]:
+        """Pair each left span with the closest right span within distance tokens"""
+        right = sorted(right)
+        starts = [span[0] for span in right]
+        spans = []
+        for span in left:
+            i = bisect_left(starts, span[0] - distance)
+            best = None
+            for other in right[i:]:
+                if other[0] > span[1] + distance:
+                    break
+                gap = max(other[0] - span[1], span[0] - other[1], 0)
+                if gap <= distance and (best is None or gap < best[0]):
+                    best = (gap, other)
+            if best:
+                other = best[1]
+                spans.append((min(span[0], other[0]), max(span[1], other[1]),
+                               min(span[2], other[2]), max(span[3], other[3])))
+        return spans
+    
+    def _phrase_spans(self, terms, term_postings, doc_id: str) -> List[Span]:
+        """Occurrences of the terms as a contiguous phrase in a document's content"""
+        postings = [self._load(term, term_postings)['content'].get(doc_id) for term in terms]
+        if any(p is None for p in postings):
+            return []
+        following = [set(p.positions) for p in postings[1:]]
+        last = postings[-1]
+        last_offsets = dict(zip(last.positions, last.offsets))
+        spans = []
+        for start, offset in zip(postings[0].positions, postings[0].offsets):
+            if all(start + i + 1 in positions for i, positions in enumerate(following)):
+                end = start + len(terms) - 1
+                spans.append((start, end, offset, last_offsets[end] + len(terms[-1])))
+        return spans
+    
+    def _term_spans(self, terms, term_postings, doc_id: str, limit: Optional[int] = 2) -> List[Span]:
+        """Individual term occurrences, used when there is no positional match"""
+        spans = []
+        for term in dict.fromkeys(terms):
+            posting = term_postings[term]['content'].get(doc_id)
+            if posting:
+                pairs = list(zip(posting.positions, posting.offsets))
+                spans.extend((p, p, o, o + len(term)) for p, o in pairs[:limit])
+        return sorted(spans)
+    
+    def _extract_snippets(self, doc_id: str, spans: List[Span], max_snippets: int = 2) -> Optional[List[str]]:
+        """Read context windows around match spans; None if the body is gone"""
+        windows = []
+        for _, _, start, end in sorted(spans, key=lambda span: span[2]):
+            if windows and start < windows[-1][1]:
+                continue
+            windows.append((max(0, start - 50), end + 50))
+            if len(windows) == max_snippets:
                 break
-            
-            # Extract surrounding context (50 chars before and after)
-            snippet_start = max(0, pos - 50)
-            snippet_end = min(len(text), pos + len(query) + 50)
-            
-            snippet = text[snippet_start:snippet_end].strip()
+        
+        snippets = []
+        for snippet_start, snippet_end in windows:
+            window = self.store.read_content_range(doc_id, snippet_start, snippet_end)
+            if window is None:
+                return None
+            text, text_length = window
+            snippet = text.strip()
             if snippet_start > 0:
                 snippet = '...' + snippet
-            if snippet_end < len(text):
+            if snippet_end < text_length:
                 snippet = snippet + '...'
-            
             snippets.append(snippet)
-            start = pos + len(query)
-            snippet_count += 1
-        
         return snippets
     
     def advanced_search(self, filters: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Advanced search with filters"""
-        if not os.path.exists(self.storage_file):
-            return []
-        
-        with open(self.storage_file, 'r') as f:
-            documents = json.load(f)
-        
         results = []
         
-        for doc_id, doc_data in documents.items():
-            # Apply filters
-            if filters.get('filename') and filters['filename'] not in doc_data.get('filename', ''):
-                continue
-            
-            if filters.get('min_length') and doc_data.get('text_length', 0) < filters['min_length']:
-                continue
-            
-            if filters.get('max_length') and doc_data.get('text_length', 0) > filters['max_length']:
+        for doc_data in self.store.list_metadata():
+            if not metadata_matches(doc_data, filters):
                 continue
             
             results.append({
-                'id': doc_id,
+                'id': doc_data['id'],
                 'filename': doc_data['filename'],
                 'created_at': doc_data['created_at'],
                 'text_length': doc_data['text_length']
@@ -0,0 +1,257 @@
+"""Persistent positional inverted index used by the search engine"""
+
+import os
+import threading
+from array import array
+from collections import namedtuple
+from typing import Dict, List, Any, Optional, Iterable, Tuple
+
+from storage import open_sqlite
+from text_analysis import AnalyzedText, tokenize
+
+# Indexed document fields
+FIELDS = ('content', 'filename')
+
+Posting = namedtuple('Posting', ['doc_id', 'tf', 'positions', 'offsets'])
+
+
+def _pack(values: List[int]) -> bytes:
+    return array('I', values).tobytes()
+
+
+def _unpack(blob: bytes) -> array:
+    values = array('I')
+    values.frombytes(blob)
+    return values
+
+
+class SearchIndex:
+    """Term -> postings index stored in SQLite and updated per document"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS postings (
+            term TEXT NOT NULL,
+            field TEXT NOT NULL,
+            doc_id TEXT NOT NULL,
+            tf INTEGER NOT NULL,
+            positions BLOB NOT NULL,
+            offsets BLOB NOT NULL,
+            PRIMARY KEY (term, field, doc_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+        CREATE TABLE IF NOT EXISTS doc_stats (
+            doc_id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            content_length INTEGER NOT NULL,
+            filename_length INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS index_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO index_meta (key, value) VALUES
+            ('generation', 0), ('doc_count', 0),
+            ('content_length', 0), ('filename_length', 0),
+            ('synced', 0), ('pending_writes', 0);
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv('SEARCH_INDEX_PATH', 'search_index.db')
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = open_sqlite(self.path)
+        return conn
+
+    @staticmethod
+    def _field_rows(doc: Dict[str, Any], analysis: Optional[AnalyzedText] = None) -> Tuple[List[tuple], Dict[str, int]]:
+        """Build postings rows and per-field token counts for one document"""
+        rows = []
+        lengths = {}
+        for field in FIELDS:
+            if field == 'content' and analysis is not None and analysis.offsets is not None:
+                # Reuse the ingest-time tokenization instead of tokenizing again
+                grouped = analysis.postings()
+                lengths[field] = len(analysis.ids)
+            else:
+                tokens = tokenize(doc.get(field, ''))
+                lengths[field] = len(tokens)
+                grouped = {}
+                for term, position, offset in tokens:
+                    positions, offsets = grouped.setdefault(term, ([], []))
+                    positions.append(position)
+                    offsets.append(offset)
+            for term, (positions, offsets) in grouped.items():
+                rows.append((term, field, doc['id'], len(positions), _pack(positions), _pack(offsets)))
+        return rows, lengths
+
+    @staticmethod
+    def _bump(conn, doc_count: int, content_length: int, filename_length: int):
+        """Adjust running collection totals and the change generation"""
+        conn.executemany(
+            'UPDATE index_meta SET value = value + ? WHERE key = ?',
+            [(1, 'generation'), (doc_count, 'doc_count'),
+             (content_length, 'content_length'), (filename_length, 'filename_length')]
+        )
+
+    def _drop(self, conn, doc_id: str):
+        """Remove one document's postings and stats inside a transaction"""
+        row = conn.execute(
+            'SELECT content_length, filename_length FROM doc_stats WHERE doc_id = ?', (doc_id,)
+        ).fetchone()
+        if row is None:
+            return
+        conn.execute('DELETE FROM postings WHERE doc_id = ?', (doc_id,))
+        conn.execute('DELETE FROM doc_stats WHERE doc_id = ?', (doc_id,))
+        self._bump(conn, -1, -row['content_length'], -row['filename_length'])
+
+    def _add(self, conn, doc: Dict[str, Any], analysis: Optional[AnalyzedText] = None):
+        """Index one document inside a transaction"""
+        rows, lengths = self._field_rows(doc, analysis)
+        self._drop(conn, doc['id'])
+        conn.executemany(
+            'INSERT INTO postings (term, field, doc_id, tf, positions, offsets) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        conn.execute(
+            'INSERT OR REPLACE INTO doc_stats '
+            '(doc_id, filename, created_at, content_length, filename_length) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (doc['id'], doc.get('filename', ''), doc.get('created_at', ''),
+             lengths['content'], lengths['filename'])
+        )
+        self._bump(conn, 1, lengths['content'], lengths['filename'])
+
+    def add_documents(self, docs: Iterable[Dict[str, Any]],
+                      analyses: Optional[Dict[str, AnalyzedText]] = None):
+        """
+        Index (or re-index) documents in a single transaction
+
+        Args:
+            docs: Documents with id, content and filename
+            analyses: Optional fresh AnalyzedText per document id, reused
+                instead of tokenizing the content again
+        """
+        analyses = analyses or {}
+        with self._connect() as conn:
+            for doc in docs:
+                self._add(conn, doc, analyses.get(doc['id']))
+
+    def add_document(self, doc: Dict[str, Any]):
+        """Index (or re-index) one document"""
+        self.add_documents([doc])
+
+    def remove_document(self, doc_id: str):
+        """Drop a document's postings"""
+        with self._connect() as conn:
+            self._drop(conn, doc_id)
+
+    def rebuild(self, docs: Iterable[Dict[str, Any]]):
+        """Replace the whole index with the given documents in one transaction"""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM postings')
+            conn.execute('DELETE FROM doc_stats')
+            conn.execute("UPDATE index_meta SET value = 0 WHERE key != 'generation'")
+            self._bump(conn, 0, 0, 0)
+            for doc in docs:
+                self._add(conn, doc)
+            conn.execute("UPDATE index_meta SET value = 1 WHERE key = 'synced'")
+
+    def begin_write(self):
+        """Record that a document store write, to be mirrored here, has started"""
+        self._adjust_pending(1)
+
+    def end_write(self):
+        """Record that a write started with ``begin_write`` is reflected in the index"""
+        self._adjust_pending(-1)
+
+    def _adjust_pending(self, delta: int):
+        with self._connect() as conn:
+            conn.execute("UPDATE index_meta SET value = value + ? WHERE key = 'pending_writes'", (delta,))
+
+    def needs_rebuild(self) -> bool:
+        """
+        Whether the index may not match the document store
+
+        True until the first ``rebuild`` (an index created alongside an
+        existing store), and after a write was interrupted between the store
+        and the index. Callers hold the index's exclusive ``file_lock`` so
+        no write is in flight.
+        """
+        stats = self.stats()
+        return not stats['synced'] or stats['pending_writes'] != 0
+
+    def postings(self, term: str, field: str = 'content') -> List[Posting]:
+        """Postings list for a term in one field"""
+        rows = self._connect().execute(
+            'SELECT doc_id, tf, positions, offsets FROM postings WHERE term = ? AND field = ?',
+            (term, field)
+        ).fetchall()
+        return [
+            Posting(row['doc_id'], row['tf'], _unpack(row['positions']), _unpack(row['offsets']))
+            for row in rows
+        ]
+
+    def document_frequencies(self, terms: Iterable[str], field: str = 'content') -> Dict[str, int]:
+        """Number of documents containing each term (terms in no document are omitted)"""
+        terms = list(terms)
+        frequencies = {}
+        conn = self._connect()
+        # Stay under SQLite's bound-parameter limit
+        for i in range(0, len(terms), 500):
+            chunk = terms[i:i + 500]
+            rows = conn.execute(
+                f'SELECT term, COUNT(*) FROM postings WHERE field = ? AND term IN ({",".join("?" * len(chunk))}) '
+                'GROUP BY term',
+                (field, *chunk)
+            ).fetchall()
+            frequencies.update({row[0]: row[1] for row in rows})
+        return frequencies
+
+    def doc_info(self, doc_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Stored filename/created_at/lengths for the given documents"""
+        doc_ids = list(doc_ids)
+        info = {}
+        conn = self._connect()
+        # Stay under SQLite's bound-parameter limit
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i + 500]
+            rows = conn.execute(
+                f'SELECT * FROM doc_stats WHERE doc_id IN ({",".join("?" * len(chunk))})',
+                chunk
+            ).fetchall()
+            info.update({row['doc_id']: dict(row) for row in rows})
+        return info
+
+    def doc_ids(self) -> List[str]:
+        """Every indexed document id"""
+        return [row[0] for row in self._connect().execute('SELECT doc_id FROM doc_stats')]
+
+    def doc_lengths(self) -> Dict[str, Tuple[int, int]]:
+        """Token counts (content, filename) for every indexed document"""
+        rows = self._connect().execute(
+            'SELECT doc_id, content_length, filename_length FROM doc_stats'
+        ).fetchall()
+        return {row['doc_id']: (row['content_length'], row['filename_length']) for row in rows}
+
+    def stats(self) -> Dict[str, int]:
+        """Collection totals maintained incrementally on every write"""
+        rows = self._connect().execute('SELECT key, value FROM index_meta').fetchall()
+        return {row['key']: row['value'] for row in rows}
+
+    def generation(self) -> int:
+        """Counter bumped on every index change, used to invalidate caches"""
+        return self._connect().execute(
+            "SELECT value FROM index_meta WHERE key = 'generation'"
+        ).fetchone()[0]
+
+    def count(self) -> int:
+        """Number of indexed documents"""
+        return self.stats()['doc_count']
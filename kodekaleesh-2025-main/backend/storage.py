@@ -0,0 +1,830 @@
+"""Pluggable storage backends for processed documents"""
+
+import base64
+import fnmatch
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from blob_store import BlobStore
+from locking import file_lock, atomic_write_json, file_signature
+from typing import Dict, List, Any, Optional, Iterator, Tuple
+
+# Columns kept in their own SQLite columns; everything else lives in `extra`
+METADATA_FIELDS = ('id', 'filename', 'created_at', 'text_length', 'pages', 'file_path')
+# Keys documents can be listed by; each has a (key, id) index in SQLite
+SORT_FIELDS = ('created_at', 'filename', 'text_length')
+
+logger = logging.getLogger(__name__)
+
+
+def metadata_matches(doc: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> bool:
+    """Apply filename (substring), min_length and max_length filters to a metadata record"""
+    if not filters:
+        return True
+    if filters.get('filename') and filters['filename'] not in doc.get('filename', ''):
+        return False
+    if filters.get('min_length') and doc.get('text_length', 0) < filters['min_length']:
+        return False
+    if filters.get('max_length') and doc.get('text_length', 0) > filters['max_length']:
+        return False
+    return True
+
+
+def open_sqlite(path: str) -> sqlite3.Connection:
+    """Open a SQLite connection configured for concurrent readers (WAL)"""
+    # IMMEDIATE takes the write lock up front, so concurrent writers from
+    # other processes wait on the busy timeout instead of failing mid-transaction
+    conn = sqlite3.connect(path, timeout=30, isolation_level='IMMEDIATE')
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def blob_body(blobs: BlobStore, digest: str, doc_id: Optional[str] = None) -> str:
+    """Body stored under ``digest``; a missing blob is logged and read as empty"""
+    content = blobs.get(digest)
+    if content is None:
+        logger.error('Blob %s for document %s is missing from %s', digest, doc_id, blobs.directory)
+        return ''
+    return content
+
+
+class DocumentStore:
+    """Interface every document storage backend implements"""
+
+    def get(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        """Return the full document record or None"""
+        raise NotImplementedError
+
+    def put(self, doc: Dict[str, Any]):
+        """Insert or replace a single document"""
+        raise NotImplementedError
+
+    def put_many(self, docs: List[Dict[str, Any]]):
+        """Insert or replace several documents"""
+        for doc in docs:
+            self.put(doc)
+
+    def delete(self, doc_id: str) -> bool:
+        """Delete a document, returning False if it did not exist"""
+        raise NotImplementedError
+
+    def get_content(self, doc_id: str) -> Optional[str]:
+        """Return only the document body, or None if the document is missing"""
+        doc = self.get(doc_id)
+        return doc['content'] if doc else None
+
+    def read_content_range(self, doc_id: str, start: int, end: int) -> Optional[Tuple[str, int]]:
+        """Return (content[start:end], len(content)) or None if the document is missing"""
+        doc = self.get(doc_id)
+        if not doc:
+            return None
+        return doc['content'][start:end], len(doc['content'])
+
+    def list_metadata(self) -> List[Dict[str, Any]]:
+        """Return metadata (no content) for every document"""
+        raise NotImplementedError
+
+    def get_metadata(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        """Return one document's metadata (no content) or None"""
+        doc = self.get(doc_id)
+        return {k: v for k, v in doc.items() if k != 'content'} if doc else None
+
+    def change_seq(self) -> int:
+        """Sequence number of the latest write, from any process"""
+        raise NotImplementedError
+
+    def changes_since(self, seq: int) -> Optional[Tuple[int, List[Tuple[str, str]]]]:
+        """
+        Writes made after ``seq``
+
+        Returns:
+            (latest seq, [(doc_id, 'put' | 'delete'), ...]), or None when the
+            caller is too far behind and must reload all metadata
+        """
+        raise NotImplementedError
+
+    def iter_documents(self) -> Iterator[Dict[str, Any]]:
+        """Iterate over full document records"""
+        raise NotImplementedError
+
+    def count(self) -> int:
+        """Number of stored documents"""
+        raise NotImplementedError
+
+    def get_derived(self, doc_id: str, key: str) -> Optional[Any]:
+        """
+        Value computed from a document (e.g. a summary) and stored with it
+
+        Derived values are dropped when the document is deleted or replaced.
+        """
+        raise NotImplementedError
+
+    def put_derived(self, entries: List[Tuple[str, str, Any]]):
+        """Store JSON-serialisable ``(doc_id, key, value)`` entries; entries for missing documents are ignored"""
+        raise NotImplementedError
+
+    def delete_derived(self, patterns: List[str]) -> int:
+        """Drop derived values, of every document, whose key matches a glob pattern; returns the number dropped"""
+        raise NotImplementedError
+
+    def get_attachment(self, doc_id: str, name: str) -> Optional[bytes]:
+        """
+        Binary value computed from a document's body alone (e.g. its tokenization)
+
+        Stored compressed; with a BlobStore it sits next to the body blob,
+        otherwise (or while the body is still inline) it is kept as a
+        derived value.
+        """
+        value = self.get_derived(doc_id, f'attachment:{name}')
+        return zlib.decompress(base64.b64decode(value)) if value else None
+
+    def put_attachments(self, entries: List[Tuple[str, str, bytes]]):
+        """Store ``(doc_id, name, data)`` attachments; entries for missing documents are ignored"""
+        self.put_derived([
+            (doc_id, f'attachment:{name}', base64.b64encode(zlib.compress(data)).decode('ascii'))
+            for doc_id, name, data in entries
+        ])
+
+    def page_metadata(self, sort: str = 'created_at', descending: bool = False,
+                      after: Optional[Tuple[Any, str]] = None, limit: int = 50,
+                      filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        One page of metadata ordered by ``(sort, id)``
+
+        Args:
+            sort: One of SORT_FIELDS
+            descending: Reverse the order
+            after: ``(sort value, id)`` of the last record of the previous page
+            limit: Maximum records returned
+            filters: filename / min_length / max_length, as in metadata_matches
+
+        Returns:
+            Metadata records (no content)
+        """
+        docs = [doc for doc in self.list_metadata() if metadata_matches(doc, filters)]
+        key = lambda doc: (doc.get(sort), doc['id'])
+        docs.sort(key=key, reverse=descending)
+        if after is not None:
+            after = tuple(after)
+            docs = [doc for doc in docs if (key(doc) < after if descending else key(doc) > after)]
+        return docs[:limit]
+
+    def count_matching(self, filters: Optional[Dict[str, Any]] = None) -> int:
+        """Number of documents passing ``filters``"""
+        if not filters:
+            return self.count()
+        return sum(1 for doc in self.list_metadata() if metadata_matches(doc, filters))
+
+
+class JSONDocumentStore(DocumentStore):
+    """
+    Legacy backend keeping every document in a single JSON file
+
+    Writes re-read the file under an exclusive file lock and replace it
+    atomically; reads reload it only when another process changed it.
+    With a BlobStore the file holds metadata only and each body lives in
+    its blob, so loading the file no longer parses every document's text.
+    Derived values live in a side file (``<name>.derived.json``) guarded by
+    the same lock, so caching a summary never rewrites the metadata file or
+    makes other workers reload it.
+    """
+
+    def __init__(self, path: str = 'documents.json', blobs: Optional[BlobStore] = None):
+        self.path = path
+        self.derived_path = os.path.splitext(path)[0] + '.derived.json'
+        self.blobs = blobs
+        self._signature = None
+        self._derived_signature = None
+        self._generation = 0
+        self.documents = {}
+        self.derived = {}
+        self._refresh()
+        if any('derived' in doc for doc in self.documents.values()):
+            self._update(self._split_derived)
+        if blobs and any('content' in doc for doc in self.documents.values()):
+            self._update(self._externalize)
+
+    def _split_derived(self, documents):
+        """Move derived values (stored inline by earlier versions) to the side file"""
+        def mutate(derived):
+            for doc_id, doc in documents.items():
+                if 'derived' in doc:
+                    derived.setdefault(doc_id, {}).update(doc.pop('derived'))
+            return True
+        self._update_derived(mutate)
+
+    def _externalize(self, documents):
+        """Move inline bodies (written before blobs were enabled) into blobs"""
+        for doc_id, doc in documents.items():
+            if 'content' in doc:
+                documents[doc_id] = self._stored(doc)
+
+    def _stored(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        """Record as written to the file"""
+        if not self.blobs:
+            return doc
+        stored = {k: v for k, v in doc.items() if k != 'content'}
+        stored['content_hash'] = self.blobs.put(doc.get('content', ''))
+        return stored
+
+    @staticmethod
+    def _orphans(documents, digests) -> set:
+        """Digests among ``digests`` no remaining document references"""
+        referenced = {doc.get('content_hash') for doc in documents.values()}
+        return {digest for digest in digests if digest} - referenced
+
+    def _release(self, digests):
+        """Delete orphaned blobs once the file no longer referencing them is written"""
+        with file_lock(self.path):
+            if file_signature(self.path) != self._signature:
+                self._reload()
+            # Re-check: another writer may have stored the same body again
+            for digest in self._orphans(self.documents, digests):
+                self.blobs.delete(digest)
+
+    @staticmethod
+    def _metadata(doc: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in doc.items() if k not in ('content', 'content_hash', 'derived')}
+
+    def _full(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        full = self._metadata(doc)
+        if 'content_hash' in doc:
+            full['content'] = blob_body(self.blobs, doc['content_hash'], doc.get('id'))
+        else:
+            full['content'] = doc.get('content', '')
+        return full
+
+    def _refresh(self):
+        """Reload the file if another process rewrote it"""
+        if file_signature(self.path) == self._signature:
+            return
+        with file_lock(self.path, shared=True):
+            self._reload()
+
+    def _reload(self):
+        """Read the file; the caller holds the file lock"""
+        signature = file_signature(self.path)
+        if signature is None:
+            self.documents = {}
+        else:
+            with open(self.path, 'r') as f:
+                self.documents = json.load(f)
+        self._signature = signature
+        self._generation += 1
+
+    def _refresh_derived(self):
+        """Reload the side file if another process rewrote it"""
+        if file_signature(self.derived_path) == self._derived_signature:
+            return
+        with file_lock(self.path, shared=True):
+            self._reload_derived()
+
+    def _reload_derived(self):
+        """Read the side file; the caller holds the file lock"""
+        signature = file_signature(self.derived_path)
+        if signature is None:
+            self.derived = {}
+        else:
+            with open(self.derived_path, 'r') as f:
+                self.derived = json.load(f)
+        self._derived_signature = signature
+
+    def _update_derived(self, mutate):
+        """Apply ``mutate(derived)``, writing the side file if it returns True; caller holds the file lock"""
+        if file_signature(self.derived_path) != self._derived_signature:
+            self._reload_derived()
+        if mutate(self.derived):
+            atomic_write_json(self.derived_path, self.derived)
+            self._derived_signature = file_signature(self.derived_path)
+
+    def _drop_derived(self, doc_ids):
+        """Forget derived values of replaced/deleted documents; caller holds the file lock"""
+        def mutate(derived):
+            present = [doc_id for doc_id in doc_ids if doc_id in derived]
+            for doc_id in present:
+                del derived[doc_id]
+            return bool(present)
+        self._update_derived(mutate)
+
+    def _update(self, mutate) -> Any:
+        """Apply ``mutate(documents)`` as an atomic read-modify-write"""
+        with file_lock(self.path):
+            if file_signature(self.path) != self._signature:
+                self._reload()
+            result = mutate(self.documents)
+            atomic_write_json(self.path, self.documents, indent=2)
+            self._signature = file_signature(self.path)
+            return result
+
+    def get(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        self._refresh()
+        doc = self.documents.get(doc_id)
+        return self._full(doc) if doc else None
+
+    def get_metadata(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        self._refresh()
+        doc = self.documents.get(doc_id)
+        return self._metadata(doc) if doc else None
+
+    def put(self, doc: Dict[str, Any]):
+        self.put_many([doc])
+
+    def put_many(self, docs: List[Dict[str, Any]]):
+        def mutate(documents):
+            replaced = []
+            for doc in docs:
+                if doc['id'] in documents:
+                    replaced.append(documents[doc['id']].get('content_hash'))
+                documents[doc['id']] = self._stored(doc)
+            self._drop_derived([doc['id'] for doc in docs])
+            return self._orphans(documents, replaced)
+        orphans = self._update(mutate)
+        if self.blobs and orphans:
+            self._release(orphans)
+
+    def delete(self, doc_id: str) -> bool:
+        def mutate(documents):
+            doc = documents.pop(doc_id, None)
+            if doc is None:
+                return None
+            self._drop_derived([doc_id])
+            return self._orphans(documents, [doc.get('content_hash')])
+        orphans = self._update(mutate)
+        if orphans is None:
+            return False
+        if self.blobs and orphans:
+            self._release(orphans)
+        return True
+
+    def get_attachment(self, doc_id: str, name: str) -> Optional[bytes]:
+        if not self.blobs:
+            return super().get_attachment(doc_id, name)
+        self._refresh()
+        digest = self.documents.get(doc_id, {}).get('content_hash')
+        if not digest:
+            return super().get_attachment(doc_id, name)  # Body still inline
+        return self.blobs.get_companion(digest, name)
+
+    def put_attachments(self, entries: List[Tuple[str, str, bytes]]):
+        if not self.blobs:
+            return super().put_attachments(entries)
+        self._refresh()
+        inline = []
+        for doc_id, name, data in entries:
+            digest = self.documents.get(doc_id, {}).get('content_hash')
+            if digest:
+                self.blobs.put_companion(digest, name, data)
+            else:
+                inline.append((doc_id, name, data))
+        if inline:
+            super().put_attachments(inline)
+
+    def get_derived(self, doc_id: str, key: str) -> Optional[Any]:
+        self._refresh()
+        if doc_id not in self.documents:
+            return None
+        self._refresh_derived()
+        return self.derived.get(doc_id, {}).get(key)
+
+    def put_derived(self, entries: List[Tuple[str, str, Any]]):
+        with file_lock(self.path):
+            if file_signature(self.path) != self._signature:
+                self._reload()
+
+            def mutate(derived):
+                stored = False
+                for doc_id, key, value in entries:
+                    if doc_id in self.documents:
+                        derived.setdefault(doc_id, {})[key] = value
+                        stored = True
+                return stored
+            self._update_derived(mutate)
+
+    def delete_derived(self, patterns: List[str]) -> int:
+        dropped = 0
+
+        def mutate(derived):
+            nonlocal dropped
+            for values in derived.values():
+                for key in [key for key in values if any(fnmatch.fnmatchcase(key, p) for p in patterns)]:
+                    del values[key]
+                    dropped += 1
+            return dropped > 0
+        with file_lock(self.path):
+            self._update_derived(mutate)
+        return dropped
+
+    def list_metadata(self) -> List[Dict[str, Any]]:
+        self._refresh()
+        return [self._metadata(doc) for doc in self.documents.values()]
+
+    def iter_documents(self) -> Iterator[Dict[str, Any]]:
+        self._refresh()
+        for doc in list(self.documents.values()):
+            yield self._full(doc)
+
+    def count(self) -> int:
+        self._refresh()
+        return len(self.documents)
+
+    def change_seq(self) -> int:
+        self._refresh()
+        return self._generation
+
+    def changes_since(self, seq: int) -> Optional[Tuple[int, List[Tuple[str, str]]]]:
+        # The whole file is the unit of change, so any change means a reload
+        return (seq, []) if self.change_seq() == seq else None
+
+
+class SQLiteDocumentStore(DocumentStore):
+    """
+    SQLite backend in WAL mode; each document is a single row
+
+    With a BlobStore the row keeps only metadata and ``content_hash``, and
+    the body is read from its blob when a caller asks for content. Blobs
+    are written before the rows that reference them, and orphaned blobs
+    are deleted only after the transaction that dropped their last row has
+    committed, so a committed row never points at a missing blob.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS documents (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            text_length INTEGER NOT NULL DEFAULT 0,
+            pages INTEGER NOT NULL DEFAULT 1,
+            file_path TEXT,
+            extra TEXT NOT NULL DEFAULT '{}',
+            content TEXT NOT NULL DEFAULT '',
+            content_hash TEXT
+        );
+        CREATE TABLE IF NOT EXISTS derived (
+            doc_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (doc_id, key)
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            doc_id TEXT NOT NULL,
+            op TEXT NOT NULL
+        );
+    """
+
+    # Change-log entries kept for workers catching up
+    CHANGE_LOG_SIZE = 10000
+
+    def __init__(self, path: str = 'documents.db', blobs: Optional[BlobStore] = None):
+        self.path = path
+        self.blobs = blobs
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(documents)')}
+            if 'content_hash' not in columns:
+                conn.execute('ALTER TABLE documents ADD COLUMN content_hash TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS documents_content_hash ON documents(content_hash)')
+            for field in SORT_FIELDS:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS documents_{field} ON documents({field}, id)')
+        if blobs:
+            self._externalize()
+
+    def _externalize(self, batch_size: int = 100):
+        """Move inline bodies (rows written before blobs were enabled) into blobs"""
+        conn = self._connect()
+        while True:
+            rows = conn.execute(
+                'SELECT id, content FROM documents WHERE content_hash IS NULL LIMIT ?', (batch_size,)
+            ).fetchall()
+            if not rows:
+                return
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                for row in rows:
+                    conn.execute(
+                        "UPDATE documents SET content = '', content_hash = ? "
+                        "WHERE id = ? AND content_hash IS NULL",
+                        (self.blobs.put(row['content']), row['id'])
+                    )
+
+    def _body(self, row: sqlite3.Row) -> str:
+        """Document body from the row or its blob"""
+        if row['content_hash'] is None:
+            return row['content']
+        return blob_body(self.blobs, row['content_hash'], row['id'])
+
+    @staticmethod
+    def _orphans(conn: sqlite3.Connection, digests) -> set:
+        """Digests no row references any more (inside the write transaction)"""
+        return {
+            digest for digest in set(digests)
+            if digest and not conn.execute(
+                'SELECT 1 FROM documents WHERE content_hash = ? LIMIT 1', (digest,)
+            ).fetchone()
+        }
+
+    def _release(self, digests):
+        """Delete orphaned blobs once the transaction has committed"""
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            # Re-check under the write lock: another writer may have stored
+            # the same body again since our commit
+            for digest in self._orphans(conn, digests):
+                self.blobs.delete(digest)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = open_sqlite(self.path)
+        return conn
+
+    def _to_row(self, doc: Dict[str, Any]) -> tuple:
+        """Row values; writes the body to its blob when blobs are enabled"""
+        extra = {k: v for k, v in doc.items() if k not in METADATA_FIELDS and k != 'content'}
+        content = doc.get('content', '')
+        content_hash = None
+        if self.blobs:
+            content_hash = self.blobs.put(content)
+            content = ''
+        return (
+            doc['id'],
+            doc.get('filename', ''),
+            doc.get('created_at', ''),
+            doc.get('text_length', 0),
+            doc.get('pages', 1),
+            doc.get('file_path'),
+            json.dumps(extra),
+            content,
+            content_hash,
+        )
+
+    @staticmethod
+    def _from_row(row: sqlite3.Row, with_content: bool = True) -> Dict[str, Any]:
+        doc = {field: row[field] for field in METADATA_FIELDS}
+        doc.update(json.loads(row['extra']))
+        if with_content:
+            doc['content'] = row['content']
+        return doc
+
+    def get(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            'SELECT * FROM documents WHERE id = ?', (doc_id,)
+        ).fetchone()
+        if not row:
+            return None
+        doc = self._from_row(row, with_content=False)
+        doc['content'] = self._body(row)
+        return doc
+
+    def get_content(self, doc_id: str) -> Optional[str]:
+        row = self._connect().execute(
+            'SELECT id, content, content_hash FROM documents WHERE id = ?', (doc_id,)
+        ).fetchone()
+        return self._body(row) if row else None
+
+    def read_content_range(self, doc_id: str, start: int, end: int) -> Optional[Tuple[str, int]]:
+        row = self._connect().execute(
+            'SELECT id, substr(content, ?, ?) AS content, content_hash, text_length FROM documents WHERE id = ?',
+            (start + 1, end - start, doc_id)
+        ).fetchone()
+        if not row:
+            return None
+        if row['content_hash'] is None:
+            return row['content'], row['text_length']
+        # Compressed blobs cannot be read at a character offset; the blob
+        # store's decoded-body cache makes every window after the first a slice
+        content = self._body(row)
+        return content[start:end], len(content)
+
+    def put(self, doc: Dict[str, Any]):
+        self.put_many([doc])
+
+    def _log(self, conn: sqlite3.Connection, doc_ids: List[str], op: str):
+        """Record writes in the change log inside the writing transaction"""
+        conn.executemany(
+            'INSERT INTO changes (doc_id, op) VALUES (?, ?)', [(doc_id, op) for doc_id in doc_ids]
+        )
+        conn.execute(
+            'DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?',
+            (self.CHANGE_LOG_SIZE,)
+        )
+
+    def put_many(self, docs: List[Dict[str, Any]]):
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            ids = [doc['id'] for doc in docs]
+            replaced = [
+                row[0] for row in conn.execute(
+                    f'SELECT content_hash FROM documents WHERE id IN ({",".join("?" * len(ids))})', ids
+                )
+            ]
+            conn.executemany(
+                'INSERT OR REPLACE INTO documents '
+                '(id, filename, created_at, text_length, pages, file_path, extra, content, content_hash) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [self._to_row(doc) for doc in docs]
+            )
+            conn.execute(f'DELETE FROM derived WHERE doc_id IN ({",".join("?" * len(ids))})', ids)
+            orphans = self._orphans(conn, replaced) if self.blobs else set()
+            self._log(conn, ids, 'put')
+        if orphans:
+            self._release(orphans)
+
+    def delete(self, doc_id: str) -> bool:
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT content_hash FROM documents WHERE id = ?', (doc_id,)).fetchone()
+            if row is None:
+                return False
+            conn.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
+            conn.execute('DELETE FROM derived WHERE doc_id = ?', (doc_id,))
+            orphans = self._orphans(conn, [row['content_hash']]) if self.blobs else set()
+            self._log(conn, [doc_id], 'delete')
+        if orphans:
+            self._release(orphans)
+        return True
+
+    def get_metadata(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            'SELECT id, filename, created_at, text_length, pages, file_path, extra '
+            'FROM documents WHERE id = ?', (doc_id,)
+        ).fetchone()
+        return self._from_row(row, with_content=False) if row else None
+
+    def get_derived(self, doc_id: str, key: str) -> Optional[Any]:
+        row = self._connect().execute(
+            'SELECT value FROM derived WHERE doc_id = ? AND key = ?', (doc_id, key)
+        ).fetchone()
+        return json.loads(row['value']) if row else None
+
+    def put_derived(self, entries: List[Tuple[str, str, Any]]):
+        with self._connect() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO derived (doc_id, key, value) '
+                'SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM documents WHERE id = ?)',
+                [(doc_id, key, json.dumps(value), doc_id) for doc_id, key, value in entries]
+            )
+
+    def _content_hash(self, doc_id: str) -> Optional[str]:
+        row = self._connect().execute('SELECT content_hash FROM documents WHERE id = ?', (doc_id,)).fetchone()
+        return row['content_hash'] if row else None
+
+    def get_attachment(self, doc_id: str, name: str) -> Optional[bytes]:
+        if not self.blobs:
+            return super().get_attachment(doc_id, name)
+        digest = self._content_hash(doc_id)
+        if not digest:
+            return super().get_attachment(doc_id, name)  # Body still inline
+        return self.blobs.get_companion(digest, name)
+
+    def put_attachments(self, entries: List[Tuple[str, str, bytes]]):
+        if not self.blobs:
+            return super().put_attachments(entries)
+        inline = []
+        for doc_id, name, data in entries:
+            digest = self._content_hash(doc_id)
+            if digest:
+                self.blobs.put_companion(digest, name, data)
+            else:
+                inline.append((doc_id, name, data))
+        if inline:
+            super().put_attachments(inline)
+
+    def delete_derived(self, patterns: List[str]) -> int:
+        # GLOB has the same wildcards as fnmatch and is case-sensitive
+        with self._connect() as conn:
+            return sum(
+                conn.execute('DELETE FROM derived WHERE key GLOB ?', (pattern,)).rowcount
+                for pattern in patterns
+            )
+
+    def change_seq(self) -> int:
+        return self._connect().execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+
+    def changes_since(self, seq: int) -> Optional[Tuple[int, List[Tuple[str, str]]]]:
+        conn = self._connect()
+        oldest = conn.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+        if oldest is not None and oldest > seq + 1:
+            return None
+        rows = conn.execute(
+            'SELECT seq, doc_id, op FROM changes WHERE seq > ? ORDER BY seq', (seq,)
+        ).fetchall()
+        if not rows:
+            return seq, []
+        return rows[-1]['seq'], [(row['doc_id'], row['op']) for row in rows]
+
+    def list_metadata(self) -> List[Dict[str, Any]]:
+        rows = self._connect().execute(
+            'SELECT id, filename, created_at, text_length, pages, file_path, extra '
+            'FROM documents ORDER BY created_at'
+        ).fetchall()
+        return [self._from_row(row, with_content=False) for row in rows]
+
+    def iter_documents(self) -> Iterator[Dict[str, Any]]:
+        for row in self._connect().execute('SELECT * FROM documents ORDER BY created_at'):
+            doc = self._from_row(row, with_content=False)
+            doc['content'] = self._body(row)
+            yield doc
+
+    def count(self) -> int:
+        return self._connect().execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    @staticmethod
+    def _where(filters: Optional[Dict[str, Any]]) -> Tuple[List[str], List[Any]]:
+        """SQL conditions equivalent to metadata_matches"""
+        clauses, params = [], []
+        filters = filters or {}
+        if filters.get('filename'):
+            clauses.append('instr(filename, ?) > 0')
+            params.append(filters['filename'])
+        if filters.get('min_length'):
+            clauses.append('text_length >= ?')
+            params.append(filters['min_length'])
+        if filters.get('max_length'):
+            clauses.append('text_length <= ?')
+            params.append(filters['max_length'])
+        return clauses, params
+
+    def page_metadata(self, sort: str = 'created_at', descending: bool = False,
+                      after: Optional[Tuple[Any, str]] = None, limit: int = 50,
+                      filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        # Keyset pagination: the (sort, id) index is walked from the cursor,
+        # so a page costs the same wherever it is in the listing
+        if sort not in SORT_FIELDS:
+            raise ValueError(f'Cannot sort by {sort}')
+        clauses, params = self._where(filters)
+        if after is not None:
+            clauses.append(f'({sort}, id) {"<" if descending else ">"} (?, ?)')
+            params.extend(after)
+        where = f'WHERE {" AND ".join(clauses)} ' if clauses else ''
+        direction = 'DESC' if descending else 'ASC'
+        rows = self._connect().execute(
+            'SELECT id, filename, created_at, text_length, pages, file_path, extra '
+            f'FROM documents {where}ORDER BY {sort} {direction}, id {direction} LIMIT ?',
+            (*params, limit)
+        ).fetchall()
+        return [self._from_row(row, with_content=False) for row in rows]
+
+    def count_matching(self, filters: Optional[Dict[str, Any]] = None) -> int:
+        clauses, params = self._where(filters)
+        where = f' WHERE {" AND ".join(clauses)}' if clauses else ''
+        return self._connect().execute(f'SELECT COUNT(*) FROM documents{where}', params).fetchone()[0]
+
+
+def migrate_json_store(json_path: str, store: DocumentStore) -> int:
+    """
+    One-time import of a legacy documents.json into another store
+
+    The JSON file is renamed to ``<name>.migrated`` afterwards so the import
+    never runs twice.
+
+    Returns:
+        Number of documents imported
+    """
+    if isinstance(store, JSONDocumentStore) or not os.path.exists(json_path):
+        return 0
+
+    with open(json_path, 'r') as f:
+        documents = json.load(f)
+
+    # Derived values inlined by older versions are recomputed, not imported
+    store.put_many([{k: v for k, v in doc.items() if k != 'derived'} for doc in documents.values()])
+    os.replace(json_path, json_path + '.migrated')
+    return len(documents)
+
+
+def create_document_store(backend: Optional[str] = None,
+                          path: Optional[str] = None,
+                          legacy_json: str = 'documents.json') -> DocumentStore:
+    """
+    Build the configured document store
+
+    Document bodies are kept in a BlobStore (DOCUMENT_BLOB_DIR) for both
+    backends; existing inline bodies are moved there on first start.
+
+    Args:
+        backend: 'sqlite' (default) or 'json'; falls back to DOCUMENT_STORE_BACKEND
+        path: Database/file path; falls back to DOCUMENT_STORE_PATH
+        legacy_json: documents.json to migrate into a non-JSON backend
+
+    Returns:
+        Ready-to-use DocumentStore
+    """
+    backend = (backend or os.getenv('DOCUMENT_STORE_BACKEND', 'sqlite')).lower()
+
+    if backend == 'json':
+        return JSONDocumentStore(path or os.getenv('DOCUMENT_STORE_PATH', legacy_json), BlobStore())
+    if backend == 'sqlite':
+        store = SQLiteDocumentStore(path or os.getenv('DOCUMENT_STORE_PATH', 'documents.db'), BlobStore())
+        migrate_json_store(legacy_json, store)
+        return store
+
+    raise ValueError(f'Unknown document store backend: {backend}')
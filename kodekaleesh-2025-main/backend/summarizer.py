@@ -1,28 +1,73 @@
-from typing import Optional
+import heapq
+import math
+from collections import Counter
+from itertools import chain
+from typing import Dict, List, Optional
+
+from text_analysis import AnalyzedText, important_words
+
+# NumPy is optional - without it the sparse products run as Python loops,
+# which TextRank only attempts for documents up to PYTHON_TEXTRANK_MAX_ENTRIES
+NUMPY_AVAILABLE = False
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    pass
+
+SUMMARY_MODES = ('frequency', 'tfidf', 'textrank')
+# Modes weighting words by corpus IDF, so their output changes with the index
+CORPUS_MODES = ('tfidf', 'textrank')
+# TextRank damping factor and power-iteration limits
+DAMPING = 0.85
+MAX_ITERATIONS = 50
+TOLERANCE = 1e-6
+# (sentence, distinct word) entries the pure-Python TextRank accepts; each
+# iteration makes two passes over them, so this keeps a request to about half a second
+PYTHON_TEXTRANK_MAX_ENTRIES = 50000
+
+
+class SummaryModeUnavailable(ValueError):
+    """Raised when a summarization mode cannot handle a document in this installation"""
+
 
 class DocumentSummarizer:
-    """Summarize legal documents"""
+    """
+    Summarize legal documents
     
-    def __init__(self):
-        pass
+    Modes:
+        frequency: Sentences sharing the document's most frequent words
+        tfidf: Words weighted by in-document frequency and corpus IDF
+            (document frequencies from the search index when one is given),
+            normalised by sentence length so long sentences are not favoured
+        textrank: PageRank over the cosine-similarity graph of TF-IDF
+            sentence vectors; without NumPy only documents up to
+            PYTHON_TEXTRANK_MAX_ENTRIES (sentence, word) entries are accepted
+    """
     
-    def summarize(self, text: str, max_length: int = 500) -> str:
-        """Generate a summary of document text"""
+    def __init__(self, index=None):
+        # Optional SearchIndex supplying corpus document frequencies
+        self.index = index
+    
+    def summarize(self, text: str, max_length: int = 500, mode: str = 'frequency',
+                  analysis: Optional[AnalyzedText] = None) -> str:
+        """
+        Generate a summary of document text
+        
+        Args:
+            text: Document text
+            max_length: Summaries longer than this are cut with '...'
+            mode: One of SUMMARY_MODES
+            analysis: Stored AnalyzedText of ``text``, saves tokenizing it again
+        """
         if len(text) <= max_length:
             return text
         
         # Simple extractive summarization
-        sentences = self._split_sentences(text)
-        
-        # Score sentences based on keyword frequency
-        scores = self._score_sentences(sentences, text)
+        sentences, scores = self._analyze(text, mode, analysis)
         
         # Select top sentences
-        top_sentences = sorted(
-            enumerate(sentences),
-            key=lambda x: scores.get(x[0], 0),
-            reverse=True
-        )[:3]
+        top_sentences = heapq.nlargest(3, enumerate(sentences), key=lambda x: scores.get(x[0], 0))
         
         # Sort by original order
         summary_sentences = sorted(top_sentences, key=lambda x: x[0])
@@ -34,37 +79,154 @@ class DocumentSummarizer:
         
         return summary
     
-    def _split_sentences(self, text: str) -> list:
-        """Split text into sentences"""
-        import re
-        # Simple sentence splitter
-        sentences = re.split(r'(?<=[.!?])\s+', text)
-        return [s.strip() for s in sentences if s.strip()]
+    def _analyze(self, text: str, mode: str, analysis: Optional[AnalyzedText] = None):
+        """Sentences of ``text`` and their scores, tokenizing only if no analysis is given"""
+        analysis = analysis or AnalyzedText.analyze(text)
+        return analysis.sentence_texts(text), self._score_words(analysis.sentence_words(), mode)
+    
+    def _score_sentences(self, sentences: list, text: Optional[str] = None, mode: str = 'frequency') -> dict:
+        """Score sentences with one of SUMMARY_MODES"""
+        return self._score_words([important_words(sentence) for sentence in sentences], mode)
+    
+    def _score_words(self, tokenized: List[list], mode: str = 'frequency') -> dict:
+        """
+        Score sentences, given the content words of each
+        
+        In 'frequency' mode a sentence scores the document frequency
+        (relative to the most frequent word) of each distinct word it
+        contains. Runs in time linear in the text.
+        """
+        if mode not in SUMMARY_MODES:
+            raise ValueError(f'mode must be one of {", ".join(SUMMARY_MODES)}')
+        if mode == 'tfidf':
+            return self._score_tfidf(tokenized)
+        if mode == 'textrank':
+            return self._score_textrank(tokenized)
+        
+        tokenized = [set(words) for words in tokenized]
+        frequencies = Counter(chain.from_iterable(tokenized))
+        if not frequencies:
+            return {i: 0 for i in range(len(tokenized))}
+        
+        top = max(frequencies.values())
+        return {
+            i: sum(map(frequencies.__getitem__, words)) / top
+            for i, words in enumerate(tokenized)
+        }
     
-    def _score_sentences(self, sentences: list, text: str) -> dict:
-        """Score sentences based on keyword frequency"""
-        # Get important words
-        words = text.lower().split()
-        stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'is', 'are', 'was', 'were', 'be', 'been', 'being'}
+    def _idf(self, tokenized: List[list]) -> Dict[str, float]:
+        """
+        Smoothed IDF of every word in the document
         
-        important_words = set(w.strip('.,;:!?"\'') for w in words if w.lower() not in stop_words and len(w) > 3)
+        Uses corpus document frequencies from the search index; without an
+        index (or an empty one) the sentences stand in for documents.
+        """
+        vocabulary = {word for words in tokenized for word in words}
+        total = self.index.count() if self.index is not None else 0
+        if total:
+            frequencies = self.index.document_frequencies(vocabulary)
+        else:
+            total = len(tokenized)
+            frequencies = Counter(word for words in tokenized for word in set(words))
+        return {word: math.log((1 + total) / (1 + frequencies.get(word, 0))) + 1 for word in vocabulary}
+    
+    def _score_tfidf(self, tokenized: List[list]) -> dict:
+        """Sum of TF-IDF word weights per sentence, divided by sqrt(sentence length)"""
+        idf = self._idf(tokenized)
+        tf = Counter(chain.from_iterable(tokenized))
+        weight = {word: tf[word] * idf[word] for word in tf}
+        return {
+            i: sum(weight[word] for word in words) / math.sqrt(len(words)) if words else 0
+            for i, words in enumerate(tokenized)
+        }
+    
+    def _score_textrank(self, tokenized: List[list]) -> dict:
+        """
+        TextRank scores from power iteration over the sentence graph
         
-        scores = {}
-        for i, sentence in enumerate(sentences):
-            score = sum(1 for word in important_words if word in sentence.lower())
-            scores[i] = score
+        Sentences are unit TF-IDF vectors (rows of a sparse matrix X). The
+        similarity graph X X^T is never built: each iteration applies it as
+        X (X^T v), so the cost per iteration is linear in the number of
+        (sentence, word) entries rather than quadratic in sentences.
+        """
+        n = len(tokenized)
+        idf = self._idf(tokenized)
+        columns: Dict[str, int] = {}
+        rows, cols, values = [], [], []
+        for i, words in enumerate(tokenized):
+            counts = Counter(words)
+            weights = {word: count * idf[word] for word, count in counts.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values()))
+            for word, w in weights.items():
+                rows.append(i)
+                cols.append(columns.setdefault(word, len(columns)))
+                values.append(w / norm)
+        if not values:
+            return {i: 0 for i in range(n)}
+        if not NUMPY_AVAILABLE and len(values) > PYTHON_TEXTRANK_MAX_ENTRIES:
+            raise SummaryModeUnavailable(
+                'Document too large for mode=textrank without NumPy (pip install numpy); use tfidf or frequency'
+            )
         
-        return scores
+        ranks = (_textrank_numpy if NUMPY_AVAILABLE else _textrank_python)(n, len(columns), rows, cols, values)
+        return {i: rank for i, rank in enumerate(ranks)}
     
-    def extract_key_points(self, text: str, num_points: int = 5) -> list:
+    def extract_key_points(self, text: str, num_points: int = 5, mode: str = 'frequency',
+                           analysis: Optional[AnalyzedText] = None) -> list:
         """Extract key points from document"""
-        sentences = self._split_sentences(text)
-        scores = self._score_sentences(sentences, text)
+        sentences, scores = self._analyze(text, mode, analysis)
         
-        top_sentences = sorted(
-            enumerate(sentences),
-            key=lambda x: scores.get(x[0], 0),
-            reverse=True
-        )[:num_points]
+        top_sentences = heapq.nlargest(num_points, enumerate(sentences), key=lambda x: scores.get(x[0], 0))
         
         return [s[1] for s in sorted(top_sentences, key=lambda x: x[0])]
+
+
+def _textrank_numpy(n: int, vocabulary: int, rows: list, cols: list, values: list) -> list:
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    has_words = np.bincount(rows, minlength=n) > 0
+
+    def similarity(v):
+        # (X X^T - I) v over non-empty sentences: unit rows make the self-similarity 1
+        projected = np.bincount(cols, weights=values * v[rows], minlength=vocabulary)
+        return np.bincount(rows, weights=values * projected[cols], minlength=n) - v * has_words
+
+    degree = similarity(np.ones(n))
+    inverse_degree = np.divide(1.0, degree, out=np.zeros(n), where=degree > 1e-12)
+    ranks = np.full(n, 1.0 / n)
+    for _ in range(MAX_ITERATIONS):
+        updated = (1 - DAMPING) / n + DAMPING * similarity(ranks * inverse_degree)
+        converged = np.abs(updated - ranks).sum() < TOLERANCE
+        ranks = updated
+        if converged:
+            break
+    return ranks.tolist()
+
+
+def _textrank_python(n: int, vocabulary: int, rows: list, cols: list, values: list) -> list:
+    entries = list(zip(rows, cols, values))
+    has_words = [0.0] * n
+    for row in rows:
+        has_words[row] = 1.0
+
+    def similarity(v):
+        projected = [0.0] * vocabulary
+        for row, col, value in entries:
+            projected[col] += value * v[row]
+        result = [-v[i] * has_words[i] for i in range(n)]
+        for row, col, value in entries:
+            result[row] += value * projected[col]
+        return result
+
+    degree = similarity([1.0] * n)
+    inverse_degree = [1.0 / d if d > 1e-12 else 0.0 for d in degree]
+    ranks = [1.0 / n] * n
+    for _ in range(MAX_ITERATIONS):
+        spread = similarity([r * w for r, w in zip(ranks, inverse_degree)])
+        updated = [(1 - DAMPING) / n + DAMPING * s for s in spread]
+        converged = sum(abs(a - b) for a, b in zip(updated, ranks)) < TOLERANCE
+        ranks = updated
+        if converged:
+            break
+    return ranks
@@ -1,17 +1,31 @@
 import pytest
 import json
 import os
+import sqlite3
 import sys
+from collections import Counter
 from pathlib import Path
 
 # Add backend directory to path
 sys.path.insert(0, str(Path(__file__).parent))
 
 from app import app
+import document_processor
 from document_processor import DocumentProcessor
 from search_engine import SearchEngine
-from summarizer import DocumentSummarizer
-from ocr_processor import OCRProcessor
+import summarizer as summarizer_module
+from summarizer import DocumentSummarizer, SUMMARY_MODES
+from ocr_processor import OCRProcessor, tsv_to_dict
+from ocr_cache import OCRResultCache
+import image_preprocessing
+from storage import SQLiteDocumentStore, JSONDocumentStore, migrate_json_store
+from search_index import SearchIndex
+from text_analysis import AnalyzedText, ANALYSIS_VERSION, query_terms
+from cache import LRUCache
+from blob_store import BlobStore, ZSTD_AVAILABLE
+from jobs import JobQueue, QueueFullError
+from query_parser import QuerySyntaxError
+from document_extractors import PYPDF_AVAILABLE, ExtractionError
 
 
 @pytest.fixture
@@ -337,6 +351,592 @@ class TestDocumentProcessor:
         assert doc is None
 
 
+class TestDocumentStore:
+    """Test document storage backends"""
+    
+    def _doc(self, doc_id, content='Sample contract text'):
+        return {
+            'id': doc_id,
+            'filename': f'{doc_id}.txt',
+            'content': content,
+            'created_at': '2025-01-01T00:00:00',
+            'pages': 1,
+            'text_length': len(content),
+            'file_path': None,
+            'source_type': 'ocr_image'
+        }
+    
+    def test_sqlite_roundtrip(self, tmp_path):
+        """Test a document survives put/get with extra fields intact"""
+        store = SQLiteDocumentStore(str(tmp_path / 'docs.db'))
+        store.put(self._doc('a1'))
+        doc = store.get('a1')
+        assert doc['content'] == 'Sample contract text'
+        assert doc['source_type'] == 'ocr_image'
+        assert 'content' not in store.list_metadata()[0]
+    
+    def test_sqlite_delete(self, tmp_path):
+        """Test deleting removes exactly one document"""
+        store = SQLiteDocumentStore(str(tmp_path / 'docs.db'))
+        store.put_many([self._doc('a1'), self._doc('a2')])
+        assert store.delete('a1') is True
+        assert store.delete('a1') is False
+        assert store.count() == 1
+    
+    def test_migrate_from_json(self, tmp_path):
+        """Test legacy documents.json is imported once"""
+        json_path = tmp_path / 'documents.json'
+        json_path.write_text(json.dumps({'a1': self._doc('a1')}))
+        store = SQLiteDocumentStore(str(tmp_path / 'docs.db'))
+        assert migrate_json_store(str(json_path), store) == 1
+        assert store.get('a1') is not None
+        assert not json_path.exists()
+        assert migrate_json_store(str(json_path), store) == 0
+    
+    def test_store_documents_batch(self, tmp_path):
+        """Test a batch is stored and indexed together"""
+        proc = DocumentProcessor(SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+                                 SearchIndex(str(tmp_path / 'index.db')))
+        docs = []
+        for i in range(3):
+            path = tmp_path / f'page{i}.txt'
+            path.write_text(f'Exhibit {i} annexure')
+            docs.append(proc.build_document(str(path), path.name))
+        assert proc.list_documents() == []
+        proc.store_documents(docs)
+        assert len(proc.list_documents()) == 3
+        assert proc.index.count() == 3
+        assert proc.store.change_seq() == 3
+    
+    def test_processor_with_json_backend(self, tmp_path):
+        """Test processor works with the legacy JSON backend"""
+        source = tmp_path / 'note.txt'
+        source.write_text('Section 12 applies')
+        proc = DocumentProcessor(JSONDocumentStore(str(tmp_path / 'documents.json')),
+                                 SearchIndex(str(tmp_path / 'index.db')))
+        doc = proc.process(str(source), 'note.txt')
+        assert proc.get_document(doc['id'])['content'] == 'Section 12 applies'
+        assert proc.delete_document(doc['id']) is True
+    
+    def _paged_processor(self, store, tmp_path):
+        proc = DocumentProcessor(store, SearchIndex(str(tmp_path / 'index.db')))
+        docs = []
+        for i, name in enumerate(['lease', 'deed', 'will', 'bond', 'lease-2']):
+            doc = self._doc(f'd{i}', 'x' * (10 * (i + 1)))
+            doc.update(filename=f'{name}.txt', created_at=f'2025-01-0{i + 1}T00:00:00')
+            docs.append(doc)
+        proc.store_documents(docs)
+        return proc
+    
+    @pytest.mark.parametrize('backend', ['sqlite', 'json'])
+    def test_page_documents_cursor(self, tmp_path, backend):
+        """Pages follow the cursor without gaps or repeats, in either backend"""
+        store = (SQLiteDocumentStore(str(tmp_path / 'docs.db')) if backend == 'sqlite'
+                 else JSONDocumentStore(str(tmp_path / 'documents.json')))
+        proc = self._paged_processor(store, tmp_path)
+        
+        seen, cursor = [], None
+        while True:
+            page = proc.page_documents(limit=2, cursor=cursor, sort='text_length', descending=True)
+            assert page['total'] == 5
+            seen.extend(doc['id'] for doc in page['documents'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        assert seen == ['d4', 'd3', 'd2', 'd1', 'd0']
+        
+        page = proc.page_documents(sort='filename', filters={'filename': 'lease', 'min_length': 20},
+                                   fields=['filename'])
+        assert page['documents'] == [{'id': 'd4', 'filename': 'lease-2.txt'}]
+        assert page['total'] == 1
+        with pytest.raises(ValueError):
+            proc.page_documents(cursor=cursor or 'bogus', sort='filename')
+    
+    def test_page_documents_uses_sort_index(self, tmp_path):
+        """SQLite listings walk the (key, id) index instead of sorting a scan"""
+        store = SQLiteDocumentStore(str(tmp_path / 'docs.db'))
+        plan = store._connect().execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM documents WHERE (filename, id) > (?, ?) '
+            'ORDER BY filename, id LIMIT 10', ('a', 'b')
+        ).fetchall()
+        details = ' '.join(row['detail'] for row in plan)
+        assert 'documents_filename' in details
+        assert 'TEMP B-TREE' not in details
+    
+    @pytest.mark.parametrize('backend', ['sqlite', 'json'])
+    def test_summaries_stored_with_document(self, tmp_path, backend):
+        """Summaries are computed at ingest, served from the store and dropped on delete"""
+        store = (SQLiteDocumentStore(str(tmp_path / 'docs.db')) if backend == 'sqlite'
+                 else JSONDocumentStore(str(tmp_path / 'documents.json')))
+        proc = DocumentProcessor(store, SearchIndex(str(tmp_path / 'index.db')))
+        text = ' '.join(f'Clause {i} obliges the tenant to pay rent.' for i in range(100))
+        doc = self._doc('a1', text)
+        proc.store_documents([doc])
+        
+        cached = store.get_derived('a1', 'summary:frequency:500')
+        assert cached['summary'] == proc.summarizer.summarize(text, max_length=500)
+        assert len(store.get_derived('a1', 'key_points:frequency')['key_points']) == 5
+        
+        store.put_derived([('a1', 'summary:frequency:500', {**cached, 'summary': 'Stored summary'})])
+        result = proc.summarize_document('a1', max_length=300)
+        assert result['summary'] == 'Stored summary'
+        assert result['original_length'] == len(text)
+        assert proc.summarize_document('a1', max_length=100)['summary'] == proc.summarizer.summarize(text, max_length=100)
+        assert store.get_derived('a1', 'summary:frequency:250') is not None
+
+        tfidf = proc.summarize_document('a1', mode='tfidf')
+        assert store.get_derived('a1', 'summary:tfidf:500')['corpus'] == proc.index.generation()
+        stored = store.get_derived('a1', 'summary:tfidf:500')
+        store.put_derived([('a1', 'summary:tfidf:500', {**stored, 'summary': 'Cached'})])
+        assert proc.summarize_document('a1', mode='tfidf')['summary'] == 'Cached'
+        # A record from an older tokenization is recomputed
+        store.put_derived([('a1', 'summary:tfidf:500', {**stored, 'analysis': 0, 'summary': 'Cached'})])
+        assert proc.summarize_document('a1', mode='tfidf')['summary'] == tfidf['summary']
+        proc.store_documents([self._doc('b1', 'Unrelated deed of gift. ' * 30)])
+        assert proc.summarize_document('a1', mode='tfidf')['summary'] == tfidf['summary']
+        
+        proc.delete_document('a1')
+        assert store.get_derived('a1', 'summary:frequency:500') is None
+        store.put_derived([('a1', 'key_points:frequency', [])])
+        assert store.get_derived('a1', 'key_points:frequency') is None
+        assert proc.summarize_document('a1') is None
+    
+    def test_json_derived_values_in_side_file(self, tmp_path):
+        """Caching a summary never rewrites documents.json; legacy keys are dropped"""
+        json_path = tmp_path / 'documents.json'
+        legacy = dict(self._doc('a1'), derived={'summary:500': 'old', 'key_points': ['old'],
+                                                'summary:frequency:500': 'kept'})
+        json_path.write_text(json.dumps({'a1': legacy}))
+        store = JSONDocumentStore(str(json_path))
+        assert 'derived' not in json_path.read_text()
+        
+        DocumentProcessor(store, SearchIndex(str(tmp_path / 'index.db')))
+        assert store.get_derived('a1', 'summary:500') is None
+        assert store.get_derived('a1', 'key_points') is None
+        assert store.get_derived('a1', 'summary:frequency:500') == 'kept'
+        
+        signature = os.stat(json_path).st_mtime_ns
+        store.put_derived([('a1', 'key_points:frequency', ['Clause 1'])])
+        assert os.stat(json_path).st_mtime_ns == signature
+        assert JSONDocumentStore(str(json_path)).get_derived('a1', 'key_points:frequency') == ['Clause 1']
+    
+    def test_json_reload_when_replaced_with_same_mtime(self, tmp_path):
+        """A same-size rewrite within the mtime granularity is still seen by other processes"""
+        json_path = tmp_path / 'documents.json'
+        reader = JSONDocumentStore(str(json_path))
+        writer = JSONDocumentStore(str(json_path))
+        writer.put_many([self._doc('a1', 'Sample contract text')])
+        assert reader.get('a1')['content'] == 'Sample contract text'
+        
+        stat = os.stat(json_path)
+        writer.put_many([self._doc('a1', 'Sample contract TEXT')])
+        os.utime(json_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert os.path.getsize(json_path) == stat.st_size
+        assert reader.get('a1')['content'] == 'Sample contract TEXT'
+    
+    def test_sqlite_bodies_in_shared_blobs(self, tmp_path):
+        """Bodies live in content-addressed blobs shared by identical documents"""
+        blobs = BlobStore(str(tmp_path / 'blobs'))
+        store = SQLiteDocumentStore(str(tmp_path / 'docs.db'), blobs)
+        store.put_many([self._doc('a1'), self._doc('a2'), self._doc('b1', 'Other text')])
+        digest = blobs.digest('Sample contract text')
+        assert blobs.get(digest) == 'Sample contract text'
+        assert store.get_content('a2') == 'Sample contract text'
+        assert store.read_content_range('a1', 7, 15) == ('contract', 20)
+        
+        store.delete('a1')
+        assert blobs.get(digest) is not None
+        store.delete('a2')
+        assert blobs.get(digest) is None
+        store.put(self._doc('b1', 'Replaced text'))
+        assert blobs.get(blobs.digest('Other text')) is None
+    
+    def test_blobs_kept_when_commit_fails(self, tmp_path, monkeypatch, caplog):
+        """A rolled-back replace keeps the old blob; a missing blob is logged"""
+        blobs = BlobStore(str(tmp_path / 'blobs'))
+        store = SQLiteDocumentStore(str(tmp_path / 'docs.db'), blobs)
+        store.put(self._doc('a1'))
+        
+        def fail(*args):
+            raise sqlite3.OperationalError('disk I/O error')
+        monkeypatch.setattr(store, '_log', fail)
+        with pytest.raises(sqlite3.OperationalError):
+            store.put(self._doc('a1', 'Replaced text'))
+        with pytest.raises(sqlite3.OperationalError):
+            store.delete('a1')
+        monkeypatch.undo()
+        assert store.get_content('a1') == 'Sample contract text'
+        
+        blobs.delete(blobs.digest('Sample contract text'))
+        with caplog.at_level('ERROR', logger='storage'):
+            assert store.get_content('a1') == ''
+        assert 'is missing' in caplog.text
+    
+    def test_inline_bodies_moved_to_blobs(self, tmp_path):
+        """Rows written before blobs were enabled are migrated on open"""
+        SQLiteDocumentStore(str(tmp_path / 'docs.db')).put(self._doc('a1'))
+        blobs = BlobStore(str(tmp_path / 'blobs'))
+        store = SQLiteDocumentStore(str(tmp_path / 'docs.db'), blobs)
+        row = store._connect().execute("SELECT content, content_hash FROM documents").fetchone()
+        assert row['content'] == '' and row['content_hash'] == blobs.digest('Sample contract text')
+        assert store.get('a1')['content'] == 'Sample contract text'
+    
+    def test_json_store_keeps_metadata_only(self, tmp_path):
+        """documents.json holds metadata; bodies load from blobs on demand"""
+        json_path = tmp_path / 'documents.json'
+        json_path.write_text(json.dumps({'a1': self._doc('a1')}))
+        store = JSONDocumentStore(str(json_path), BlobStore(str(tmp_path / 'blobs')))
+        assert 'Sample contract text' not in json_path.read_text()
+        assert store.get('a1')['content'] == 'Sample contract text'
+        assert 'content_hash' not in store.list_metadata()[0]
+    
+    def test_blob_compression_migrates_existing_bodies(self, tmp_path):
+        """Plain blobs stay readable and are rewritten compressed by migrate"""
+        text = 'The lessee shall pay rent monthly. ' * 200
+        plain = BlobStore(str(tmp_path / 'blobs'), codec='none')
+        digest = plain.put(text)
+        
+        gzipped = BlobStore(str(tmp_path / 'blobs'), codec='gzip', level=9)
+        assert gzipped.get(digest) == text
+        assert gzipped.stats()['compression_ratio'] == 1.0
+        assert gzipped.migrate()['rewritten'] == 1
+        assert BlobStore(str(tmp_path / 'blobs'), codec='none').get(digest) == text
+        stats = gzipped.stats()
+        assert stats['raw_bytes'] == len(text)
+        assert stats['compression_ratio'] > 10
+    
+    def test_blob_stats_kept_incrementally(self, tmp_path, monkeypatch):
+        """stats() reads running counters instead of walking the blobs"""
+        blobs = BlobStore(str(tmp_path / 'blobs'), codec='gzip')
+        assert blobs.stats()['blobs'] == 0
+        first, second = blobs.put('Clause one ' * 50), blobs.put('Clause two ' * 50)
+        blobs.put('Clause one ' * 50)
+        blobs.delete(second)
+        blobs.delete(second)
+        
+        monkeypatch.setattr(blobs, '_blob_paths', lambda: pytest.fail('stats walked the blobs'))
+        stats = blobs.stats()
+        assert stats['blobs'] == 1
+        assert stats['raw_bytes'] == len('Clause one ' * 50)
+        assert stats['stored_bytes'] == os.path.getsize(blobs._path(first))
+        monkeypatch.undo()
+        assert blobs.recount() == {k: stats[k] for k in ('blobs', 'stored_bytes', 'raw_bytes')}
+    
+    @pytest.mark.skipif(not ZSTD_AVAILABLE, reason='zstandard not installed')
+    def test_zstd_blobs_roundtrip(self, tmp_path):
+        """zstd bodies are transparent to the document store"""
+        store = SQLiteDocumentStore(str(tmp_path / 'docs.db'), BlobStore(str(tmp_path / 'blobs'), codec='zstd'))
+        store.put(self._doc('a1', 'Clause 4.2 ' * 100))
+        assert store.get_content('a1') == 'Clause 4.2 ' * 100
+        assert store.blobs.stats()['codec'] == 'zstd'
+    
+    def test_unknown_codec_rejected(self, tmp_path):
+        """Misconfigured codecs fail at startup"""
+        with pytest.raises(ValueError):
+            BlobStore(str(tmp_path / 'blobs'), codec='lz4')
+
+
+def _text_pdf(path, pages):
+    """Write a minimal PDF with one line of Helvetica text per page"""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None,
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for text in pages:
+        stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       f'/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>')
+        kids.append(f'{len(objects)} 0 R')
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'
+    body = b'%PDF-1.4\n'
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(body))
+        body += f'{number} 0 obj\n{obj}\nendobj\n'.encode()
+    xref = len(body)
+    body += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    body += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    body += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    path.write_bytes(body)
+
+
+class TestDocumentExtractors:
+    """Test PDF and DOCX text extraction"""
+    
+    @pytest.fixture
+    def processor(self, tmp_path):
+        return DocumentProcessor(
+            store=SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+            index=SearchIndex(str(tmp_path / 'index.db'))
+        )
+    
+    def test_docx_pages_split_at_page_breaks(self, processor, tmp_path):
+        """DOCX text is read from document.xml with page boundaries kept"""
+        import zipfile
+        w = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+        xml = (f'<w:document {w}><w:body>'
+               '<w:p><w:r><w:t>Lease</w:t></w:r><w:r><w:tab/><w:t>Agreement</w:t></w:r></w:p>'
+               '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+               '<w:p><w:r><w:lastRenderedPageBreak/><w:t>Schedule A</w:t></w:r></w:p>'
+               '</w:body></w:document>')
+        path = tmp_path / 'lease.docx'
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr('word/document.xml', xml)
+        
+        doc = processor.build_document(str(path), 'lease.docx')
+        assert doc['content'] == 'Lease\tAgreement\n\nSchedule A'
+        assert doc['pages'] == 2
+        assert doc['source_type'] == 'docx'
+    
+    def test_corrupt_docx_raises(self, processor, tmp_path):
+        """Unreadable DOCX files are rejected instead of stored as bytes"""
+        path = tmp_path / 'broken.docx'
+        path.write_bytes(b'not a zip')
+        with pytest.raises(ExtractionError):
+            processor.build_document(str(path), 'broken.docx')
+    
+    @pytest.mark.skipif(not PYPDF_AVAILABLE, reason='pypdf not installed')
+    def test_pdf_text_layer_read_per_page(self, processor, tmp_path):
+        """PDF text is extracted page by page without OCR"""
+        path = tmp_path / 'contract.pdf'
+        _text_pdf(path, ['Contract for sale', 'Signed by both parties'])
+        doc = processor.build_document(str(path), 'contract.pdf')
+        assert doc['pages'] == 2
+        assert doc['content'] == 'Contract for sale\n\nSigned by both parties'
+        assert doc['page_offsets'] == [0, len('Contract for sale') + 2]
+        assert 'ocr_confidence' not in doc
+    
+    @pytest.mark.skipif(not PYPDF_AVAILABLE, reason='pypdf not installed')
+    def test_pdf_image_only_pages_go_to_ocr(self, tmp_path):
+        """Only pages without a text layer are OCRed"""
+        from PIL import Image
+        path = tmp_path / 'scan.pdf'
+        Image.new('RGB', (100, 60), 'white').save(path)
+        
+        class FakeOCR:
+            calls = 0
+            
+            def is_available(self):
+                return True
+            
+            def extract_image(self, image):
+                FakeOCR.calls += 1
+                return {'success': True, 'text': 'scanned stamp', 'confidence': 77, 'word_count': 2}
+            
+            combine_pages = staticmethod(OCRProcessor.combine_pages)
+        
+        processor = DocumentProcessor(
+            store=SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+            index=SearchIndex(str(tmp_path / 'index.db')),
+            ocr=FakeOCR()
+        )
+        doc = processor.build_document(str(path), 'scan.pdf')
+        assert doc['content'] == 'scanned stamp'
+        assert doc['ocr_confidence'] == 77
+        assert FakeOCR.calls == 1
+    
+    @pytest.mark.skipif(not PYPDF_AVAILABLE, reason='pypdf not installed')
+    def test_pdf_with_no_readable_page_raises(self, tmp_path):
+        """A PDF whose every page failed is rejected instead of stored empty"""
+        from PIL import Image
+        path = tmp_path / 'scan.pdf'
+        Image.new('RGB', (100, 60), 'white').save(path)
+        ocr = OCRProcessor()
+        ocr.available = False
+        ocr.is_available = lambda: True  # Let the page reach extract_image
+        processor = DocumentProcessor(
+            store=SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+            index=SearchIndex(str(tmp_path / 'index.db')),
+            ocr=ocr
+        )
+        with pytest.raises(ExtractionError, match='Tesseract OCR not installed'):
+            processor.build_document(str(path), 'scan.pdf')
+
+
+class TestContentCache:
+    """Test the byte-budgeted LRU content cache"""
+    
+    def test_lru_eviction_by_bytes(self):
+        """Test least recently used entries are evicted over budget"""
+        cache = LRUCache(max_bytes=10, sizeof=len)
+        cache.put('a', 'xxxx')
+        cache.put('b', 'yyyy')
+        cache.get('a')
+        cache.put('c', 'zzzz')
+        assert cache.get('b') is None
+        assert cache.get('a') == 'xxxx'
+        stats = cache.stats()
+        assert stats['evictions'] == 1
+        assert stats['bytes'] == 8
+        assert stats['hits'] == 2 and stats['misses'] == 1
+    
+    def test_processor_loads_bodies_lazily(self, tmp_path):
+        """Test bodies are reloaded from storage after eviction"""
+        store = SQLiteDocumentStore(str(tmp_path / 'docs.db'))
+        index = SearchIndex(str(tmp_path / 'index.db'))
+        source = tmp_path / 'deed.txt'
+        source.write_text('Deed of conveyance')
+        doc_id = DocumentProcessor(store, index).process(str(source), 'deed.txt')['id']
+        
+        proc = DocumentProcessor(store, index)
+        assert 'content' not in proc.metadata[doc_id]
+        assert proc.get_document(doc_id)['content'] == 'Deed of conveyance'
+        assert proc.get_document(doc_id)['content'] == 'Deed of conveyance'
+        assert proc.cache_stats()['misses'] == 1
+        assert proc.cache_stats()['hits'] == 1
+
+
+class TestSharedState:
+    """Test state stays coherent across worker processes sharing files"""
+    
+    def test_processors_see_each_others_writes(self, tmp_path):
+        """Test a second worker picks up uploads and deletes via the change log"""
+        worker_a = DocumentProcessor(SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+                                     SearchIndex(str(tmp_path / 'index.db')))
+        worker_b = DocumentProcessor(SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+                                     SearchIndex(str(tmp_path / 'index.db')))
+        source = tmp_path / 'will.txt'
+        source.write_text('Last will and testament')
+        doc_id = worker_a.process(str(source), 'will.txt')['id']
+        
+        assert worker_b.get_document(doc_id)['content'] == 'Last will and testament'
+        assert worker_b.delete_document(doc_id) is True
+        assert worker_a.get_document(doc_id) is None
+        assert worker_a.list_documents() == []
+    
+    def test_json_store_reloads_external_writes(self, tmp_path):
+        """Test the JSON backend merges writes from another instance"""
+        path = str(tmp_path / 'documents.json')
+        first, second = JSONDocumentStore(path), JSONDocumentStore(path)
+        first.put({'id': 'a1', 'filename': 'a.txt', 'content': 'x', 'created_at': '', 'pages': 1, 'text_length': 1})
+        second.put({'id': 'b2', 'filename': 'b.txt', 'content': 'y', 'created_at': '', 'pages': 1, 'text_length': 1})
+        assert first.count() == 2
+    
+    def test_chain_concurrent_appends(self, tmp_path):
+        """Test concurrent add_block calls never fork the chain"""
+        import threading
+        from blockchain import SimpleChain
+        chain_file = str(tmp_path / 'chain.json')
+        ledgers = [SimpleChain(chain_file) for _ in range(4)]
+        threads = [
+            threading.Thread(target=lambda l=l: [l.add_block({'document_id': str(i)}) for i in range(10)])
+            for l in ledgers
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(ledgers[0].get_chain()) == 41
+        assert ledgers[1].verify()
+
+
+class TestBatchUpload:
+    """Test saving batch uploads and zip archives"""
+    
+    def _zip(self, names):
+        import io
+        import zipfile
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for name in names:
+                archive.writestr(name, 'clause')
+        buffer.seek(0)
+        return buffer
+    
+    def test_zip_member_limit_removes_saved_files(self, tmp_path, monkeypatch):
+        """Test an oversized zip is refused before extraction and earlier files are removed"""
+        import app as app_module
+        from werkzeug.datastructures import FileStorage
+        monkeypatch.setitem(app.config, 'UPLOAD_FOLDER', str(tmp_path))
+        monkeypatch.setattr(app_module, 'MAX_BATCH_FILES', 3)
+        (tmp_path / 'a.txt').write_text('existing')
+        
+        files = [FileStorage(self._zip(['a.txt', 'b.txt']), 'first.zip'),
+                 FileStorage(self._zip([f'{i}.txt' for i in range(5)]), 'second.zip')]
+        with pytest.raises(app_module.IngestionError):
+            app_module._save_batch_files(files)
+        assert sorted(os.listdir(tmp_path)) == ['a.txt']
+        assert (tmp_path / 'a.txt').read_text() == 'existing'
+        
+        saved, rejected = app_module._save_batch_files([FileStorage(self._zip(['a.txt']), 'c.zip')])
+        assert [name for _, name in saved] == ['a_1.txt']
+
+
+class TestJobQueue:
+    """Test the background upload job queue"""
+    
+    def _wait(self, queue, job_id):
+        import time
+        for _ in range(200):
+            job = queue.get(job_id)
+            if job['status'] in ('succeeded', 'failed'):
+                return job
+            time.sleep(0.01)
+        raise AssertionError('job did not finish')
+    
+    def test_job_reports_result(self, tmp_path):
+        """Test a job runs in the background and records its result"""
+        queue = JobQueue(str(tmp_path / 'jobs.db'), max_workers=1, max_pending=4)
+        
+        def work(report, value):
+            report(50, 'halfway')
+            return {'document_id': value}
+        
+        job = queue.submit('upload', work, 'abc123')
+        assert job['status'] == 'queued'
+        done = self._wait(queue, job['id'])
+        assert done['status'] == 'succeeded'
+        assert done['result'] == {'document_id': 'abc123'}
+    
+    def test_failed_job_keeps_error(self, tmp_path):
+        """Test exceptions mark the job failed with the message"""
+        queue = JobQueue(str(tmp_path / 'jobs.db'), max_workers=1, max_pending=4)
+        
+        def work(report):
+            raise RuntimeError('tesseract crashed')
+        
+        done = self._wait(queue, queue.submit('upload', work)['id'])
+        assert done['status'] == 'failed'
+        assert done['error'] == 'tesseract crashed'
+    
+    def test_back_pressure_when_full(self, tmp_path):
+        """Test submit raises once max_pending jobs are waiting"""
+        import threading
+        release = threading.Event()
+        started = threading.Event()
+        queue = JobQueue(str(tmp_path / 'jobs.db'), max_workers=1, max_pending=1)
+        
+        def block(report):
+            started.set()
+            release.wait(5)
+        
+        queue.submit('upload', block)
+        assert started.wait(5)  # the worker has taken the first job
+        queue.submit('upload', lambda report: None)
+        with pytest.raises(QueueFullError):
+            queue.submit('upload', lambda report: None)
+        release.set()
+    
+    def test_orphaned_jobs_fail_on_restart(self, tmp_path):
+        """Test unfinished jobs of a dead process are marked failed at startup"""
+        import jobs as jobs_module
+        path = str(tmp_path / 'jobs.db')
+        queue = JobQueue(path, max_workers=1, max_pending=4)
+        now = '2026-01-01T00:00:00'
+        with queue._connect() as conn:
+            conn.executemany(
+                'INSERT INTO jobs (id, kind, status, progress, created_at, updated_at, worker) '
+                'VALUES (?, ?, ?, 0, ?, ?, ?)',
+                [('stale', 'upload', 'running', now, now, f'{os.getpid()}:oldtoken'),
+                 ('live', 'upload', 'queued', now, now, queue._worker_id())]
+            )
+        
+        restarted = JobQueue(path, max_workers=1, max_pending=4)
+        assert restarted.get('stale')['status'] == 'failed'
+        assert restarted.get('live')['status'] == 'queued'
+        assert jobs_module._pid_alive(os.getpid())
+
+
 class TestSearchEngine:
     """Test SearchEngine module"""
     
@@ -355,6 +955,144 @@ class TestSearchEngine:
         assert len(results) <= 5
 
 
+class TestSearchIndex:
+    """Test the inverted index behind search"""
+    
+    @pytest.fixture
+    def indexed(self, tmp_path):
+        proc = DocumentProcessor(SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+                                 SearchIndex(str(tmp_path / 'index.db')))
+        engine = SearchEngine(proc.index, proc.store)
+        for name, text in [('lease.txt', 'The lease agreement binds the tenant.'),
+                           ('contract.txt', 'This contract is a sale agreement. Sale agreement terms apply.')]:
+            path = tmp_path / name
+            path.write_text(text)
+            proc.process(str(path), name)
+        return proc, engine
+    
+    def test_postings_have_positions(self, tmp_path):
+        """Test postings record term positions and offsets"""
+        index = SearchIndex(str(tmp_path / 'index.db'))
+        index.add_document({'id': 'd1', 'filename': 'a.txt', 'content': 'sale of sale'})
+        posting = index.postings('sale')[0]
+        assert posting.tf == 2
+        assert list(posting.positions) == [0, 2]
+        assert list(posting.offsets) == [0, 8]
+    
+    def test_whole_word_matching(self, indexed):
+        """Test a term does not match inside longer words"""
+        _, engine = indexed
+        assert engine.search('act') == []
+        assert engine.search('contract')[0]['filename'] == 'contract.txt'
+    
+    def test_phrase_ranks_first(self, indexed):
+        """Test the phrase document ranks first and match count comes from positions"""
+        _, engine = indexed
+        results = engine.search('sale agreement')
+        assert results[0]['filename'] == 'contract.txt'
+        assert results[0]['match_count'] == 2
+        assert results[0]['snippets']
+    
+    def test_bm25f_filename_field(self, indexed):
+        """Test a filename hit only counts in BM25F mode"""
+        _, engine = indexed
+        assert engine.search('lease', ranking='bm25f')[0]['relevance_score'] > \
+            engine.search('lease', ranking='bm25')[0]['relevance_score']
+        assert engine.search('txt', ranking='bm25') == []
+    
+    def test_top_k_matches_exhaustive_ranking(self, tmp_path):
+        """Test MaxScore pruning returns the same hits as scoring everything"""
+        proc = DocumentProcessor(SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+                                 SearchIndex(str(tmp_path / 'index.db')))
+        engine = SearchEngine(proc.index, proc.store)
+        for i in range(30):
+            path = tmp_path / f'doc{i}.txt'
+            path.write_text('clause ' * (i % 7 + 1) + 'tenant ' * (i % 3) + 'rare' * (i == 11))
+            proc.process(str(path), path.name)
+        
+        engine.scorer.refresh()
+        exhaustive = {}
+        for term in ('clause', 'tenant', 'rare'):
+            field_postings = {field: {p.doc_id: p for p in proc.index.postings(term, field)}
+                              for field in ('content', 'filename')}
+            for doc_id, value in engine.scorer.score_term(term, field_postings).items():
+                exhaustive[doc_id] = exhaustive.get(doc_id, 0.0) + value
+        expected = sorted(exhaustive.values(), reverse=True)[:5]
+        
+        results = engine.search('clause tenant rare', limit=5)
+        assert [r['relevance_score'] for r in results] == [round(v, 4) for v in expected]
+    
+    def test_invalid_ranking_mode(self, indexed):
+        """Test unknown ranking modes are rejected"""
+        _, engine = indexed
+        with pytest.raises(ValueError):
+            engine.search('lease', ranking='tfidf')
+    
+    def test_exact_phrase_query(self, indexed):
+        """Test quoted phrases only match contiguous terms"""
+        _, engine = indexed
+        assert [r['filename'] for r in engine.search('"sale agreement"')] == ['contract.txt']
+        assert engine.search('"agreement contract"') == []
+    
+    def test_near_query(self, indexed):
+        """Test NEAR/n matches terms within n positions"""
+        _, engine = indexed
+        assert [r['filename'] for r in engine.search('lease NEAR/4 tenant')] == ['lease.txt']
+        assert engine.search('lease NEAR/3 tenant') == []
+        assert len(engine.search('(lease OR sale) NEAR/1 agreement')) == 2
+    
+    def test_boolean_query(self, indexed):
+        """Test AND / NOT / OR operators"""
+        _, engine = indexed
+        assert [r['filename'] for r in engine.search('agreement NOT lease')] == ['contract.txt']
+        assert [r['filename'] for r in engine.search('agreement AND tenant')] == ['lease.txt']
+        assert len(engine.search('lease OR sale')) == 2
+    
+    def test_snippet_from_positions(self, indexed):
+        """Test snippets are cut around the stored match offsets"""
+        _, engine = indexed
+        result = engine.search('"binds the tenant"')[0]
+        assert result['match_count'] == 1
+        assert 'binds the tenant' in result['snippets'][0]
+    
+    def test_query_syntax_error(self, indexed):
+        """Test malformed queries raise QuerySyntaxError"""
+        _, engine = indexed
+        with pytest.raises(QuerySyntaxError):
+            engine.search('(lease AND')
+    
+    def test_delete_updates_index(self, indexed):
+        """Test deleted documents disappear from results"""
+        proc, engine = indexed
+        doc_id = engine.search('lease')[0]['document_id']
+        proc.delete_document(doc_id)
+        assert engine.search('lease') == []
+    
+    def test_rebuild_from_pending_marker(self, indexed, tmp_path):
+        """A restart rebuilds the index only after a write that reached the store but not the index"""
+        proc, engine = indexed
+        generation = proc.index.generation()
+        DocumentProcessor(proc.store, proc.index)
+        assert proc.index.generation() == generation
+        
+        # Same document count, different documents: only the marker notices
+        doc_id = engine.search('lease')[0]['document_id']
+        proc.index.begin_write()
+        proc.store.delete(doc_id)
+        proc.store.put_many([{'id': 'deed1', 'filename': 'deed.txt', 'content': 'A deed of gift.',
+                              'created_at': '2025-01-01T00:00:00', 'pages': 1, 'text_length': 15}])
+        assert proc.index.count() == proc.store.count()
+        DocumentProcessor(proc.store, proc.index)
+        assert engine.search('lease') == []
+        assert engine.search('deed')[0]['document_id'] == 'deed1'
+        assert not proc.index.needs_rebuild()
+        
+        fresh = SearchIndex(str(tmp_path / 'fresh.db'))
+        assert fresh.needs_rebuild()
+        DocumentProcessor(proc.store, fresh)
+        assert fresh.count() == 2
+
+
 class TestSummarizer:
     """Test DocumentSummarizer module"""
     
@@ -379,6 +1117,156 @@ class TestSummarizer:
         summary = summarizer_instance.summarize(text, max_length=100)
         assert isinstance(summary, str)
         assert len(summary) <= 100
+    
+    def test_score_sentences_by_term_frequency(self, summarizer_instance):
+        """Sentences sharing the document's frequent words score highest"""
+        sentences = ['The tenant pays rent.', 'Rent is due monthly; the tenant must pay rent.',
+                     'It is so.']
+        scores = summarizer_instance._score_sentences(sentences)
+        assert scores[1] > scores[0] > scores[2] == 0
+        assert summarizer_instance.extract_key_points(' '.join(sentences), num_points=1) == [sentences[1]]
+    
+    def test_score_sentences_scales_linearly(self, summarizer_instance, monkeypatch):
+        """Word-frequency lookups grow with the text (4x sentences, 4x lookups), not sentences x words"""
+        lookups = []
+        
+        class CountingCounter(Counter):
+            def __getitem__(self, word):
+                lookups.append(word)
+                return super().__getitem__(word)
+        
+        monkeypatch.setattr(summarizer_module, 'Counter', CountingCounter)
+        
+        def score(n):
+            lookups.clear()
+            sentences = [f'Clause binds party{i} and witness{i} alike.' for i in range(n)]
+            scores = summarizer_instance._score_sentences(sentences)
+            assert scores[n // 2] == scores[n - 1] > 3
+            return len(lookups)
+        
+        small = score(1000)
+        assert small > 0
+        assert score(4000) == 4 * small
+    
+    def test_tfidf_uses_corpus_document_frequencies(self, tmp_path):
+        """Words common across the corpus weigh less than words specific to this document"""
+        index = SearchIndex(str(tmp_path / 'index.db'))
+        index.add_documents([
+            {'id': f'd{i}', 'filename': 'x.txt', 'content': 'agreement between parties'} for i in range(5)
+        ])
+        assert index.document_frequencies(['agreement', 'arbitration'])['agreement'] == 5
+        summarizer = DocumentSummarizer(index)
+        sentences = ['This agreement binds both parties.', 'Arbitration happens in Mumbai.']
+        scores = summarizer._score_sentences(sentences, mode='tfidf')
+        assert scores[1] > scores[0]
+    
+    def test_textrank_prefers_central_sentences(self, summarizer_instance):
+        """Sentences similar to many others rank highest, with or without NumPy"""
+        sentences = ['The tenant pays rent to the landlord.', 'Rent is paid by the tenant monthly.',
+                     'The landlord receives the rent from the tenant.', 'Birds migrate south.']
+        scores = summarizer_instance._score_sentences(sentences, mode='textrank')
+        assert min(scores[0], scores[1], scores[2]) > scores[3]
+        
+        n, rows, cols, values = 3, [0, 0, 1, 2], [0, 1, 0, 1], [0.6, 0.8, 1.0, 1.0]
+        expected = summarizer_module._textrank_python(n, 2, rows, cols, values)
+        if summarizer_module.NUMPY_AVAILABLE:
+            assert summarizer_module._textrank_numpy(n, 2, rows, cols, values) == pytest.approx(expected)
+    
+    def test_textrank_without_numpy_is_capped(self, summarizer_instance, monkeypatch):
+        """Pure-Python TextRank refuses documents too large to rank on a request thread"""
+        from summarizer import SummaryModeUnavailable
+        monkeypatch.setattr(summarizer_module, 'NUMPY_AVAILABLE', False)
+        monkeypatch.setattr(summarizer_module, 'PYTHON_TEXTRANK_MAX_ENTRIES', 20)
+        text = ' '.join(f'Clause {i} requires notice in writing.' for i in range(20))
+        with pytest.raises(SummaryModeUnavailable):
+            summarizer_instance.summarize(text, max_length=100, mode='textrank')
+        assert summarizer_instance.summarize(text, max_length=100, mode='tfidf')
+    
+    def test_summary_modes(self, summarizer_instance):
+        """Every mode returns a bounded summary; unknown modes are rejected"""
+        text = ' '.join(f'Clause {i} requires notice in writing within {i} days.' for i in range(200))
+        for mode in SUMMARY_MODES:
+            assert len(summarizer_instance.summarize(text, max_length=200, mode=mode)) <= 203
+        with pytest.raises(ValueError):
+            summarizer_instance.summarize(text, mode='lsa')
+
+
+class TestTextAnalysis:
+    """Test the shared tokenization layer"""
+    
+    TEXT = 'The Lessee shall pay rent.  Rent is due on the 1st!\nNotice: Section 12(a) applies.'
+    
+    def test_analysis_roundtrip(self):
+        """Token ids, sentences and content words survive storage"""
+        analysis = AnalyzedText.analyze(self.TEXT)
+        assert [analysis.vocabulary[i] for i in analysis.ids] == query_terms(self.TEXT)
+        assert analysis.ids.typecode == 'H'
+        assert analysis.sentence_texts(self.TEXT) == [
+            'The Lessee shall pay rent.', 'Rent is due on the 1st!', 'Notice: Section 12(a) applies.'
+        ]
+        assert analysis.sentence_words()[0] == ['lessee', 'shall', 'rent']
+        assert analysis.term_counts().most_common(1) == [('rent', 2)]
+        
+        stored = AnalyzedText.from_bytes(analysis.to_bytes())
+        assert stored.ids == analysis.ids
+        assert stored.sentence_words() == analysis.sentence_words()
+        assert AnalyzedText.from_bytes(analysis.to_bytes().replace(
+            f'"version":{ANALYSIS_VERSION}'.encode(), b'"version":0')) is None
+    
+    def test_index_rows_from_analysis_match_tokenizer(self):
+        """Indexing from a stored analysis produces the same postings"""
+        doc = {'id': 'a1', 'filename': 'lease.txt', 'content': self.TEXT}
+        assert (SearchIndex._field_rows(doc, AnalyzedText.analyze(self.TEXT))
+                == SearchIndex._field_rows(doc))
+    
+    @pytest.mark.parametrize('blobs', [False, True])
+    def test_processor_stores_analysis(self, tmp_path, blobs):
+        """Ingest keeps the analysis compressed with the document; keywords read it"""
+        blob_store = BlobStore(str(tmp_path / 'blobs'), codec='gzip') if blobs else None
+        proc = DocumentProcessor(SQLiteDocumentStore(str(tmp_path / 'docs.db'), blob_store),
+                                 SearchIndex(str(tmp_path / 'index.db')))
+        path = tmp_path / 'lease.txt'
+        path.write_text(self.TEXT * 50)
+        doc = proc.process(str(path), 'lease.txt')
+        data = proc.store.get_attachment(doc['id'], 'analysis')
+        assert AnalyzedText.from_bytes(data).ids == AnalyzedText.analyze(self.TEXT * 50).ids
+        assert proc.store.get_derived(doc['id'], 'analysis') is None
+        assert proc.extract_metadata(doc['id'])['keywords'][0] == 'rent'
+        if blobs:
+            companion = blob_store._path(blob_store.digest(self.TEXT * 50)) + '.analysis'
+            assert os.path.getsize(companion) < len(data) / 2
+            proc.delete_document(doc['id'])
+            assert not os.path.exists(companion)
+            assert blob_store.stats()['stored_bytes'] == 0
+    
+    def test_metadata_extracted_at_ingest(self, tmp_path, monkeypatch):
+        """Metadata is stored at ingest, served as stored and recomputed when its version changes"""
+        proc = DocumentProcessor(SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+                                 SearchIndex(str(tmp_path / 'index.db')))
+        path = tmp_path / 'lease.txt'
+        path.write_text(self.TEXT + ' Filed 12/03/2024.')
+        doc = proc.process(str(path), 'lease.txt')
+        stored = proc.store.get_derived(doc['id'], 'metadata')
+        assert stored['version'] == document_processor.METADATA_VERSION
+        assert stored['entities']['potential_dates'] == ['12/03/2024']
+        
+        proc.store.put_derived([(doc['id'], 'metadata', {**stored, 'word_count': 999})])
+        assert proc.extract_metadata(doc['id'])['word_count'] == 999
+        assert proc.analyze([doc['id'], 'missing'])['combined_word_count'] == 999
+        assert proc.recompute_metadata() == 0
+        
+        monkeypatch.setattr(document_processor, 'METADATA_VERSION', 2)
+        assert proc.recompute_metadata() == 1
+        assert proc.extract_metadata(doc['id'])['word_count'] == len(path.read_text().split())
+        assert proc.recompute_metadata(recompute_all=True) == 1
+        
+        # Metadata from an older tokenization is outdated too
+        monkeypatch.setattr(document_processor, 'ANALYSIS_VERSION', 2)
+        assert proc.recompute_metadata() == 1
+        assert proc.store.get_derived(doc['id'], 'metadata')['analysis'] == 2
+        proc.store.put_derived([(doc['id'], 'metadata', {**stored, 'word_count': 999})])
+        assert proc.extract_metadata(doc['id'])['word_count'] == len(path.read_text().split())
+        assert 'analysis' not in proc.extract_metadata(doc['id'])
 
 
 class TestOCRProcessor:
@@ -397,6 +1285,249 @@ class TestOCRProcessor:
         """Test supported formats are defined"""
         assert hasattr(ocr_instance, 'SUPPORTED_FORMATS')
         assert len(ocr_instance.SUPPORTED_FORMATS) > 0
+    
+    def test_batch_extract_parallel_keeps_input_order(self, ocr_instance, tmp_path):
+        """Parallel batch results come back in input order"""
+        paths = [str(tmp_path / f'missing-{i}.png') for i in range(4)]
+        results = ocr_instance.batch_extract(paths, workers=2, page_timeout=5)
+        assert [doc['path'] for doc in results['documents']] == paths
+        assert results['successful'] + results['failed'] == 4
+    
+    def test_iter_batch_extract_yields_every_page(self, ocr_instance, tmp_path):
+        """Streaming batch yields one result per input index"""
+        paths = [str(tmp_path / f'missing-{i}.png') for i in range(3)]
+        indexes = sorted(i for i, _ in ocr_instance.iter_batch_extract(paths, workers=2))
+        assert indexes == [0, 1, 2]
+    
+    def test_batch_worker_reuses_one_processor(self, tmp_path, monkeypatch):
+        """A batch worker process builds its OCRProcessor once, with the parent's cache settings"""
+        import ocr_processor
+        created = []
+        
+        def build(cache=None):
+            created.append(cache)
+            return OCRProcessor(cache)
+        
+        monkeypatch.setattr(ocr_processor, 'OCRProcessor', build)
+        monkeypatch.setattr(ocr_processor, '_worker_processor', None)
+        ocr_processor._init_worker(str(tmp_path / 'cache'), 1024 * 1024)
+        for i in range(3):
+            assert ocr_processor._extract_page(str(tmp_path / f'missing-{i}.png'), 5)['success'] is False
+        assert len(created) == 1
+        assert created[0].directory == str(tmp_path / 'cache')
+
+    def test_parse_tesseract_data_rebuilds_layout(self, ocr_instance):
+        """Text, lines, boxes and confidence come from one image_to_data result"""
+        rows = [
+            # level, page, block, par, line, word, text, conf
+            (1, 1, 0, 0, 0, 0, '', '-1'),
+            (5, 1, 1, 1, 1, 1, 'Lease', '96'),
+            (5, 1, 1, 1, 1, 2, 'Agreement', '90.5'),
+            (4, 1, 1, 1, 2, 0, '', '-1'),
+            (5, 1, 1, 1, 2, 1, 'Term:', '80'),
+            (5, 1, 2, 1, 1, 1, 'Signed', '-1'),
+        ]
+        data = {key: [] for key in ('level', 'page_num', 'block_num', 'par_num', 'line_num',
+                                    'word_num', 'text', 'conf', 'left', 'top', 'width', 'height')}
+        for n, (level, page, block, par, line, word, text, conf) in enumerate(rows):
+            for key, value in zip(('level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num',
+                                   'text', 'conf', 'left', 'top', 'width', 'height'),
+                                  (level, page, block, par, line, word, text, conf, n * 10, 5, 8, 12)):
+                data[key].append(value)
+        
+        result = ocr_instance.parse_tesseract_data(data)
+        assert result['text'] == 'Lease Agreement\nTerm:\n\nSigned'
+        assert [line['words'] for line in result['lines']] == [2, 1, 1]
+        assert result['lines'][0]['box'] == [10, 5, 28, 17]
+        assert len(result['words']) == 4
+        assert result['confidence'] == round((96 + 90.5 + 80) / 3, 2)
+    
+    def test_tsv_to_dict_feeds_parser(self, ocr_instance):
+        """In-process engine TSV parses the same way as image_to_data output"""
+        tsv = ('1\t1\t0\t0\t0\t0\t0\t0\t100\t40\t-1\t\n'
+               '5\t1\t1\t1\t1\t1\t2\t3\t30\t10\t91.5\tStamp\n'
+               '5\t1\t1\t1\t1\t2\t40\t3\t20\t10\t88\tpaid\n')
+        result = ocr_instance.parse_tesseract_data(tsv_to_dict(tsv))
+        assert result['text'] == 'Stamp paid'
+        assert result['words'][1]['left'] == 40
+    
+    def test_engine_reports_backend(self, ocr_instance):
+        """Engine name reflects the backend actually in use"""
+        expected = 'tesserocr' if ocr_instance.engine_pool else ('pytesseract' if ocr_instance.available else 'none')
+        assert ocr_instance.engine == expected
+    
+    def test_ocr_cache_hit_skips_ocr(self, tmp_path):
+        """A repeat image with the same settings is served from the cache"""
+        from PIL import Image
+        image = tmp_path / 'scan.png'
+        Image.new('L', (60, 20), 255).save(image)
+        copy = tmp_path / 'renamed.png'
+        copy.write_bytes(image.read_bytes())
+        ocr = OCRProcessor(cache=OCRResultCache(str(tmp_path / 'cache'), 1024 * 1024))
+        calls = []
+        
+        def ocr_frame(frame, preprocess, timeout):
+            calls.append(preprocess)
+            return {'success': True, 'text': 'Exhibit A', 'confidence': 90, 'word_count': 2}
+        ocr._ocr_frame = ocr_frame
+        
+        assert 'cached' not in ocr.extract_text_with_preprocessing(str(image))
+        hit = ocr.extract_text_with_preprocessing(str(copy))
+        assert hit['cached'] and hit['text'] == 'Exhibit A'
+        ocr.extract_text(str(image))
+        assert calls == [True, False]
+    
+    def test_ocr_cache_evicts_least_recently_used(self, tmp_path):
+        """Cache directory stays within its size budget"""
+        cache = OCRResultCache(str(tmp_path / 'cache'), max_bytes=2500)
+        for i in range(10):
+            cache.put(cache.key(f'hash{i}', {}), {'success': True, 'text': 'x' * 400})
+        stats = cache.stats()
+        assert stats['bytes'] <= 2500
+        assert stats['evictions'] > 0
+        assert cache.get(cache.key('hash9', {})) is not None
+    
+    def test_ocr_cache_key_includes_engine(self, tmp_path):
+        """Results from one OCR engine or tesseract release are not served for another"""
+        ocr = OCRProcessor(cache=OCRResultCache(str(tmp_path / 'cache'), 1024 * 1024))
+        settings = ocr._settings(True)
+        assert settings['engine'] == ocr.engine
+        ocr._engine_version = 'tesseract 9.9.9'
+        assert ocr.cache.key('hash', ocr._settings(True)) != ocr.cache.key('hash', settings)
+    
+    def test_engine_pool_failure_reports_fallback(self, tmp_path, monkeypatch):
+        """Pages read by pytesseract after tesserocr fails are reported and cached as pytesseract"""
+        import ocr_processor
+        from blockchain import SimpleChain
+        from PIL import Image
+        monkeypatch.setattr(ocr_processor, 'TESSERACT_AVAILABLE', True)
+        monkeypatch.setattr(ocr_processor.pytesseract, 'get_tesseract_version', lambda: '5.3.0', raising=False)
+        monkeypatch.setattr(ocr_processor.pytesseract, 'image_to_data', lambda *args, **kwargs: tsv_to_dict(
+            '5\t1\t1\t1\t1\t1\t2\t3\t30\t10\t91\tStamp\n'), raising=False)
+        
+        class BrokenPool:
+            def recognize(self, image, timeout=None):
+                raise RuntimeError('Failed to init API, possibly an invalid tessdata path')
+        
+        ocr = OCRProcessor(cache=OCRResultCache(str(tmp_path / 'cache'), 1024 * 1024))
+        ocr.engine_pool = BrokenPool()
+        ocr._engine_version = 'tesseract 5.3.0 (tesserocr)'
+        tesserocr_key = ocr._cache_key('hash', False, 0)
+        path = tmp_path / 'scan.png'
+        Image.new('L', (60, 20), 255).save(path)
+        
+        assert ocr.extract_text(str(path))['text'] == 'Stamp'
+        assert ocr.engine == 'pytesseract'
+        assert ocr._settings(False)['engine_version'] == '5.3.0'
+        image_hash = SimpleChain.sha256_file(str(path))
+        assert ocr.cache.get(ocr.cache.key(image_hash, dict(ocr._settings(False), page=0)))['text'] == 'Stamp'
+        assert ocr._cache_key('hash', False, 0) != tesserocr_key
+    
+    def test_ocr_cache_stats_without_walking(self, tmp_path, monkeypatch):
+        """stats() keeps size and entry count up to date without rescanning"""
+        cache = OCRResultCache(str(tmp_path / 'cache'), max_bytes=1024 * 1024)
+        cache.put(cache.key('a', {}), {'text': 'x'})
+        cache.put(cache.key('a', {}), {'text': 'xy'})
+        cache.put(cache.key('b', {}), {'text': 'y'})
+        cache.get(cache.key('a', {}))
+        cache.get(cache.key('c', {}))
+        monkeypatch.setattr(cache, '_scan', lambda: pytest.fail('stats walked the cache'))
+        stats = cache.stats()
+        assert (stats['entries'], stats['hits'], stats['misses']) == (2, 1, 1)
+        monkeypatch.undo()
+        assert stats['bytes'] == cache._scan()[1]
+    
+    def test_multipage_tiff_streams_every_page(self, tmp_path):
+        """Every TIFF frame is OCRed and the document stores the real page count"""
+        from PIL import Image
+        path = tmp_path / 'bundle.tiff'
+        frames = [Image.new('L', (80, 40), shade) for shade in (250, 240, 230)]
+        frames[0].save(path, save_all=True, append_images=frames[1:])
+        
+        ocr = OCRProcessor(cache=OCRResultCache(str(tmp_path / 'cache'), 0))
+        ocr._recognize = lambda image, timeout=None: {
+            'text': f'page text {image.getpixel((0, 0))}', 'confidence': 80, 'lines': [], 'words': [{}, {}, {}]
+        }
+        pages = ocr.iter_pages(str(path), preprocess=False)
+        first = next(pages)
+        assert (first['page'], first['page_count']) == (1, 3)
+        
+        processor = DocumentProcessor(
+            store=SQLiteDocumentStore(str(tmp_path / 'docs.db')),
+            index=SearchIndex(str(tmp_path / 'index.db'))
+        )
+        doc = processor.build_paged_document(str(path), 'bundle.tiff', [first, *pages])
+        assert doc['pages'] == 3
+        assert doc['content'].split('\n\n') == ['page text 250', 'page text 240', 'page text 230']
+        assert [doc['content'][offset:offset + 9] for offset in doc['page_offsets']] == ['page text'] * 3
+        assert doc['ocr_confidence'] == 80
+
+
+class TestImagePreprocessing:
+    """Test OCR image preprocessing"""
+    
+    @pytest.fixture
+    def scan(self):
+        from PIL import Image, ImageDraw
+        image = Image.new('RGB', (400, 200), (235, 230, 220))
+        draw = ImageDraw.Draw(image)
+        for y in range(10, 190, 20):
+            draw.text((10, y), 'Lease agreement dated 2024', fill=(40, 40, 40))
+        return image
+    
+    def test_downsamples_to_target_dpi(self, scan):
+        """High-DPI scans are converted to grayscale at the target resolution"""
+        scan.info['dpi'] = (600, 600)
+        gray = image_preprocessing.grayscale_at_dpi(scan, target_dpi=300)
+        assert gray.mode == 'L'
+        assert gray.size == (200, 100)
+    
+    @pytest.mark.skipif(not image_preprocessing.NUMPY_AVAILABLE, reason='numpy not installed')
+    def test_numpy_pipeline_matches_pil(self, scan):
+        """Fused NumPy pipeline produces the same image as the PIL passes"""
+        import numpy as np
+        gray = scan.convert('L')
+        fast = np.asarray(image_preprocessing._preprocess_numpy(gray, 1.5, 1.1, 2.0, 3, False), dtype=int)
+        reference = np.asarray(image_preprocessing._preprocess_pil(gray, 1.5, 1.1, 2.0, 3, False), dtype=int)
+        assert fast.shape == reference.shape
+        assert np.abs(fast - reference).max() <= 2
+    
+    def test_binarize_outputs_black_and_white(self, scan):
+        """Adaptive binarization leaves only ink and paper"""
+        result = image_preprocessing.preprocess_image(scan, binarize=True)
+        histogram = result.histogram()
+        assert sum(histogram[1:255]) == 0
+        assert histogram[0] > 0
+    
+    def _fake_ocr(self, ocr_instance, confidences):
+        seen = []
+        
+        def recognize(image, timeout=None):
+            seen.append(image)
+            return {'text': 'Lease', 'confidence': confidences[len(seen) - 1], 'lines': [], 'words': [{}]}
+        ocr_instance._recognize = recognize
+        ocr_instance.cache = None
+        return seen
+    
+    def test_clean_input_skips_enhancement(self, ocr_instance, scan, tmp_path):
+        """High-contrast, noise-free images go straight to OCR"""
+        path = tmp_path / 'clean.png'
+        scan.convert('L').point(lambda v: 0 if v < 128 else 255).save(path)
+        seen = self._fake_ocr(ocr_instance, [95])
+        result = ocr_instance.extract_text_with_preprocessing(str(path))
+        assert result['preprocessing'] == 'fast'
+        assert len(seen) == 1
+    
+    def test_low_confidence_retries_heavy_path(self, ocr_instance, scan, tmp_path):
+        """Heavy preprocessing runs only after a weak first pass"""
+        from PIL import Image
+        path = tmp_path / 'noisy.png'
+        Image.blend(scan.convert('L'), Image.effect_noise(scan.size, 40), 0.4).save(path)
+        seen = self._fake_ocr(ocr_instance, [40, 75])
+        result = ocr_instance.extract_text_with_preprocessing(str(path))
+        assert len(seen) == 2
+        assert result['preprocessing'] == 'heavy'
+        assert result['confidence'] == 75
 
 
 if __name__ == '__main__':
@@ -0,0 +1,209 @@
+"""Shared tokenization and per-document text analysis"""
+
+import json
+import re
+from array import array
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# The one tokenizer: search terms, keywords and summary words all come from it
+TOKEN_PATTERN = re.compile(r'\w+')
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+STOP_WORDS = frozenset({
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for',
+    'is', 'are', 'was', 'were', 'be', 'been', 'being'
+})
+# Words shorter than this are never keywords or summary terms
+MIN_WORD_LENGTH = 4
+
+# Bump when tokenization or sentence splitting changes; stored analyses
+# with another version are recomputed
+ANALYSIS_VERSION = 1
+
+
+def tokenize(text: str) -> List[Tuple[str, int, int]]:
+    """
+    Split text into lowercase terms
+
+    Returns:
+        List of (term, token position, character offset) tuples
+    """
+    return [
+        (match.group().lower(), position, match.start())
+        for position, match in enumerate(TOKEN_PATTERN.finditer(text or ''))
+    ]
+
+
+def query_terms(query: str) -> List[str]:
+    """Lowercase terms of a query in their original order"""
+    return [term for term, _, _ in tokenize(query)]
+
+
+def is_important(term: str) -> bool:
+    """Whether a (lowercase) term counts as a content word"""
+    return len(term) >= MIN_WORD_LENGTH and term not in STOP_WORDS
+
+
+def important_words(text: str) -> List[str]:
+    """Lowercase content words of a text, in order"""
+    return [term for term in query_terms(text) if is_important(term)]
+
+
+def sentence_spans(text: str) -> List[Tuple[int, int]]:
+    """(start, end) character spans of the non-empty, stripped sentences of a text"""
+    spans = []
+    start = 0
+    for boundary in [*SENTENCE_PATTERN.finditer(text), None]:
+        end = boundary.start() if boundary else len(text)
+        sentence = text[start:end]
+        stripped = sentence.strip()
+        if stripped:
+            left = start + len(sentence) - len(sentence.lstrip())
+            spans.append((left, left + len(stripped)))
+        if boundary:
+            start = boundary.end()
+    return spans
+
+
+def _typecode(count: int) -> str:
+    """Smallest unsigned array typecode holding ids below ``count``"""
+    return 'H' if count <= 0xFFFF else 'I'
+
+
+class AnalyzedText:
+    """
+    A document tokenized once, as ids into its own vocabulary
+
+    Tokens are stored in ``array`` buffers (2 bytes per token for documents
+    with fewer than 65536 distinct terms) rather than lists of strings, so
+    the analysis can be kept with the document and reused by the search
+    index, keyword extraction and the summarizer.
+
+    Attributes:
+        vocabulary: Distinct lowercase terms; a term's id is its position
+        ids: Term id of every token, in document order
+        offsets: Character offset of every token (only after ``analyze``;
+            not persisted, as the search index stores its own)
+        sentences: Flat (start, end) character spans of the sentences
+        sentence_tokens: Index of each sentence's first token, plus the
+            token count at the end
+    """
+
+    __slots__ = ('vocabulary', 'ids', 'offsets', 'sentences', 'sentence_tokens', '_important')
+
+    def __init__(self, vocabulary: List[str], ids: array, sentences: array, sentence_tokens: array,
+                 offsets: Optional[array] = None):
+        self.vocabulary = vocabulary
+        self.ids = ids
+        self.offsets = offsets
+        self.sentences = sentences
+        self.sentence_tokens = sentence_tokens
+        self._important = None
+
+    @classmethod
+    def analyze(cls, text: str) -> 'AnalyzedText':
+        """Tokenize ``text`` and split it into sentences in one pass each"""
+        text = text or ''
+        term_ids: Dict[str, int] = {}
+        assign = term_ids.setdefault
+        ids = []
+        offsets = array('I')
+        for match in TOKEN_PATTERN.finditer(text):
+            ids.append(assign(match.group().lower(), len(term_ids)))
+            offsets.append(match.start())
+        vocabulary = list(term_ids)
+
+        sentences = array('I')
+        sentence_tokens = array('I')
+        token = 0
+        for start, end in sentence_spans(text):
+            sentences.extend((start, end))
+            # Tokens never straddle a sentence boundary (boundaries are whitespace)
+            while token < len(offsets) and offsets[token] < start:
+                token += 1
+            sentence_tokens.append(token)
+        sentence_tokens.append(len(offsets))
+        return cls(vocabulary, array(_typecode(len(vocabulary)), ids), sentences, sentence_tokens, offsets)
+
+    @property
+    def sentence_count(self) -> int:
+        return len(self.sentence_tokens) - 1
+
+    def sentence_texts(self, text: str) -> List[str]:
+        """Sentences of the analysed ``text``"""
+        return [text[self.sentences[2 * i]:self.sentences[2 * i + 1]] for i in range(self.sentence_count)]
+
+    def important(self) -> List[bool]:
+        """Per term id, whether the term is a content word"""
+        if self._important is None:
+            self._important = [is_important(term) for term in self.vocabulary]
+        return self._important
+
+    def sentence_words(self) -> List[List[str]]:
+        """Content words of each sentence"""
+        important = self.important()
+        vocabulary = self.vocabulary
+        bounds = self.sentence_tokens
+        return [
+            [vocabulary[term_id] for term_id in self.ids[bounds[i]:bounds[i + 1]] if important[term_id]]
+            for i in range(self.sentence_count)
+        ]
+
+    def term_counts(self) -> Counter:
+        """Occurrences of every content word"""
+        important = self.important()
+        return Counter({
+            self.vocabulary[term_id]: count
+            for term_id, count in Counter(self.ids).items() if important[term_id]
+        })
+
+    def postings(self) -> Dict[str, Tuple[List[int], List[int]]]:
+        """Token positions and character offsets of every term, for the search index"""
+        if self.offsets is None:
+            raise ValueError('Offsets are only available on a fresh analysis')
+        grouped: Dict[str, Tuple[List[int], List[int]]] = {}
+        vocabulary = self.vocabulary
+        for position, (term_id, offset) in enumerate(zip(self.ids, self.offsets)):
+            positions, offsets = grouped.setdefault(vocabulary[term_id], ([], []))
+            positions.append(position)
+            offsets.append(offset)
+        return grouped
+
+    def to_bytes(self) -> bytes:
+        """
+        Binary form without offsets: a JSON header line, then the raw arrays
+
+        Callers store it compressed (see DocumentStore.put_attachments).
+        """
+        header = {
+            'version': ANALYSIS_VERSION,
+            'vocabulary': self.vocabulary,
+            'typecode': self.ids.typecode,
+            'sizes': [len(self.ids), len(self.sentences), len(self.sentence_tokens)]
+        }
+        # json.dumps escapes newlines, so the header is a single line
+        return b''.join((json.dumps(header, separators=(',', ':')).encode('utf-8'), b'\n',
+                         self.ids.tobytes(), self.sentences.tobytes(), self.sentence_tokens.tobytes()))
+
+    @classmethod
+    def from_bytes(cls, data: Optional[bytes]) -> Optional['AnalyzedText']:
+        """Inverse of ``to_bytes``; None for a missing or outdated analysis"""
+        if not data:
+            return None
+        line, _, body = data.partition(b'\n')
+        try:
+            header = json.loads(line)
+        except ValueError:
+            return None
+        if header.get('version') != ANALYSIS_VERSION:
+            return None
+        arrays = []
+        position = 0
+        for typecode, size in zip((header['typecode'], 'I', 'I'), header['sizes']):
+            values = array(typecode)
+            end = position + size * values.itemsize
+            values.frombytes(body[position:end])
+            arrays.append(values)
+            position = end
+        return cls(header['vocabulary'], *arrays)
@@ -75,17 +75,25 @@ function App() {
 
   const fetchDocuments = async () => {
     try {
-      const response = await fetch(`${API_BASE}/documents`, { headers: { ...authHeader } });
-      if (!response.ok) {
-        const msg = await response.text();
-        throw new Error(msg || `Failed to fetch documents (${response.status})`);
-      }
-      const data = await response.json();
-      if (data.success) {
-        setDocuments(data.documents);
-      } else {
-        throw new Error(data.error || 'Unknown error');
-      }
+      // The listing is paginated; follow next_cursor until the last page
+      const all = [];
+      let cursor = null;
+      do {
+        const params = new URLSearchParams({ limit: '500' });
+        if (cursor) params.set('cursor', cursor);
+        const response = await fetch(`${API_BASE}/documents?${params}`, { headers: { ...authHeader } });
+        if (!response.ok) {
+          const msg = await response.text();
+          throw new Error(msg || `Failed to fetch documents (${response.status})`);
+        }
+        const data = await response.json();
+        if (!data.success) {
+          throw new Error(data.error || 'Unknown error');
+        }
+        all.push(...data.documents);
+        cursor = data.next_cursor;
+      } while (cursor);
+      setDocuments(all);
     } catch (error) {
       console.error('Error fetching documents:', error);
       toast.error(`Load failed: ${error.message}`);